@@ -0,0 +1,207 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 10:12:37 2026
+
+Goal: Read the position and the state of many actuators at the same time.
+
+Each actuator is a different controller (a different COM port), so they can
+be queried in parallel, each one in its own thread. The queries of a single
+controller are still done one after the other.
+The reading can also be started before taking the counts, such that the
+actuators are queried while the fpga is counting.
+
+Each reading is time stamped, which allows to interpolate the position of
+each actuator at the middle of each count window.
+
+@author: Childresslab
+"""
+
+import numpy as np
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def read_actuator(api):
+    """
+    Read the position and the state of one actuator.
+    Return (t, position, state), where t is the time of the position query
+    (middle of the query).
+    """
+    if hasattr(api, 'get_position_and_state'):
+        # Both in a single round trip
+        t0 = time.time()
+        position, state = api.get_position_and_state()
+        t1 = time.time()
+        return 0.5*(t0+t1), position, state
+    t0 = time.time()
+    position = api.get_position()
+    t1 = time.time()
+    state = api.get_state()
+    return 0.5*(t0+t1), position, state
+
+def interpolate_positions(ts_reading, positions, ts):
+    """
+    Return the positions at the times ts, linearly interpolated from the
+    readings. Outside of the readings, the closest reading is taken.
+
+    ts_reading:
+        Array of the times of the readings.
+    positions:
+        Array of the positions read at ts_reading.
+    ts:
+        Times at which we want the positions.
+    """
+    ts_reading = np.asarray(ts_reading, dtype=float)
+    positions  = np.asarray(positions , dtype=float)
+    if len(ts_reading) == 0:
+        return np.full(len(ts), np.nan)
+    # np.interp needs increasing times
+    order = np.argsort(ts_reading)
+    return np.interp(ts, ts_reading[order], positions[order])
+
+
+class ActuatorPoller():
+    """
+    Query many actuators in parallel.
+
+    Typical use, for overlapping the reading with the counts:
+        poller = ActuatorPoller([X.api, Y.api, Z.api])
+        poller.start()
+        ... take the counts ...
+        ts, positions, states = poller.get()
+        poller.close()
+    """
+    def __init__(self, list_api):
+        """
+        list_api:
+            List of the api of the actuators. They must have the methods
+            get_position() and get_state().
+        """
+        _debug('ActuatorPoller: __init__')
+        _debug('Do what you can, with what you have, where you are. – Theodore Roosevelt')
+
+        self.list_api = list_api
+        # One thread per actuator
+        self.executor = ThreadPoolExecutor(max_workers=len(list_api))
+        self.futures = None
+
+        # All the readings, for each actuator
+        self.ts_reading        = [[] for api in list_api]
+        self.positions_reading = [[] for api in list_api]
+
+    def start(self):
+        """
+        Start to read all the actuators, without waiting for the answer.
+        """
+        _debug('ActuatorPoller: start')
+
+        self.futures = [self.executor.submit(read_actuator, api) for api in self.list_api]
+
+    def get(self):
+        """
+        Wait for the reading started with start() and return it.
+        Return (ts, positions, states), three lists with one element per
+        actuator.
+        """
+        _debug('ActuatorPoller: get')
+
+        if self.futures is None:
+            self.start()
+        ts, positions, states = [], [], []
+        for i, future in enumerate(self.futures):
+            t, position, state = future.result()
+            ts       .append(t)
+            positions.append(position)
+            states   .append(state)
+            self.ts_reading       [i].append(t)
+            self.positions_reading[i].append(position)
+        self.futures = None
+        return ts, positions, states
+
+    def poll(self):
+        """
+        Read all the actuators in parallel and wait for the answer.
+        Same output as get().
+        """
+        self.start()
+        return self.get()
+
+    def get_positions_at(self, ts):
+        """
+        Return the positions of each actuator at the times ts, interpolated
+        from all the readings done so far. The output has the shape
+        (number of actuators, len(ts)).
+        """
+        return np.array([interpolate_positions(self.ts_reading[i],
+                                               self.positions_reading[i], ts)
+                         for i in range(len(self.list_api))])
+
+    def close(self):
+        """
+        Stop the threads.
+        """
+        _debug('ActuatorPoller: close')
+
+        if not(self.futures is None):
+            self.get()
+        self.executor.shutdown(wait=True)
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Fake actuators with a slow serial link, moving at constant speed
+    class FakeActuator():
+        def __init__(self, speed):
+            self.speed = speed
+            self.t0 = time.time()
+        def get_position(self):
+            time.sleep(0.01)
+            return self.speed*(time.time()-self.t0)
+        def get_state(self):
+            time.sleep(0.01)
+            return 'MOVING'
+
+    list_api = [FakeActuator(1), FakeActuator(2), FakeActuator(3)]
+
+    # One after the other, like before
+    t0 = time.time()
+    for i in range(20):
+        for api in list_api:
+            api.get_position()
+        for api in list_api:
+            api.get_state()
+        time.sleep(0.01) # Counts
+    rate_serial = 20/(time.time()-t0)
+
+    # In parallel, during the counts
+    poller = ActuatorPoller(list_api)
+    windows = []
+    t0 = time.time()
+    for i in range(20):
+        poller.start()
+        t_start = time.time()
+        time.sleep(0.01) # Counts
+        windows.append(0.5*(t_start + time.time()))
+        poller.get()
+    rate_parallel = 20/(time.time()-t0)
+    positions = poller.get_positions_at(windows)
+    poller.close()
+
+    print('Checkpoints per second: %.1f serial, %.1f in parallel'%(rate_serial, rate_parallel))
+    error = positions[0] - (np.array(windows) - list_api[0].t0)
+    print('Error of the interpolated position of X: %.4f'%np.max(np.abs(error)))
@@ -0,0 +1,360 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Wed Oct 21 09:12:40 2026
+
+Goal: After a coarse magnet sweep, sweep again more finely only where the
+photoluminescence (PL) changes, for example at the level anticrossings.
+
+The steps are:
+    - Each line of the coarse sweep is given with its counts. The counts
+      along the line are smoothed and compared to their noise. The places
+      where they dip below the median of the line, or where their slope is
+      large, are the features.
+    - Around each feature, short lines are proposed: one on the same line
+      and some parallel ones on each side (in the plane of the sweep if it
+      is flat), the closest to the feature being the most important.
+    - The proposed lines that are almost the same as a more significant one
+      (for example the parallel lines of features on adjacent coarse lines)
+      are removed.
+    - The most significant lines are taken, as many as the sweep of all of
+      them, with the travel between them, fits in the time budget. This
+      number is found by bisection, with a quick order of the lines (nearest
+      neighbour). The order of the lines taken is then improved with the
+      path planner.
+The result is a path (xs, ys, zs) in the same format as the settings of
+GUIMagnetSweepLines, to be swept after the coarse one.
+
+@author: Childresslab
+"""
+
+import numpy as np
+from scipy.ndimage import gaussian_filter1d
+
+from path_planner import order_lines, get_durations # For the order of the lines and their time
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def find_features(ss, ws, size_smooth=3, nb_sigma=5):
+    """
+    Find the dips and the steep parts of the counts along a line.
+    Return a list of (s, score), where s is the position of the feature
+    along the line and score its significance (in standard deviations).
+
+    ss:
+        Position of each point along the line (increasing).
+    ws:
+        Counts of each point.
+    size_smooth:
+        Standard deviation (in number of points) of the gaussian smoothing.
+    nb_sigma:
+        Minimum significance of a feature.
+    """
+    ss = np.asarray(ss, dtype=float)
+    ws = np.asarray(ws, dtype=float)
+    N = len(ws)
+    if N < 4*size_smooth:
+        return []
+
+    smooth = gaussian_filter1d(ws, size_smooth, mode='nearest')
+    # Noise of a single point, from the differences between neighbours
+    # (robust to the features), and of the smoothed counts
+    noise = 1.4826*np.median(np.abs(np.diff(ws)))/np.sqrt(2)
+    if noise <= 0:
+        noise = np.sqrt(max(np.median(ws), 1))
+    noise_smooth = noise/np.sqrt(2*np.sqrt(np.pi)*size_smooth)
+
+    # Dips below the rest of the line
+    score_dip = (np.median(smooth) - smooth)/noise_smooth
+    # Slope, on the scale of the smoothing
+    k = int(np.ceil(size_smooth))
+    score_slope = np.zeros(N)
+    score_slope[k:-k] = np.abs(smooth[2*k:] - smooth[:-2*k])/(np.sqrt(2)*noise_smooth)
+    scores = np.maximum(score_dip, score_slope)
+
+    # Each region above the threshold is one feature, at its maximum
+    is_above = scores > nb_sigma
+    features = []
+    i = 0
+    while i < N:
+        if is_above[i]:
+            j = i
+            while j < N and is_above[j]:
+                j += 1
+            i_max = i + np.argmax(scores[i:j])
+            features.append((ss[i_max], scores[i_max]))
+            i = j
+        else:
+            i += 1
+    return features
+
+def get_perpendiculars(points, direction, tolerance=1e-3):
+    """
+    Return the list of the unit vectors perpendicular to the direction along
+    which to put the parallel lines: in the plane of the points if they are on
+    a plane, the two perpendiculars if they fill a volume, none if they are
+    on a line.
+    """
+    direction = direction/np.linalg.norm(direction)
+    centered = points - np.mean(points, axis=0)
+    singular_values, axes = np.linalg.svd(centered, full_matrices=False)[1:]
+    nb_dimensions = np.sum(singular_values > tolerance*singular_values[0])
+    if nb_dimensions <= 1:
+        return []
+    if nb_dimensions == 2:
+        perpendicular = np.cross(axes[2], direction)
+        norm = np.linalg.norm(perpendicular)
+        return [] if norm < tolerance else [perpendicular/norm]
+    # Volume: any two perpendiculars
+    helper = np.eye(3)[np.argmin(np.abs(direction))]
+    p1 = np.cross(direction, helper)
+    p1 /= np.linalg.norm(p1)
+    return [p1, np.cross(direction, p1)]
+
+
+class AdaptiveSweepPlanner():
+    """
+    Collect the lines of a coarse sweep and plan the finer lines around the
+    features.
+
+    Typical use:
+        planner = AdaptiveSweepPlanner(time_budget_s=3600, speed_refine=0.05, ...)
+        for each line swept:
+            planner.add_line(r_start, r_end, xs, ys, zs, ws)
+        xs, ys, zs, is_refined = planner.plan(r_now)
+    """
+    def __init__(self, time_budget_s, speed_refine, speed_transit,
+                 half_width=0.2, spacing=0.05, nb_offsets=2,
+                 speeds_max=[2, 2, 2], acceleration=None,
+                 nb_sigma=5, size_smooth=3):
+        """
+        time_budget_s:
+            Maximum time (s) for the fine sweep, travel included.
+        speed_refine:
+            Speed (mm/s) along the fine lines.
+        speed_transit:
+            Speed (mm/s) between the fine lines.
+        half_width:
+            Each fine line goes from half_width before to half_width after
+            the feature (mm).
+        spacing:
+            Distance between the parallel fine lines (mm).
+        nb_offsets:
+            Number of parallel fine lines on each side of the feature.
+        speeds_max:
+            Speed limit of each axis (mm/s).
+        acceleration:
+            Acceleration of the actuators (mm/s^2). None for instantaneous.
+        nb_sigma, size_smooth:
+            For finding the features, see find_features.
+        """
+        _debug('AdaptiveSweepPlanner: __init__')
+        _debug('Measure twice, cut once. – Proverb')
+
+        self.time_budget_s = time_budget_s
+        self.speed_refine  = speed_refine
+        self.speed_transit = speed_transit
+        self.half_width    = half_width
+        self.spacing       = spacing
+        self.nb_offsets    = nb_offsets
+        self.speeds_max    = np.array(speeds_max, dtype=float)
+        self.acceleration  = acceleration
+        self.nb_sigma      = nb_sigma
+        self.size_smooth   = size_smooth
+
+        self.points   = [] # Extremities of the coarse lines, for the geometry
+        self.features = [] # (position, direction, score) of each feature
+        self.duration_planned = 0
+
+    def add_line(self, r_start, r_end, xs, ys, zs, ws):
+        """
+        Add a line of the coarse sweep and find its features.
+
+        r_start, r_end:
+            (x, y, z) start and end of the line (mm).
+        xs, ys, zs, ws:
+            Positions and counts of the points of the line.
+        """
+        _debug('AdaptiveSweepPlanner: add_line')
+
+        r_start = np.array(r_start, dtype=float)
+        r_end   = np.array(r_end  , dtype=float)
+        self.points.extend([r_start, r_end])
+        length = np.linalg.norm(r_end - r_start)
+        if length == 0 or len(ws) == 0:
+            return
+        direction = (r_end - r_start)/length
+        positions = np.transpose([xs, ys, zs]).astype(float)
+        ss = np.dot(positions - r_start, direction)
+        order = np.argsort(ss)
+        for s, score in find_features(ss[order], np.asarray(ws)[order],
+                                      self.size_smooth, self.nb_sigma):
+            self.features.append((r_start + s*direction, direction, score))
+
+    def get_candidates(self):
+        """
+        Return the list of the proposed fine lines, as (score, start, end),
+        from the most to the least important.
+        """
+        candidates = []
+        if len(self.features) == 0:
+            return candidates
+        points = np.array(self.points)
+        r_min, r_max = np.min(points, axis=0), np.max(points, axis=0)
+        for r0, direction, score in self.features:
+            offsets = [np.zeros(3)]
+            for p in get_perpendiculars(points, direction):
+                for k in range(1, self.nb_offsets+1):
+                    offsets.extend([k*self.spacing*p, -k*self.spacing*p])
+            for offset in offsets:
+                # Stay in the region of the coarse sweep
+                start = np.clip(r0 + offset - self.half_width*direction, r_min, r_max)
+                end   = np.clip(r0 + offset + self.half_width*direction, r_min, r_max)
+                if np.linalg.norm(end - start) == 0:
+                    continue
+                # The further from the feature, the less important
+                k = np.linalg.norm(offset)/self.spacing
+                candidates.append((score/(1+k), start, end))
+        candidates.sort(key=lambda c: -c[0])
+        return self.remove_duplicates(candidates)
+
+    def remove_duplicates(self, candidates):
+        """
+        Return the candidates without those that are almost a more important
+        one: both ends closer than half the spacing, in any direction. The
+        parallel lines of features found on adjacent coarse lines often
+        overlap like that.
+
+        candidates:
+            List of (score, start, end), from the most to the least important.
+        """
+        tolerance = 0.5*self.spacing
+        kept = []
+        starts = np.zeros((len(candidates), 3))
+        ends   = np.zeros((len(candidates), 3))
+        for candidate in candidates:
+            score, start, end = candidate
+            n = len(kept)
+            d_start = np.linalg.norm(starts[:n] - start, axis=1)
+            d_end   = np.linalg.norm(ends[:n]   - end  , axis=1)
+            d_start_flipped = np.linalg.norm(starts[:n] - end  , axis=1)
+            d_end_flipped   = np.linalg.norm(ends[:n]   - start, axis=1)
+            if np.any((np.maximum(d_start, d_end) < tolerance) |
+                      (np.maximum(d_start_flipped, d_end_flipped) < tolerance)):
+                continue
+            starts[n], ends[n] = start, end
+            kept.append(candidate)
+        return kept
+
+    def get_plan_duration(self, starts, ends, r_start, nb_pass_max=50):
+        """
+        Return (order, is_flipped, duration) for sweeping the lines from
+        r_start.
+
+        nb_pass_max:
+            Maximum number of passes of 2-opt for the order of the lines, 0 for
+            the nearest neighbour only (quicker).
+        """
+        kwargs = {'speeds':self.speeds_max, 'acceleration':self.acceleration}
+        order, is_flipped = order_lines(starts, ends, r_start=r_start,
+                                        speed_line=self.speed_transit,
+                                        nb_pass_max=nb_pass_max, **kwargs)
+        entries = np.where(is_flipped[:,None], ends[order], starts[order])
+        exits   = np.where(is_flipped[:,None], starts[order], ends[order])
+        duration = 0
+        r = r_start
+        for i in range(len(order)):
+            duration += get_durations(r, entries[i], speed_line=self.speed_transit, **kwargs)[0,0]
+            duration += get_durations(entries[i], exits[i], speed_line=self.speed_refine, **kwargs)[0,0]
+            r = exits[i]
+        return order, is_flipped, duration
+
+    def plan(self, r_start):
+        """
+        Return (xs, ys, zs, is_refined), the path of the fine sweep from the
+        position r_start. Every segment between two consecutive points is
+        swept; is_refined tells, for each point, if the segment that ends
+        there is a fine line (otherwise it is the travel between two fine
+        lines).
+        """
+        _debug('AdaptiveSweepPlanner: plan')
+
+        r_start = np.array(r_start, dtype=float)
+        candidates = self.get_candidates()
+        xs, ys, zs, is_refined = [], [], [], []
+        self.duration_planned = 0
+        if len(candidates) == 0:
+            return xs, ys, zs, is_refined
+        starts = np.array([c[1] for c in candidates])
+        ends   = np.array([c[2] for c in candidates])
+
+        # The sweep of the lines alone bounds the number of lines that fit
+        kwargs = {'speeds':self.speeds_max, 'acceleration':self.acceleration}
+        sweeps = [get_durations(start, end, speed_line=self.speed_refine, **kwargs)[0,0]
+                  for start, end in zip(starts, ends)]
+        n_max = int(np.searchsorted(np.cumsum(sweeps), self.time_budget_s, side='right'))
+        # Most important lines that fit with the travel, by bisection. Each
+        # try only orders the lines with the nearest neighbour.
+        n_min = 0
+        while n_min < n_max:
+            n = (n_min + n_max + 1)//2
+            duration = self.get_plan_duration(starts[:n], ends[:n], r_start, nb_pass_max=0)[2]
+            if duration <= self.time_budget_s:
+                n_min = n
+            else:
+                n_max = n - 1
+        if n_min == 0:
+            return xs, ys, zs, is_refined
+        starts, ends = starts[:n_min], ends[:n_min]
+        # Then the order is improved once (2-opt)
+        order, is_flipped, self.duration_planned = self.get_plan_duration(starts, ends, r_start)
+        r = r_start
+        for i, flip in zip(order, is_flipped):
+            r_in, r_out = (ends[i], starts[i]) if flip else (starts[i], ends[i])
+            if np.any(r_in != r):
+                xs.append(r_in[0]); ys.append(r_in[1]); zs.append(r_in[2])
+                is_refined.append(False)
+            xs.append(r_out[0]); ys.append(r_out[1]); zs.append(r_out[2])
+            is_refined.append(True)
+            r = r_out
+        return xs, ys, zs, is_refined
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Fake a plane (z fixed) with a narrow dip of the PL along a circle
+    def get_counts(x, y):
+        rate = 100*(1 - 0.3*np.exp(-(np.hypot(x-15, y-15) - 2)**2/(2*0.02**2)))
+        return np.random.poisson(rate)
+
+    # Coarse zigzag, lines along x every 0.5 mm, a point every 10 um
+    planner = AdaptiveSweepPlanner(time_budget_s=600, speed_refine=0.01, speed_transit=1,
+                                   half_width=0.1, spacing=0.1, nb_offsets=2)
+    for i, y in enumerate(np.arange(12, 18.01, 0.5)):
+        x_start, x_end = (12, 18) if i%2 == 0 else (18, 12)
+        xs = np.arange(x_start, x_end, 0.01*np.sign(x_end - x_start))
+        ys = y + 0*xs
+        planner.add_line([x_start, y, 15], [x_end, y, 15], xs, ys, 15+0*xs, get_counts(xs, ys))
+    print('%d features found on the coarse lines'%len(planner.features))
+
+    xs, ys, zs, is_refined = planner.plan([12, 18, 15])
+    print('%d fine lines planned, %.0f s (budget %.0f s)'%(np.sum(is_refined),
+                                                           planner.duration_planned,
+                                                           planner.time_budget_s))
+    # How close to the dip are the fine lines
+    xs, ys = np.array(xs), np.array(ys)
+    distances = np.abs(np.hypot(xs[np.array(is_refined)]-15, ys[np.array(is_refined)]-15) - 2)
+    print('Median distance of the fine line ends to the dip: %.2f mm (half width %.2f)'%(np.median(distances), planner.half_width))
@@ -15,6 +15,8 @@ import spinmob as _s
 from mpl_toolkits.mplot3d import Axes3D # This import registers the 3D projection, but is otherwise unused.
 import matplotlib.pyplot as plt
 
+from sweep_result import databox_to_sweep_result # For many points
+
 import traceback
 _p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
 
@@ -29,19 +31,22 @@ def _debug(*a):
 
 
 def plot_magSweepLinesResult(dataResult, settings=-1, 
-                             title='Patate Chaude', vmin=-1, vmax=-1):
+                             title='Patate Chaude', vmin=-1, vmax=-1,
+                             nb_max_pts=20000):
     """
     Plot the result of a sweep
     
     #TODO EXPLAIN THE INPUT
     
+    nb_max_pts:
+        Maximum number of points to show. If there are more, the points
+        close to each other are averaged (see SweepResult.get_preview).
+
     """
     _debug('plot_magSweepLinesResult')
     
-    xs = dataResult['xs']
-    ys = dataResult['ys']
-    zs = dataResult['zs']   
-    ws = dataResult['ws'] # The color of the point will be that
+    # The color of the point will be ws
+    xs, ys, zs, ws = databox_to_sweep_result(dataResult).get_preview(nb_max_pts)
     dt = dataResult.h('time_per_point') # Counting time (ms)
 
     # Initialize the figure and axis
@@ -100,7 +105,8 @@ def plot_magSweepLinesResult(dataResult, settings=-1,
     ax.set_title(title, fontsize=10)     
 
 def plot_flat_result(dataResult, flat_axes='xy', size_pts=1,
-                     title='Patate Chaude', vmin=-1, vmax=-1):
+                     title='Patate Chaude', vmin=-1, vmax=-1,
+                     nb_max_pts=20000):
     """
     Plot the result of a sweep projected on a 2D plane. 
     
@@ -111,14 +117,18 @@ def plot_flat_result(dataResult, flat_axes='xy', size_pts=1,
         data are shown. 
     size_pts:
         size of the points to show.
+    nb_max_pts:
+        Maximum number of points to show. If there are more, the points
+        close to each other are averaged (see SweepResult.get_preview).
     
     """
     _debug('plot_magSweepLinesResult')
     
-    xs = dataResult['xs']
-    ys = dataResult['ys']
-    zs = dataResult['zs']   
-    ws = dataResult['ws'] # The color of the point will be that
+    preview = databox_to_sweep_result(dataResult).get_preview(nb_max_pts)
+    ws = preview[3] # The color of the point will be that
+    # Coordinates on the plane
+    xs = preview['xyz'.index(flat_axes[0])]
+    ys = preview['xyz'.index(flat_axes[1])]
     dt = dataResult.h('time_per_point') # Counting time (ms)
 
     # Initialize the figure and axis
@@ -148,8 +158,8 @@ def plot_flat_result(dataResult, flat_axes='xy', size_pts=1,
           
         
     plt.legend(loc='lower left')
-    ax.set_xlabel('x (mm)')
-    ax.set_ylabel('y (mm)')
+    ax.set_xlabel(flat_axes[0]+' (mm)')
+    ax.set_ylabel(flat_axes[1]+' (mm)')
 #    # Set equal aspect
 #    # For this we need the extermum of all the pts
 #    allpts = np.concatenate((xs, ys, zs))
@@ -164,6 +174,46 @@ def plot_flat_result(dataResult, flat_axes='xy', size_pts=1,
         t2 = title[int(len(title)/2):]
         title = t1+'\n'+t2
         
+    ax.set_title(title, fontsize=10)
+
+def plot_regrid_result(dataResult, flat_axes='xy', nb_pts=200, kernel='Gaussian',
+                       title='Patate Chaude', vmin=None, vmax=None, **kwargs):
+    """
+    Plot the result of a sweep projected on a 2D plane and interpolated on a
+    regular grid. The pixels without scanned points around are blank.
+
+    dataResult:
+        databox generated by the experiment.
+    flat_axes:
+        (string) either 'xy', 'yz' or 'zx'.
+    nb_pts:
+        Number of pixels on each axis.
+    kernel:
+        'Gaussian' or 'IDW', see SweepResult.interpolate.
+    kwargs:
+        Are sent to SweepResult.regrid (radius, k, power, sigma).
+    """
+    _debug('plot_regrid_result')
+
+    result = databox_to_sweep_result(dataResult)
+    dt = dataResult.h('time_per_point') # Counting time (ms)
+    (x_grid, y_grid), W = result.regrid(nb_pts, axes=flat_axes, kernel=kernel, **kwargs)
+
+    fig = plt.figure(tight_layout=True)
+    ax  = fig.add_subplot(111)
+    myplot = ax.pcolormesh(x_grid, y_grid, W.T/dt, shading='nearest',
+                           vmin=vmin, vmax=vmax)
+    cbar = plt.colorbar(myplot)
+    cbar.set_label("KiloCounts/sec")
+    ax.set_xlabel(flat_axes[0]+' (mm)')
+    ax.set_ylabel(flat_axes[1]+' (mm)')
+    ax.set_aspect('equal')
+    # Slice the title if it's too long (for example, by including the whol path)
+    if len(title)>20:
+        t1 = title[:int(len(title)/2)]
+        t2 = title[int(len(title)/2):]
+        title = t1+'\n'+t2
+        
     ax.set_title(title, fontsize=10)   
     
     
@@ -23,6 +23,9 @@ ATTEMP to use the class CONEX inside the mcphysics GUI.
 #import time
 import mcphysics   as _mp
 import time
+import numpy as np
+
+from trajectory_model import trapezoid_distance, trapezoid_profile # For the motion of the fake actuator
 
 import traceback
 _p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
@@ -38,6 +41,16 @@ def _debug(*a):
         for x in a: s.append(str(x))
         print(', '.join(s))
 
+# Meaning of the state code returned by the command 'TS' (p.50 of the
+# controller documentation)
+_conex_states = {'33':'READY from MOVING',
+                 '32':'READY from HOMING',
+                 '28':'MOVING',
+                 '1E':'HOMING',
+                 '0A':'NOT REFERENCED from RESET',
+                 '3C':'DISABLE from READY.',
+                 '0E':'NOT REFERENCED from READY.'}
+
 
         
 class ApiActuator(_mp.visa_tools.visa_api_base):
@@ -55,6 +68,13 @@ class ApiActuator(_mp.visa_tools.visa_api_base):
         # Run the core setup.
         _mp.visa_tools.visa_api_base.__init__(self, name, pyvisa_py, simulation, timeout=timeout, write_sleep=write_sleep, **kwargs)
         
+        if simulation:
+            # No controller: talk to a fake one. 
+            # Its behavior is set by the dictionary simulation_settings
+            self._api = CONEX_fake_api(**simulation_settings)
+            self.apiTest = self._api
+            return
+        
         #Inherit the functionality
         self._api = CONEX_api()
         self.apiTest = CONEX_api()
@@ -91,12 +111,31 @@ class ApiActuator(_mp.visa_tools.visa_api_base):
         """
         return self._api.set_position_abs(r)
     
+    def move_to(self, r, v):
+        """
+        Set the velocity v and move at the position r (in mm), in one batch.
+        """
+        return self._api.move_to(r, v)
+
     def get_position(self):
         """
         Get the actuator position (in mm). 
         """
         return self._api.get_position()
 
+    def get_position_and_state(self):
+        """
+        Return (position, state) with a single round trip.
+        """
+        return self._api.get_position_and_state()
+
+    def invalidate_limits(self):
+        """
+        Forget the limits kept in memory. They will be asked again at the
+        next motion.
+        """
+        return self._api.invalidate_limits()
+
     def set_velocity(self, v):
         """
         Set the velocity of the actuator when they move. 
@@ -135,6 +174,15 @@ class CONEX_api(_mp.visa_tools.visa_api_base):
 #        
 #        #Set the COMPort
 #        self.COMPort = COMPort
+
+        # Limits (lower, upper) kept in memory, for not asking them before
+        # each motion. None when they must be asked again.
+        self.limits = None
+        # If True, write_batch and get_position_and_state send their commands
+        # back to back, without the _write_sleep between them. Off because it
+        # is not checked yet on the controller that no command is lost at
+        # its communication rate (about 50 Hz).
+        self.pipelining = False
         return
         
     def reset(self):
@@ -146,6 +194,7 @@ class CONEX_api(_mp.visa_tools.visa_api_base):
         """
         _debug('CONEX_api.reset(self)')
         
+        self.invalidate_limits()
         self.write('1RS') #Reset, equivalent to a power-up. The state should end up in NOT REFERENCED
         #Delay a little bit before the next command. 
         time.sleep(0.500) #500ms The communication rate is about 50Hz, so 20ms. 
@@ -161,23 +210,30 @@ class CONEX_api(_mp.visa_tools.visa_api_base):
         
         # For knowing the meaning of the returned string, look at p.50 of the 
         # controller documentation. 
-        strState = self.query('1TS?)')[7:9] #This extract a number corresponding to the state. 
-        if strState == '33':
-            return 'READY from MOVING'
-        elif strState == '32':
-            return 'READY from HOMING'
-        elif strState == '28':
-            return 'MOVING'
-        elif strState == '1E':
-            return 'HOMING'
-        elif strState == '0A':
-            return 'NOT REFERENCED from RESET'
-        elif strState == '3C':
-            return 'DISABLE from READY.'     
-        elif strState == '0E':
-            return 'NOT REFERENCED from READY.'    
-        else:
-            return strState #Return the number that we can looking in the manual under the description of the command 'TS'
+        strState = self.query('1TS?')[7:9] #This extract a number corresponding to the state.
+        #Return the number that we can looking in the manual under the description of the command 'TS' if it is not known
+        return _conex_states.get(strState, strState)
+
+    def get_position_and_state(self):
+        """
+        Return (position, state), where the position is in mm and the state
+        is the same string as get_state().
+
+        With pipelining on, the two queries are sent before reading the
+        answers, such that we wait for the controller only once instead of
+        twice. Otherwise they are sent one after the other.
+        """
+        _debug('CONEX_api.get_position_and_state()')
+
+        if not(self.pipelining) or getattr(self, 'instrument', None) is None:
+            # One after the other, with the usual pause after each write
+            return self.get_position(), self.get_state()
+
+        self.instrument.write('1TP?')
+        self.instrument.write('1TS?')
+        strPos   = self.instrument.read()
+        strState = self.instrument.read()[7:9]
+        return float(strPos[3:]), _conex_states.get(strState, strState)
     
     def get_COMPort(self):
         """
@@ -200,6 +256,38 @@ class CONEX_api(_mp.visa_tools.visa_api_base):
         strHigh = self.query('1SL?') #Get the string of upper limit
         return float(strHigh[3:]) #Convert into a float 
     
+    def get_limits(self):
+        """
+        Return (lower limit, upper limit) of the actuator position. They are
+        asked to the controller only the first time, or after
+        invalidate_limits().
+        """
+        if self.limits is None:
+            self.limits = (self.get_lowLimit(), self.get_upLimit())
+        return self.limits
+
+    def invalidate_limits(self):
+        """
+        Forget the limits kept in memory. Call it if the limits are changed
+        on the controller.
+        """
+        _debug('CONEX_api.invalidate_limits()')
+        self.limits = None
+
+    def is_within_limits(self, r):
+        """
+        Return True if the position r is within the limits. Print an error
+        otherwise.
+        """
+        lowLimit, upLimit = self.get_limits()
+        if r > upLimit:
+            print('ERROR: set_posistion_abs() r above the upper limit!')
+            return False
+        if r < lowLimit:
+            print('ERROR: set_posistion_abs() r below the lower limit!')
+            return False
+        return True
+
     def set_position_abs(self, r):
         """
         Move the actuator at a position r (in mm). 
@@ -208,14 +296,37 @@ class CONEX_api(_mp.visa_tools.visa_api_base):
         _debug('CONEX_api.set_position_abs(self, r) r = '+str(r))
         
         #Return and send an error if the position is outside of the limit
-        if r > self.get_upLimit():
-            print('ERROR: set_posistion_abs() r above the upper limit!')
-            return
-        if r < self.get_lowLimit():
-            print('ERROR: set_posistion_abs() r below the lower limit!')
+        if not self.is_within_limits(r):
             return
         #Send the command to move at position r
         self.write('1PA'+str(r))
+
+    def move_to(self, r, v):
+        """
+        Set the velocity v and move at the position r (in mm).
+        Both commands are sent in the same batch.
+        """
+        _debug('CONEX_api.move_to(self, r, v)', r, v)
+
+        if not self.is_within_limits(r):
+            return
+        self.write_batch(['1VA' + str(v), '1PA'+str(r)])
+
+    def write_batch(self, commands):
+        """
+        Send many commands that don't have an answer (like '1VA', '1PA'),
+        one after the other. With pipelining on, we don't wait between them,
+        only once after the last one.
+        """
+        _debug('CONEX_api.write_batch()', commands)
+
+        if not(self.pipelining) or getattr(self, 'instrument', None) is None:
+            for command in commands:
+                self.write(command)
+            return
+        for command in commands:
+            self.instrument.write(command)
+        time.sleep(self._write_sleep)
         
     def get_position(self):
         """
@@ -257,6 +368,228 @@ class CONEX_api(_mp.visa_tools.visa_api_base):
 
 
 
+# Settings of the fake CONEX created by ApiActuator in simulation mode. 
+# Change them before to connect, for example for an accelerated time. 
+simulation_settings = {'time_scale'  :1,
+                       'latency_s'   :0.02,
+                       'speed_max'   :2,
+                       'acceleration':10,
+                       'lower_limit' :0,
+                       'upper_limit' :25}
+
+class CONEX_fake_api(CONEX_api):
+    """
+    Fake CONEX controller, for testing the GUIs without the actuators. 
+    
+    It has the same methods as CONEX_api, because it only replaces the 
+    communication (write and query). The commands used by CONEX_api are 
+    understood: 1TP?, 1TS?, 1PA, 1VA, 1SL?, 1SR?, 1ST, 1RS, 1OR, 1VE?
+    With pipelining on, a batch of commands (write_batch, 
+    get_position_and_state) pays the latency only once, like on the real 
+    port. 
+    
+    The actuator moves with a trapezoidal speed profile. Its state follows the 
+    one of the real controller: NOT REFERENCED after a reset, HOMING when 
+    going toward the ready state, MOVING and READY.
+    Nothing runs in the background: the position and the state are computed 
+    from the time at each query. 
+    """
+    def __init__(self, time_scale=1, latency_s=0.02, speed_max=2, 
+                 acceleration=10, lower_limit=0, upper_limit=25, 
+                 position=12.5, speed_homing=2):
+        """
+        time_scale:
+            Speed of the simulated time, relative to the real time. For 
+            example, 10 makes the motions 10 times faster. 
+        latency_s:
+            Real time (in s) waited at each write and query, like the serial 
+            communication. 
+        speed_max:
+            Maximum speed (mm/s). Faster speeds are clipped. 
+        acceleration:
+            Acceleration (mm/s^2)
+        lower_limit, upper_limit:
+            Travel limits (mm)
+        position:
+            Initial position (mm)
+        speed_homing:
+            Speed when going back to zero during the homing (mm/s)
+        """
+        _debug('CONEX_fake_api._init__()')
+        _debug('Believe you can and you’re halfway there. – Theodore Roosevelt')
+
+        CONEX_api.__init__(self)
+        
+        self.time_scale   = time_scale
+        self.latency_s    = latency_s
+        self.speed_max    = speed_max
+        self.acceleration = acceleration
+        self.lower_limit  = lower_limit
+        self.upper_limit  = upper_limit
+        self.speed_homing = speed_homing
+        
+        self.t_zero = time.time()
+        self.speed  = speed_max
+        self.error_code = '0000'
+        # The motion: go from r_start to r_end, starting at t_start
+        self.r_start = position
+        self.r_end   = position
+        self.t_start = 0
+        self.speed_motion = speed_max
+        self.state = '0A' # NOT REFERENCED from RESET
+        
+    def get_time(self):
+        """
+        Return the simulated time (s). 
+        """
+        return self.time_scale*(time.time() - self.t_zero)
+        
+    def get_motion_duration(self):
+        """
+        Return the duration of the actual motion (s, simulated time). 
+        """
+        distance = abs(self.r_end - self.r_start)
+        if distance == 0:
+            return 0
+        t_acc, t_cruise, _ = trapezoid_profile(distance, self.speed_motion, self.acceleration)
+        return 2*t_acc + t_cruise
+        
+    def get_simulated_position(self, t):
+        """
+        Return the position at the simulated time t. 
+        """
+        distance = abs(self.r_end - self.r_start)
+        d = trapezoid_distance([t - self.t_start], distance, self.speed_motion, 
+                               self.acceleration)[0]
+        return self.r_start + np.sign(self.r_end - self.r_start)*d
+        
+    def update_state(self):
+        """
+        Update the state if the motion is finished. 
+        """
+        t = self.get_time()
+        if self.state in ['28', '1E'] and t - self.t_start >= self.get_motion_duration():
+            # Arrived
+            self.r_start = self.r_end
+            self.state = '33' if self.state == '28' else '32'
+        
+    def start_motion(self, r, speed, state):
+        """
+        Start a motion from the actual position toward r. 
+        """
+        t = self.get_time()
+        self.r_start = self.get_simulated_position(t)
+        self.r_end   = r
+        self.t_start = t
+        self.speed_motion = speed
+        self.state = state
+        
+    def write(self, command):
+        """
+        Send a command to the fake controller. 
+        """
+        _debug('CONEX_fake_api.write()', command)
+        
+        time.sleep(self.latency_s)
+        self.execute(command)
+
+    def write_batch(self, commands):
+        """
+        Send many commands, with the latency only once if pipelining is on.
+        """
+        _debug('CONEX_fake_api.write_batch()', commands)
+
+        if not(self.pipelining):
+            return CONEX_api.write_batch(self, commands)
+        time.sleep(self.latency_s)
+        for command in commands:
+            self.execute(command)
+
+    def get_position_and_state(self):
+        """
+        Return (position, state), with the latency only once if pipelining is
+        on.
+        """
+        _debug('CONEX_fake_api.get_position_and_state()')
+
+        if not(self.pipelining):
+            return CONEX_api.get_position_and_state(self)
+        time.sleep(self.latency_s)
+        strPos   = self.answer('1TP?')
+        strState = self.answer('1TS?')[7:9]
+        return float(strPos[3:]), _conex_states.get(strState, strState)
+
+    def execute(self, command):
+        """
+        Execute a command without answer.
+        """
+        self.update_state()
+        command = command.strip()
+        name, argument = command[1:3], command[3:]
+        
+        if name == 'PA':
+            r = float(argument)
+            if not(self.state in ['32', '33']):
+                self.error_code = '0000'
+                print('Warning: CONEX_fake_api: the actuator is not ready (state %s)'%self.state)
+                return
+            if r < self.lower_limit or r > self.upper_limit:
+                self.error_code = '0001'
+                return
+            self.start_motion(r, self.speed, '28')
+        elif name == 'VA':
+            # The controller clips the speed to its maximum
+            self.speed = min(abs(float(argument)), self.speed_max)
+        elif name == 'ST':
+            # Stop here (after the deceleration, ignored)
+            r = self.get_simulated_position(self.get_time())
+            self.r_start = r
+            self.r_end   = r
+            self.state = '33' if self.state == '28' else self.state
+        elif name == 'RS':
+            # Power-up. The position is lost until the homing
+            self.r_end = self.get_simulated_position(self.get_time())
+            self.r_start = self.r_end
+            self.state = '0A'
+        elif name == 'OR':
+            if self.state in ['0A', '0E']:
+                # Homing: go to zero
+                self.start_motion(self.lower_limit, self.speed_homing, '1E')
+        else:
+            print('Warning: CONEX_fake_api: unknown command '+command)
+        
+    def query(self, command):
+        """
+        Send a command to the fake controller and return its answer. 
+        """
+        _debug('CONEX_fake_api.query()', command)
+        
+        time.sleep(self.latency_s)
+        return self.answer(command)
+
+    def answer(self, command):
+        """
+        Return the answer to a query.
+        """
+        self.update_state()
+        name = command.strip()[1:3]
+        
+        if name == 'TP':
+            return '1TP%.6f'%self.get_simulated_position(self.get_time())
+        elif name == 'TS':
+            return '1TS' + self.error_code + self.state
+        elif name == 'SL':
+            return '1SL%g'%self.lower_limit
+        elif name == 'SR':
+            return '1SR%g'%self.upper_limit
+        elif name == 'VE':
+            return '1VE CONEX-CC fake'
+        else:
+            print('Warning: CONEX_fake_api: unknown query '+command)
+            return '1'+name+'0'
+        
+        
+
 #By default set the object
 if __name__ == '__main__':
 #    cc = ApiActuator().
@@ -10,6 +10,8 @@ API for controlling the fpga
 
 from nifpga.session import Session
 import numpy as np
+import threading
+import functools
 
 import traceback
 _p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
@@ -23,6 +25,19 @@ def _debug(*a):
         for x in a: s.append(str(x))
         print(', '.join(s))
 
+def _locked(method):
+    """
+    Decorator for the methods of the fpga api: the method holds the lock of
+    the api, such that a single thread drives the fpga at a time (the scan of
+    gui_confocal_map runs in a worker thread while the other GUIs still
+    respond).
+    """
+    @functools.wraps(method)
+    def locked_method(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return locked_method
+
         
 class FPGA_api():
     """
@@ -49,6 +64,10 @@ class FPGA_api():
         _debug('FPGA_api:__init__')
         _debug('We can see through others only when we can see through ourselves. – Bruce Lee')
         
+        # Hold it to do several steps without an other thread in between, 
+        # like prepare_AOs, run_pulse and get_counts for one pixel
+        self.lock = threading.RLock()
+        
         self.bitfile_path = bitfile_path
         self.resource_num = resource_num
         
@@ -60,6 +79,7 @@ class FPGA_api():
         self.bit_per_volt = 3276.8 
         
         
+    @_locked
     def open_session(self):
         """
         Open a session nifpga
@@ -93,6 +113,7 @@ class FPGA_api():
         _debug(self._fpga.registers.keys())
         
        
+    @_locked
     def close_session(self):
         """
         Close a session nifpga
@@ -126,6 +147,7 @@ class FPGA_api():
         # something like that, due to two's compliments bit representation.
         return int(round(voltage * self.bit_per_volt))   
     
+    @_locked
     def prepare_AOs(self, AO_list, voltage_list):
         """
         Prepare the AOs for a specific voltage. 
@@ -153,6 +175,7 @@ class FPGA_api():
             bits = self.v_to_bits(voltage_list[i])
             self._fpga.registers['AO%d'%AO].write(bits)
 
+    @_locked
     def prepare_DIOs(self, DIO_list, state_list):
         """
         Prepare the DIOs to a specific state
@@ -191,6 +214,7 @@ class FPGA_api():
         
         _debug('ht_fifo datatype: ', self.ht_fifo.datatype)    
                 
+    @_locked
     def prepare_wait_time(self, wait_time_us):
         """
         Set the wait time after the AOs are set. 
@@ -208,6 +232,7 @@ class FPGA_api():
             
         
         
+    @_locked
     def set_counting_mode(self, boolean):
         """
         Set the counting mode. 
@@ -221,6 +246,7 @@ class FPGA_api():
         self.counting_mode.write(boolean)
         
         
+    @_locked
     def write_output(self):
         """
         WARNING: 
@@ -262,6 +288,7 @@ class FPGA_api():
         bits = self._fpga.registers['AO%d'%AO].read()
         return bits/self.bit_per_volt        
 
+    @_locked
     def read_AI1(self):
         """
         Read the value of AI1. 
@@ -272,6 +299,7 @@ class FPGA_api():
         self.ai = self._fpga.registers['AI1']
         return self.ai.read()
 
+    @_locked
     def get_A1_voltage(self):
         """
         Read the A1 and return the corresponding voltage. 
@@ -282,6 +310,7 @@ class FPGA_api():
         return reading/self.bit_per_volt
         
     
+    @_locked
     def get_counts(self):
         """
         Return the whole count array, in the form of numpy array
@@ -289,6 +318,7 @@ class FPGA_api():
         _debug('FPGA_api: get_counts')
         return np.array(self.counts) 
 
+    @_locked
     def get_DIO_states(self):
         """
         Return the DIO state 
@@ -296,6 +326,7 @@ class FPGA_api():
         _debug('FPGA_api: get_DIO_states')
         return self.list_DIO_states
     
+    @_locked
     def get_AO_voltage(self, AO):
         """
         Get the voltage that a AO outputs.
@@ -316,6 +347,7 @@ class FPGA_api():
         volt = bits/self.bit_per_volt    
         return  volt
     
+    @_locked
     def get_wait_time_us(self):
         """
         Return the waiting time
@@ -323,6 +355,7 @@ class FPGA_api():
         _debug('FPGA_api: get_wait_time_us')
         return self.wait.read()
     
+    @_locked
     def get_data_array(self):
         """
         Return the data array that the fpga has. 
@@ -330,6 +363,7 @@ class FPGA_api():
         _debug('FPGA_api: get_data_array')
         return self.data
     
+    @_locked
     def configure_fifo(self):
         """
         Configutre the fifo for the data array
@@ -345,6 +379,7 @@ class FPGA_api():
         self.ht_fifo.stop()
         self.th_fifo.stop()        
     
+    @_locked
     def prepare_pulse(self, data_array, is_zero_ending=True, list_DIO_state=[] ):
         """
         Prepare the data array for the pulse pattern in the fpga. 
@@ -381,6 +416,7 @@ class FPGA_api():
         _debug('ht_fifo datatype: ', self.ht_fifo.datatype)      
         
       
+    @_locked
     def lets_go_FPGA(self):
         """
         Ultimate function for running the FPGA. 
@@ -413,6 +449,7 @@ class FPGA_api():
         self.run_pulse()
         
         
+    @_locked
     def run_pulse(self):
         """
         Start the FPGA for when there is a pulse sequence. 
@@ -460,6 +497,7 @@ class FPGA_api():
             # Get the mean only if the array is not empty.
             _debug("Mean counts = ", np.mean(self.counts))
                      
+    @_locked
     def run_pulse_loop(self, data_array, N_loopFPGA):
         """
         Loop over the fpga instructions. This is a example of what can be done 
@@ -481,6 +519,34 @@ class FPGA_api():
             _debug('FPGA loop ', i+1, ' over ', N_loopFPGA)
             self.run_instruction()
                 
+# Model of the counts for FPGA_fake_api, when a simulated signal generator is
+# attached to it (see FPGA_fake_api.set_signal_generator)
+simulation_settings = {'rate_cps'        :100e3, # Counts per second without RF
+                       'contrast'        :0.2, # Maximum relative dip of the counts
+                       'f_resonances_Hz' :[2.82e9, 2.92e9],
+                       'linewidth_Hz'    :5e6, # Full width at half maximum
+                       'P_saturation_dBm':-10} # Power for half the contrast
+
+def get_rate_ESR(fs, Ps_dBm, is_on, rate_cps=100e3, contrast=0.2,
+                 f_resonances_Hz=[2.82e9, 2.92e9], linewidth_Hz=5e6,
+                 P_saturation_dBm=-10):
+    """
+    Return the count rate (counts/sec) of a NV under the RF of frequencies fs
+    (Hz) and powers Ps_dBm: a lorentzian dip at each resonance, deeper with
+    the power up to the contrast.
+
+    is_on:
+        False if the RF output is off (no dip).
+    """
+    fs = np.asarray(fs, dtype=float)
+    saturation = 10**((np.asarray(Ps_dBm, dtype=float) - P_saturation_dBm)/10)
+    dip = 0
+    for f0 in f_resonances_Hz:
+        dip = dip + 1/(1 + (2*(fs - f0)/linewidth_Hz)**2)
+    depth = is_on*contrast*saturation/(1 + saturation)
+    return rate_cps*(1 - depth*np.minimum(dip, 1))
+
+
 class FPGA_fake_api():
     """
     Fake api for the fpga. 
@@ -504,6 +570,10 @@ class FPGA_fake_api():
         _debug('FPGA_fake_api:__init__')
         _debug('The secret of getting ahead is getting started. – Mark Twain.')
         
+        # Hold it to do several steps without an other thread in between, 
+        # like prepare_AOs, run_pulse and get_counts for one pixel
+        self.lock = threading.RLock()
+        
         self.bitfile_path = bitfile_path
         self.resource_num = resource_num
         
@@ -514,7 +584,70 @@ class FPGA_fake_api():
         # Magic number for converting voltage into bits for the AOs
         self.bit_per_volt = 3276.8 
         
+        self.counting_mode = False
+        self.tickDuration = 1/120 # us, like the converter
+        # Simulated signal generator, for the counts to depend on the RF
+        self.signal_generator = None
+
+
+    def set_signal_generator(self, signal_generator, DIO_trigger=7, DIO_count=1):
+        """
+        Attach a simulated signal generator (the scpi_simulator of
+        gui_signal_generator.py, which is the instrument of
+        signal_generator_api in simulation mode).
+        The counts of run_pulse then follow the model get_rate_ESR (with the
+        dictionary simulation_settings) at the RF of the signal generator,
+        and each rising edge of DIO_trigger steps its list, like the
+        external trigger.
+        GuiMainPulseSequence (gui_pulser.py) attaches its signal generator
+        before each run when both are simulated, otherwise call it with
+        signal_generator_api(simulation=True).instrument.
+
+        DIO_count:
+            DIO during which the counts are taken.
+        """
+        _debug('FPGA_fake_api: set_signal_generator')
+
+        self.signal_generator = signal_generator
+        self.DIO_trigger = DIO_trigger
+        self.DIO_count   = DIO_count
+
+    def simulate_counts(self):
+        """
+        Return the counts for the data array, one for each time that DIO_count
+        is ON (like the FPGA when it does not count each tick), from the rate
+        at the RF of the signal generator during each count.
+
+        The RF of each instruction is the list point after all the triggers
+        up to that instruction: a count after one trigger reads the list
+        point 1, and a trigger during a count changes the RF for the rest of
+        the count.
+        """
+        _debug('FPGA_fake_api: simulate_counts')
+
+        # Decode all the instructions at once: 16 bits of ticks, 16 DIOs
+        data = np.asarray(self.data).astype(np.int64) & 0xFFFFFFFF
+        ticks = data & 0xFFFF
+        is_counting = (data >> (16 + self.DIO_count  )) & 1
+        is_trigger  = (data >> (16 + self.DIO_trigger)) & 1
+        # Number of triggers (rising edges) up to each instruction
+        nb_triggers = np.cumsum(np.diff(np.concatenate([[0], is_trigger])) == 1)
+        # Start of each count
+        starts = np.where(np.diff(np.concatenate([[0], is_counting])) == 1)[0]
+        if len(starts) == 0:
+            counts = np.zeros(0, dtype=int)
+        else:
+            # Mean counts during each instruction, summed over each count
+            fs, Ps, is_on = self.signal_generator.get_rf(nb_triggers)
+            rates = get_rate_ESR(fs, Ps, is_on, **simulation_settings)
+            means = rates*ticks*self.tickDuration*1e-6*is_counting
+            counts = np.random.poisson(np.add.reduceat(means, starts))
+        # The generator is where the sequence left it
+        if len(nb_triggers) > 0:
+            self.signal_generator.trigger(nb_triggers[-1])
+        return counts
         
+    @_locked
     def open_session(self):
         """
         Open a session nifpga
@@ -529,6 +662,7 @@ class FPGA_fake_api():
         self.prepare_wait_time(1)
         
        
+    @_locked
     def close_session(self):
         """
         Close a session nifpga
@@ -548,6 +682,7 @@ class FPGA_fake_api():
         # something like that, due to two's compliments bit representation.
         return int(round(voltage * self.bit_per_volt))   
     
+    @_locked
     def prepare_AOs(self, AO_list, voltage_list):
         """
         Prepare the AOs for a specific voltage. 
@@ -566,6 +701,7 @@ class FPGA_fake_api():
         self.list_AO_states[AO_list] = voltage_list
         
         
+    @_locked
     def prepare_DIOs(self, DIO_list, state_list):
         """
         Prepare the DIOs to a specific state
@@ -594,6 +730,7 @@ class FPGA_fake_api():
         
            
                 
+    @_locked
     def prepare_wait_time(self, wait_time_us):
         """
         Set the wait time after the AOs are set. 
@@ -604,6 +741,7 @@ class FPGA_fake_api():
         _debug('FPGA_fake_api: prepare_wait_time')
         self.wait_time_us = wait_time_us
 
+    @_locked
     def set_counting_mode(self, boolean):
         """
         Set the counting mode. 
@@ -616,6 +754,7 @@ class FPGA_fake_api():
         _debug('FPGA_api: set_counting_mode')
         self.counting_mode = boolean
         
+    @_locked
     def write_output(self):
         """
         Write the AOs and the DIOs in the fpga. 
@@ -628,6 +767,7 @@ class FPGA_fake_api():
         _debug('FPGA_fake_api: write_output')
         return 
 
+    @_locked
     def read_AI1(self):
         """
         Read the value of AI1. 
@@ -638,6 +778,7 @@ class FPGA_fake_api():
         
         return np.random.poisson(100)/100
 
+    @_locked
     def get_A1_voltage(self):
         """
         Read the A1 and return the corresponding voltage. 
@@ -647,6 +788,7 @@ class FPGA_fake_api():
         return np.random.poisson(2000)/1000
         
     
+    @_locked
     def get_counts(self):
         """
         Return the whole count array, in the form of numpy array
@@ -654,6 +796,7 @@ class FPGA_fake_api():
         _debug('FPGA_fake_api: get_counts')
         return np.array(self.counts) 
 
+    @_locked
     def get_DIO_states(self):
         """
         Return the DIO state 
@@ -661,6 +804,7 @@ class FPGA_fake_api():
         _debug('FPGA_fake_api: get_DIO_states')
         return self.list_DIO_states
     
+    @_locked
     def get_AO_voltage(self, AO):
         """
         Get the voltage that a AO outputs.
@@ -672,6 +816,7 @@ class FPGA_fake_api():
         
         return AO*np.random(1000)/1000
     
+    @_locked
     def get_wait_time_us(self):
         """
         Return the waiting time
@@ -680,6 +825,7 @@ class FPGA_fake_api():
         
         return self.wait_time_us
     
+    @_locked
     def get_data_array(self):
         """
         Return the data array that the fpga has. 
@@ -687,6 +833,7 @@ class FPGA_fake_api():
         _debug('FPGA_fake_api: get_data_array')
         return self.data
     
+    @_locked
     def prepare_pulse(self, data_array, is_zero_ending=True, list_DIO_state=[] ):
         """
         Prepare the data array for the pulse pattern in the fpga. 
@@ -717,6 +864,7 @@ class FPGA_fake_api():
             self.list_DIO_states = list_DIO_state 
         
       
+    @_locked
     def run_pulse(self):
         """
         Start the FPGA for when there is a pulse sequence. 
@@ -727,12 +875,16 @@ class FPGA_fake_api():
         """
         _debug('FPGA_fake_api: run_pulse')
         
-        
-        self.counts = [[np.random.poisson(50)/50]] 
+        if self.signal_generator is None or self.counting_mode:
+            # No model (and the count each tick mode is not simulated)
+            self.counts = [[np.random.poisson(50)/50]]
+        else:
+            self.counts = self.simulate_counts()
         if len(self.counts)>0: 
             # Get the mean only if the array is not empty.
             _debug("Mean counts = ", np.mean(self.counts))
                      
+    @_locked
     def run_pulse_loop(self, data_array, N_loopFPGA):
         """
         Loop over the fpga instructions. This is a example of what can be done 
@@ -0,0 +1,332 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Thu Oct 22 10:27:53 2026
+
+Goal: Bayes inference of the rates gamma+ and gamma- (and possibly other
+parameters, like PL0 and the contrast) with particles instead of a grid.
+
+The posterior is a cloud of weighted particles (sequential Monte Carlo):
+    - Each measurement multiplies the weights by its like-lihood, the same as
+      for the grid of Bayes3Measure (see protocol_bayes.likelihood_3measure).
+      Everything is done with the logarithm of the weights, so nothing
+      overflows or underflows.
+    - When too few particles carry the weight (small effective sample size),
+      the particles are resampled with the Liu-West moves: each new particle
+      is drawn around a chosen particle, shrunk toward the mean, with a
+      gaussian kick. This keeps the mean and the covariance of the cloud.
+The memory and the time scale with the number of particles, not with the size
+of a grid, and the particles follow the posterior when it narrows.
+
+@author: Childresslab
+"""
+
+import numpy as np
+
+from protocol_bayes import likelihood_3measure # Same like-lihood as for the grid
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+class Bayes3MeasureParticles():
+    """
+    Bayes inference for 3 measure, with particles.
+
+    This is how it should be used, like Bayes3Measure:
+
+        - Initiate it with the model functions.
+        - Initialize it with the prior (on a grid, or directly particles).
+        - Add measurement for updating the posterior. This can be done many
+          time.
+        - Get the mean and the covariance, or the posterior on a grid.
+    """
+    def __init__(self, model_functions, nb_particles=2000, a=0.98,
+                 ess_threshold=0.5, seed=None):
+        """
+        model_functions = [f0, fp, fm]
+
+        f0,fp,fm:
+            Function with signature (t,Gp,Gm) which gonna define the PL for the
+            three type of measurement. If the particles have more parameters,
+            they are all given: (t,Gp,Gm,...).
+        nb_particles:
+            Number of particles drawn from the prior.
+        a:
+            Parameter of the Liu-West moves, between 0 and 1. The new
+            particles are shrunk by a toward the mean and kicked with a
+            covariance (1-a^2) times the covariance of the cloud. Closer to 1
+            gives smaller moves.
+        ess_threshold:
+            The particles are resampled when the effective sample size is
+            below this fraction of the number of particles.
+        seed:
+            Seed of the random generator, for reproducible runs.
+        """
+        _debug('Bayes3MeasureParticles: __init__')
+        _debug('Many drops make a shower. – Proverb')
+
+        self.model_functions = model_functions
+        self.f0 = model_functions[0]
+        self.fp = model_functions[1]
+        self.fm = model_functions[2]
+
+        self.nb_particles  = nb_particles
+        self.a             = a
+        self.ess_threshold = ess_threshold
+        self.random        = np.random.RandomState(seed)
+
+        self.nb_resampling = 0 # Number of resampling done so far
+
+    def initialize(self, gp_axis, gm_axis, prior):
+        """
+        Draw the particles from the prior defined on a grid, like for
+        Bayes3Measure. Each particle is uniform in the cell of the grid
+        around its point.
+
+        gp_axis:
+            1D array of the axis for gamma+
+        gm_axis:
+            1D array of the axis for gamma-
+        prior:
+            2D array of the prior probability density, of shape
+            (len(gm_axis), len(gp_axis)). No need to be normalized.
+        """
+        _debug('Bayes3MeasureParticles: initialize')
+
+        # Kept for showing the posterior on the same grid
+        self.gp_axis = np.asarray(gp_axis, dtype=float)
+        self.gm_axis = np.asarray(gm_axis, dtype=float)
+
+        # Probability of each cell
+        edges_p = self.get_edges(self.gp_axis)
+        edges_m = self.get_edges(self.gm_axis)
+        P = np.asarray(prior, dtype=float)*np.outer(np.diff(edges_m), np.diff(edges_p))
+        P = P.ravel()/np.sum(P)
+        cells = self.random.choice(len(P), size=self.nb_particles, p=P)
+        i, j = np.unravel_index(cells, (len(self.gm_axis), len(self.gp_axis)))
+        Gp = self.random.uniform(edges_p[j], edges_p[j+1])
+        Gm = self.random.uniform(edges_m[i], edges_m[i+1])
+
+        self.initialize_particles(np.column_stack([Gp, Gm]))
+
+    def initialize_particles(self, particles, weights=None):
+        """
+        Start from the given particles.
+
+        particles:
+            2D array of shape (number of particles, number of parameters).
+            The first two parameters are gamma+ and gamma-, the others are
+            given as well to the model functions.
+        weights:
+            Weight of each particle. None for equal weights.
+        """
+        _debug('Bayes3MeasureParticles: initialize_particles')
+
+        self.particles = np.array(particles, dtype=float)
+        self.nb_particles = len(self.particles)
+        if weights is None:
+            self.log_weights = np.zeros(self.nb_particles)
+        else:
+            with np.errstate(divide='ignore'):
+                self.log_weights = np.log(np.asarray(weights, dtype=float))
+        self.update_weights()
+        self.process_post()
+
+    def get_edges(self, axis):
+        """
+        Return the edges of the cells around each point of the axis (the
+        middles between the points, and the extremities).
+        """
+        middles = 0.5*(axis[1:] + axis[:-1])
+        return np.concatenate([[axis[0]], middles, [axis[-1]]])
+
+    def update_weights(self):
+        """
+        Normalize the weights from their logarithm.
+        """
+        self.log_weights -= np.max(self.log_weights)
+        self.weights = np.exp(self.log_weights)
+        self.weights /= np.sum(self.weights)
+
+    def get_ess(self):
+        """
+        Return the effective sample size, between 1 and the number of
+        particles.
+        """
+        return 1/np.sum(self.weights**2)
+
+    def add_measurement(self, t_probe, nb_readout, diff_p, diff_m):
+        """
+        Add a measurement for updating the weights, and resample if needed.
+
+        t_probe:
+            (float) Time at which the measurment is done.
+        nb_readout:
+            (float) Number of readout performed on each state. This will be used
+            for computing the expectation.
+        diff_p:
+            Measured TOTAL difference between the counts of the f0 and fp
+            measurements. Without noise, it would be expected to be equal to
+            nb_readout*(f0-fp).
+        diff_m:
+            Measured TOTAL difference between the counts of the f0 and fm
+            measurements. Without noise, it would be expected to be equal to
+            nb_readout*(f0-fm).
+        """
+        _debug('Bayes3MeasureParticles: add_measurement')
+
+        # Like-lihood of this measurement for each particle
+        parameters = self.particles.T
+        exp_0 = self.f0(t_probe, *parameters)*nb_readout
+        exp_p = self.fp(t_probe, *parameters)*nb_readout
+        exp_m = self.fm(t_probe, *parameters)*nb_readout
+        with np.errstate(all='ignore'):
+            L = likelihood_3measure(exp_0, exp_p, exp_m, diff_p, diff_m)
+        # The particles for which the model doesn't make sense are impossible
+        L[np.isnan(L)] = np.inf
+
+        log_weights = self.log_weights - L
+        if not(np.any(np.isfinite(log_weights))):
+            print('Warning: Bayes3MeasureParticles: the measurement is impossible for all the particles. It is ignored.')
+            return
+        self.log_weights = log_weights
+        self.update_weights()
+
+        if self.get_ess() < self.ess_threshold*self.nb_particles:
+            self.resample()
+        self.process_post()
+
+    def resample(self):
+        """
+        Draw new particles from the current ones with the Liu-West moves.
+        The new particles have equal weights.
+        """
+        _debug('Bayes3MeasureParticles: resample')
+
+        N = self.nb_particles
+        mean = self.get_mean()
+        cov  = self.get_covariance()
+        # Systematic resampling: each particle is chosen about N*weight times
+        positions = (self.random.uniform() + np.arange(N))/N
+        chosen = np.searchsorted(np.cumsum(self.weights), positions)
+        chosen = np.minimum(chosen, N-1)
+        # Shrink toward the mean and kick, for keeping the mean and the covariance
+        kicks = self.random.multivariate_normal(np.zeros(len(mean)), (1-self.a**2)*cov, size=N)
+        particles = self.a*self.particles[chosen] + (1-self.a)*mean + kicks
+        # All the parameters are positive, reflect them on zero
+        self.particles = np.abs(particles)
+        self.log_weights = np.zeros(N)
+        self.update_weights()
+        self.nb_resampling += 1
+
+    def get_mean(self):
+        """
+        Return the mean of the parameters over the posterior.
+        """
+        return np.dot(self.weights, self.particles)
+
+    def get_covariance(self):
+        """
+        Return the covariance matrix of the parameters over the posterior.
+        """
+        deviations = self.particles - self.get_mean()
+        return np.dot(deviations.T*self.weights, deviations)
+
+    def process_post(self):
+        """
+        Extract the best guess and the covariance of the rates from the
+        particles. Same attributes as for Bayes3Measure.
+        """
+        _debug('Bayes3MeasureParticles: process_post')
+
+        mean = self.get_mean()
+        cov  = self.get_covariance()
+        self.Gp_guess = mean[0]
+        self.Gm_guess = mean[1]
+        self.cov_Gp   = cov[0][0]
+        self.cov_Gm   = cov[1][1]
+        self.cov_GpGm = cov[0][1]
+        self.eGp_guess = np.sqrt(self.cov_Gp)
+        self.eGm_guess = np.sqrt(self.cov_Gm)
+
+    def get_post(self, gp_axis=None, gm_axis=None):
+        """
+        Return the posterior probability density on a grid, like
+        Bayes3Measure.get_post, from the histogram of the particles.
+
+        gp_axis, gm_axis:
+            Axis of the grid. None for the axis of the prior.
+        """
+        _debug('Bayes3MeasureParticles: get_post')
+
+        if gp_axis is None: gp_axis = self.gp_axis
+        if gm_axis is None: gm_axis = self.gm_axis
+        edges_p = self.get_edges(np.asarray(gp_axis, dtype=float))
+        edges_m = self.get_edges(np.asarray(gm_axis, dtype=float))
+        P = np.histogram2d(self.particles[:,1], self.particles[:,0],
+                           bins=[edges_m, edges_p], weights=self.weights)[0]
+        return P/np.outer(np.diff(edges_m), np.diff(edges_p))
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import time
+    from protocol_bayes import Bayes3Measure
+    from protocol_mode_UnusedNow import PLModel
+
+    # Benchmark of the particles against the grid, on the same measurements
+    model = PLModel([0.04, 0.2])
+    model_functions = [model.PL00, model.PLp0, model.PLm0]
+    Gp_true, Gm_true = 15e3, 32e3
+    gp_axis = np.linspace(0.1e3, 100e3, 300)
+    gm_axis = np.linspace(0.1e3, 100e3, 300)
+    prior = np.ones([len(gm_axis), len(gp_axis)])
+
+    # Fake measurements, at a few times
+    random = np.random.RandomState(0)
+    R = 1e5
+    measurements = []
+    for k in range(100):
+        t = [5e-6, 10e-6, 20e-6][k%3]
+        counts = [random.poisson(R*f(t, Gp_true, Gm_true)) for f in model_functions]
+        measurements.append((t, R, counts[0]-counts[1], counts[0]-counts[2]))
+
+    # Grid: add the like-lihoods
+    grid = Bayes3Measure(model_functions, [0.04, 0.2])
+    grid.gp_axis, grid.gm_axis = gp_axis, gm_axis
+    grid.Gp_Axis, grid.Gm_Axis = np.meshgrid(gp_axis, gm_axis)
+    grid.log_prior = np.log(prior)
+    grid.L = np.zeros(grid.Gp_Axis.shape)
+    t0 = time.time()
+    for t, R, diff_p, diff_m in measurements:
+        grid.likelihood_stats = (t, R, diff_p, diff_m)
+        grid.L += grid.compute_L(grid.Gp_Axis, grid.Gm_Axis)
+        grid.update_post()
+    t_grid = time.time() - t0
+
+    for nb_particles in [500, 2000, 8000]:
+        particles = Bayes3MeasureParticles(model_functions, nb_particles=nb_particles, seed=0)
+        particles.initialize(gp_axis, gm_axis, prior)
+        t0 = time.time()
+        for measurement in measurements:
+            particles.add_measurement(*measurement)
+        t_particles = time.time() - t0
+        print('%5d particles: %.0f ms instead of %.0f ms for %dx%d points, %d resampling'%(
+              nb_particles, t_particles*1e3, t_grid*1e3, len(gp_axis), len(gm_axis),
+              particles.nb_resampling))
+        print('    Gp = %.0f +- %.0f Hz (grid: %.0f +- %.0f Hz)'%(
+              particles.Gp_guess, particles.eGp_guess, grid.Gp_mean, np.sqrt(grid.cov_post[0][0])))
+        print('    Gm = %.0f +- %.0f Hz (grid: %.0f +- %.0f Hz)'%(
+              particles.Gm_guess, particles.eGm_guess, grid.Gm_mean, np.sqrt(grid.cov_post[1][1])))
@@ -0,0 +1,213 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 09:12:41 2026
+
+Goal: Periodically save the data accumulated during a long experiment, such
+that a crash or an accidental reset doesn't throw hours of measurement away.
+
+A checkpoint is a single .npz file containing the arrays, plus the headers
+(iteration, repetition, settings, etc.) encoded in json.
+The file is first written in a temporary file and then renamed over the old
+checkpoint. Therefore the checkpoint on the disk is always either the old one
+or the new one, never a half-written file.
+
+@author: Childresslab
+"""
+
+import numpy as np
+import json
+import os
+import tempfile
+import time
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def _to_json_friendly(value):
+    """
+    Convert the numpy types (and other weird stuff from the tree dictionary)
+    into something that json can write.
+    """
+    if isinstance(value, np.ndarray):
+        return value.tolist()
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, (list, tuple)):
+        return [_to_json_friendly(v) for v in value]
+    if isinstance(value, dict):
+        return {str(k):_to_json_friendly(v) for k, v in value.items()}
+    if isinstance(value, (str, int, float, bool)) or value is None:
+        return value
+    # Last resort
+    return str(value)
+
+def save_checkpoint(path, arrays, headers):
+    """
+    Atomically write a checkpoint.
+
+    path:
+        Path of the checkpoint file (should end with .npz)
+    arrays:
+        Dictionary of the arrays to save. Keys are the name of the arrays.
+    headers:
+        Dictionary of the scalar information (iteration, settings, ...).
+        The values must be convertible to json.
+    """
+    _debug('save_checkpoint', path)
+
+    directory = os.path.dirname(os.path.abspath(path))
+
+    # Write in a temporary file that lives in the same folder, such that the
+    # final renaming is atomic.
+    fd, path_temp = tempfile.mkstemp(suffix='.tmp', dir=directory)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            to_save = dict(arrays)
+            to_save['_headers_json'] = np.array(json.dumps(_to_json_friendly(headers)))
+            np.savez(f, **to_save)
+            # Make sure that it is really on the disk before to rename
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path_temp, path)
+    except:
+        # Don't leave garbage behind us
+        if os.path.exists(path_temp):
+            os.remove(path_temp)
+        raise
+
+def load_checkpoint(path):
+    """
+    Load a checkpoint written with save_checkpoint.
+
+    Return (arrays, headers), two dictionaries.
+    """
+    _debug('load_checkpoint', path)
+
+    with np.load(path, allow_pickle=False) as f:
+        arrays  = {key:f[key] for key in f.files if key != '_headers_json'}
+        headers = json.loads(str(f['_headers_json']))
+    return arrays, headers
+
+
+class Checkpointer():
+    """
+    Decide when it is time to write a checkpoint, and write it.
+    A checkpoint is due every N iterations or every T seconds, whichever
+    comes first.
+    """
+    def __init__(self, path, N_iter=100, T_s=600):
+        """
+        path:
+            Path of the checkpoint file.
+        N_iter:
+            Number of iterations between two checkpoints. 0 means never check
+            the number of iteration.
+        T_s:
+            Time (in second) between two checkpoints. 0 means never check the
+            time.
+        """
+        _debug('Checkpointer: __init__')
+        _debug('The secret of getting ahead is getting started. – Mark Twain')
+
+        self.path   = path
+        # Where the previous checkpoint goes when we start over
+        self.path_previous = os.path.splitext(path)[0] + '_previous.npz'
+        self.N_iter = N_iter
+        self.T_s    = T_s
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget about the previous checkpoint.
+        """
+        _debug('Checkpointer: reset')
+
+        self.iter_last = -1
+        self.time_last = time.time()
+
+    def is_due(self, iteration):
+        """
+        Return True if a checkpoint should be written at this iteration.
+        """
+        _debug('Checkpointer: is_due')
+
+        if self.N_iter>0:
+            if iteration - self.iter_last >= self.N_iter:
+                return True
+        if self.T_s>0:
+            if time.time() - self.time_last >= self.T_s:
+                return True
+        return False
+
+    def save(self, iteration, arrays, headers):
+        """
+        Write the checkpoint and note when it was done.
+
+        iteration:
+            Iteration at which the checkpoint is taken.
+        arrays, headers:
+            Same as in save_checkpoint.
+        """
+        _debug('Checkpointer: save')
+
+        headers = dict(headers)
+        headers['checkpoint_iteration'] = iteration
+        headers['checkpoint_time'     ] = time.ctime()
+        save_checkpoint(self.path, arrays, headers)
+
+        self.iter_last = iteration
+        self.time_last = time.time()
+
+    def archive(self):
+        """
+        Move the current checkpoint aside, such that the next checkpoints
+        don't overwrite it. This is useful when the data are reset: the
+        previous run can still be resumed if the reset was an accident.
+        """
+        _debug('Checkpointer: archive')
+
+        if os.path.exists(self.path):
+            os.replace(self.path, self.path_previous)
+        self.reset()
+
+    def load(self):
+        """
+        Load the checkpoint. If there is no checkpoint since the last archive,
+        load the archived one.
+        Return (arrays, headers), or None if there is no checkpoint at all.
+        """
+        _debug('Checkpointer: load')
+
+        if os.path.exists(self.path):
+            return load_checkpoint(self.path)
+        if os.path.exists(self.path_previous):
+            return load_checkpoint(self.path_previous)
+        return None
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = True
+
+    # Quick check of the round trip
+    path = 'checkpoint_test.npz'
+    cc = Checkpointer(path, N_iter=10, T_s=0)
+    for i in range(25):
+        if cc.is_due(i):
+            cc.save(i, {'counts_total':np.arange(6).reshape(2,3)*i},
+                    {'rep':1000, 'nb_block':3})
+    arrays, headers = cc.load()
+    print(arrays, headers)
+    os.remove(path)
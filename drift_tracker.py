@@ -0,0 +1,364 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 09:05:44 2026
+
+Goal: Remember the result of each optimization and learn how the position of
+the NV drifts with time.
+
+The history is a text file with one line per optimization:
+    time, Vx, Vy, Vz, counts, sigma_x, sigma_y, sigma_z
+where sigma is the uncertainty of the fit on the position (nan if not known).
+It is appended after each optimization, so it survives the restart of the
+GUI.
+
+The drift is modeled with a Kalman filter for each axis, with a constant
+velocity model: the state is (position, velocity) and the velocity does a
+random walk. Between the optimizations, it predicts where the NV is and how
+well we know it. This is used for:
+    - Shifting the AOs before the NV is lost, on the axes where the drift
+      velocity is significant (elsewhere the shift would only add the noise
+      of the optimizations).
+    - Optimizing on a smaller range when the prediction is good.
+
+@author: Childresslab
+"""
+
+import numpy as np
+import os
+import time
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+class OptimizationHistory():
+    """
+    Persistent list of the optimization results.
+    """
+    def __init__(self, path='optimization_history.txt'):
+        """
+        path:
+            Path of the text file. It is created if it does not exist.
+        """
+        _debug('OptimizationHistory: __init__')
+        _debug('Whatever you are, be a good one. – Abraham Lincoln')
+
+        self.path = path
+        self.keys = ['time', 'Vx', 'Vy', 'Vz', 'counts', 'sigma_x', 'sigma_y', 'sigma_z']
+        if os.path.exists(path):
+            data = np.loadtxt(path, delimiter=',', ndmin=2)
+            self.data = data.reshape(-1, len(self.keys))
+        else:
+            self.data = np.zeros((0, len(self.keys)))
+            with open(path, 'w') as f:
+                f.write('# ' + ', '.join(self.keys) + '\n')
+
+    def __len__(self):
+        return len(self.data)
+
+    def append(self, t, r, counts, sigmas=None):
+        """
+        Add one optimization.
+
+        t:
+            Time of the optimization (in s, like time.time())
+        r:
+            (Vx, Vy, Vz) found.
+        counts:
+            Counts on the NV.
+        sigmas:
+            (sigma_x, sigma_y, sigma_z) uncertainty on the position. None if
+            not known.
+        """
+        _debug('OptimizationHistory: append')
+
+        if sigmas is None:
+            sigmas = [np.nan]*3
+        row = np.concatenate([[t], r, [counts], sigmas]).astype(float)
+        self.data = np.vstack([self.data, row])
+        with open(self.path, 'a') as f:
+            f.write(', '.join(['%.17g'%x for x in row]) + '\n')
+
+    def get(self, key):
+        """
+        Return the column key of the history (see self.keys).
+        """
+        return self.data[:, self.keys.index(key)]
+
+
+class DriftKalman():
+    """
+    Kalman filter of the position and velocity of the NV, for the three axes
+    at once (the axes are independent).
+    """
+    def __init__(self, noise_velocity=1e-15, sigma_measure=0.005,
+                 sigma_velocity_start=1e-5):
+        """
+        noise_velocity:
+            Spectral density of the random walk of the velocity (V^2/s^3).
+            The larger, the faster the model forgets the old velocity.
+        sigma_measure:
+            Uncertainty of the position found by an optimization (in V), used
+            when the optimization doesn't give one.
+        sigma_velocity_start:
+            Uncertainty of the velocity (in V/s) before any measurement.
+        """
+        _debug('DriftKalman: __init__')
+
+        self.noise_velocity = noise_velocity
+        self.sigma_measure  = sigma_measure
+        self.sigma_velocity_start = sigma_velocity_start
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything.
+        """
+        _debug('DriftKalman: reset')
+
+        self.t     = None
+        self.x     = np.zeros((3,2))   # (position, velocity) for each axis
+        self.P     = np.zeros((3,2,2)) # Covariance for each axis
+        self.P[:,1,1] = self.sigma_velocity_start**2
+
+    def get_transition(self, dt):
+        """
+        Return the transition matrix and the process noise for a time dt.
+        """
+        F = np.array([[1, dt],
+                      [0, 1 ]])
+        q = self.noise_velocity
+        Q = q*np.array([[dt**3/3, dt**2/2],
+                        [dt**2/2, dt     ]])
+        return F, Q
+
+    def predict(self, t):
+        """
+        Return (positions, sigmas): the predicted (Vx, Vy, Vz) at time t and
+        their uncertainty. Return (None, None) if nothing is known.
+        """
+        if self.t is None:
+            return None, None
+        F, Q = self.get_transition(t - self.t)
+        x = np.einsum('ij,aj->ai', F, self.x)
+        P = np.einsum('ij,ajk,lk->ail', F, self.P, F) + Q
+        return x[:,0], np.sqrt(P[:,0,0])
+
+    def update(self, t, positions, sigmas=None):
+        """
+        Add the positions (Vx, Vy, Vz) found at time t.
+        """
+        _debug('DriftKalman: update')
+
+        positions = np.array(positions, dtype=float)
+        if sigmas is None:
+            sigmas = [np.nan]*3
+        R = np.array(sigmas, dtype=float)**2
+        R[~np.isfinite(R)] = self.sigma_measure**2
+
+        if self.t is None:
+            # First point: the position is known, not the velocity
+            self.x[:,0] = positions
+            self.P[:,0,0] = R
+            self.P[:,0,1] = 0
+            self.P[:,1,0] = 0
+            self.t = t
+            return
+
+        # Predict
+        F, Q = self.get_transition(t - self.t)
+        self.x = np.einsum('ij,aj->ai', F, self.x)
+        self.P = np.einsum('ij,ajk,lk->ail', F, self.P, F) + Q
+        # Update with the measured position
+        S = self.P[:,0,0] + R
+        K = self.P[:,:,0]/S[:,None] # Gain, (3,2)
+        innovation = positions - self.x[:,0]
+        self.x += K*innovation[:,None]
+        self.P -= K[:,:,None]*self.P[:,0,:][:,None,:]
+        self.t = t
+
+    def jump(self, t, positions, sigmas=None):
+        """
+        The position changed for another reason than the drift (for example
+        we moved on another NV). Restart the position, but keep the velocity,
+        because the drift is mostly the one of the whole stage.
+        """
+        _debug('DriftKalman: jump')
+
+        velocity = self.x[:,1].copy()
+        P_velocity = self.P[:,1,1].copy()
+        self.t = None
+        self.update(t, positions, sigmas)
+        self.x[:,1] = velocity
+        self.P[:,1,1] = P_velocity
+
+    def get_velocity(self):
+        """
+        Return the drift velocity (V/s) of each axis.
+        """
+        return self.x[:,1].copy()
+
+    def get_velocity_sigmas(self):
+        """
+        Return the uncertainty of the drift velocity (V/s) of each axis.
+        """
+        return np.sqrt(self.P[:,1,1])
+
+
+class DriftTracker():
+    """
+    History of the optimizations and drift model built from it.
+    """
+    def __init__(self, path='optimization_history.txt', max_gap_s=3*3600,
+                 **kwargs):
+        """
+        path:
+            Path of the history file.
+        max_gap_s:
+            If there is more than this time (in s) between two optimizations,
+            the drift model starts over. The old history is then irrelevant
+            (the setup was probably touched).
+        kwargs:
+            Are sent to DriftKalman.
+        """
+        _debug('DriftTracker: __init__')
+        _debug('Act as if what you do makes a difference. It does. – William James')
+
+        self.history = OptimizationHistory(path)
+        self.model   = DriftKalman(**kwargs)
+        self.max_gap_s = max_gap_s
+        self.r_last_correction = None # Prediction when the AOs were last shifted
+        # Learn from the history
+        for row in self.history.data:
+            self.update_model(row[0], row[1:4], row[5:8])
+
+    def update_model(self, t, r, sigmas, distance_jump=None):
+        """
+        Add a position to the drift model.
+        """
+        if not(self.model.t is None) and t - self.model.t > self.max_gap_s:
+            self.model.reset()
+        if not(distance_jump is None):
+            r_predicted = self.model.predict(t)[0]
+            if not(r_predicted is None) and np.any(np.abs(r - r_predicted) > distance_jump):
+                self.model.jump(t, r, sigmas)
+                return
+        self.model.update(t, r, sigmas)
+
+    def add_optimization(self, r, counts, sigmas=None, t=None, distance_jump=None):
+        """
+        Note the result of an optimization.
+
+        r:
+            (Vx, Vy, Vz) found.
+        counts:
+            Counts on the NV.
+        sigmas:
+            Uncertainty on r. None if not known.
+        t:
+            Time of the optimization. Default is now.
+        distance_jump:
+            (dx, dy, dz) If the position is further than this from the
+            prediction, we consider that we moved on another NV.
+        """
+        _debug('DriftTracker: add_optimization')
+
+        if t is None:
+            t = time.time()
+        self.history.append(t, r, counts, sigmas)
+        self.update_model(t, np.array(r, dtype=float), sigmas, distance_jump)
+        self.r_last_correction = self.model.predict(t)[0]
+
+    def get_correction(self, t=None, nb_sigma_velocity=3):
+        """
+        Return the shift (dVx, dVy, dVz) to apply on the AOs since the last
+        call, for following the predicted drift. Return zeros if the drift
+        is not known.
+
+        nb_sigma_velocity:
+            The shift is zero on the axes where the drift velocity is smaller
+            than this number of times its uncertainty.
+        """
+        if t is None:
+            t = time.time()
+        r_predicted = self.model.predict(t)[0]
+        if r_predicted is None or self.r_last_correction is None:
+            return np.zeros(3)
+        shift = r_predicted - self.r_last_correction
+        self.r_last_correction = r_predicted
+        is_significant = (np.abs(self.model.get_velocity()) > 
+                          nb_sigma_velocity*self.model.get_velocity_sigmas())
+        return np.where(is_significant, shift, 0)
+
+    def get_ranges(self, ranges, t=None, nb_sigma=4, fraction_min=0.25):
+        """
+        Return the ranges on which to optimize. It is the usual ranges if the
+        drift is not known, and a smaller one if the prediction is good.
+
+        ranges:
+            (range_x, range_y, range_z) usual ranges.
+        nb_sigma:
+            The range is at least this number of prediction uncertainty on
+            each side.
+        fraction_min:
+            The range is at least this fraction of the usual range, for still
+            seeing the shape of the spot.
+        """
+        if t is None:
+            t = time.time()
+        ranges = np.array(ranges, dtype=float)
+        sigmas = self.model.predict(t)[1]
+        if sigmas is None:
+            return ranges
+        return np.clip(2*nb_sigma*sigmas, fraction_min*ranges, ranges)
+
+    def get_info(self, t=None):
+        """
+        Return a short string describing the drift.
+        """
+        if self.model.t is None:
+            return 'Drift: unknown'
+        if t is None:
+            t = time.time()
+        v = self.model.get_velocity()*3600*1e3
+        sigmas = self.model.predict(t)[1]*1e3
+        return ('Drift (mV/h): %.2f, %.2f, %.2f\n'%tuple(v) +
+                'Prediction uncertainty (mV): %.2f, %.2f, %.2f'%tuple(sigmas))
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Fake a stage drifting linearly in z only, optimized every 10 min
+    path = 'history_test.txt'
+    tracker = DriftTracker(path)
+    velocity = np.array([0, 0, 5e-6]) # V/s
+    errors_without, errors_with = [], []
+    r_optimized = np.zeros(3)
+    for i in range(30):
+        t = i*600.
+        # Between optimizations, the AOs are shifted every minute
+        r_AO = r_optimized.copy()
+        for k in range(1, 11):
+            r_AO += tracker.get_correction(t + k*60)
+        r_true = velocity*(t + 600)
+        errors_with   .append(np.abs(r_AO - r_true))
+        errors_without.append(np.abs(r_optimized - r_true))
+        r_optimized = r_true + np.random.normal(0, 0.001, 3)
+        tracker.add_optimization(r_optimized, 1000, [0.001]*3, t=t+600)
+    print(tracker.get_info(t+600))
+    print('Rms error before optimizing without correction (mV):', 1e3*np.sqrt(np.mean(np.square(errors_without[10:]), axis=0)))
+    print('Rms error before optimizing with correction (mV):   ', 1e3*np.sqrt(np.mean(np.square(errors_with[10:]), axis=0)))
+    print('Ranges:', tracker.get_ranges([0.1, 0.1, 0.2], t=t+1200))
+    os.remove(path)
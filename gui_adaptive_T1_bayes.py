@@ -7,9 +7,14 @@ Created on Mon Aug 17 16:34:14 2020
 
 import numpy as np
 from spinmob import egg
+from model_cache import ModelCache # For evaluating the model only once per time to probe
 import traceback
 _p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
 
+# Trapezoidal rule. np.trapz is called np.trapezoid since numpy 2.0, and 
+# removed in the latest numpy
+_trapz = getattr(np, 'trapezoid', None) or np.trapz
+
 
 _debug_enabled     = False
 def _debug(*a):
@@ -251,8 +256,8 @@ def integral2D(x,y, Z):
 #               'x:', x,
 #               'y:', y,
 #               'Z:', Z)
-    firstInt = np.trapz(Z, x=x, axis=1) #First integrate along the first axis
-    return     np.trapz(firstInt, x=y) #Integrate over the remaining axis
+    firstInt = _trapz(Z, x=x, axis=1) #First integrate along the first axis
+    return     _trapz(firstInt, x=y) #Integrate over the remaining axis
 
 class Bayes3Measure():
     """
@@ -309,6 +314,9 @@ class Bayes3Measure():
         self.NGm    = len(self.gm_axis)       #Number of discrete point along the gamma- axis for the probability distributions. 
         #Meshgrid
         self.Gp_Axis, self.Gm_Axis = np.meshgrid(self.gp_axis, self.gm_axis)  
+        # Tables of the model functions on this grid, for each time probed
+        self.model_cache = ModelCache(model_functions)
+        self.model_cache.set_grid(self.Gp_Axis, self.Gm_Axis)
         
         #Get the prior 
         self.prior = prior #Prior distribution
@@ -401,9 +409,11 @@ class Bayes3Measure():
         """
         
         # Get the like-lihood of this measurement
-        exp_0 = self.f0(t_probe, self.Gp_Axis, self.Gm_Axis)*nb_readout
-        exp_p = self.fp(t_probe, self.Gp_Axis, self.Gm_Axis)*nb_readout
-        exp_m = self.fm(t_probe, self.Gp_Axis, self.Gm_Axis)*nb_readout
+        # The model functions are evaluated only the first time at t_probe
+        f0s, fps, fms = self.model_cache.get(t_probe)
+        exp_0 = f0s*nb_readout
+        exp_p = fps*nb_readout
+        exp_m = fms*nb_readout
         # Update the total likelihood. And rescale it
         self.L += self.likelihood(exp_0, exp_p, exp_m, diff_p, diff_m)
         self.L -= np.min(self.L) # Shift it to avoid too much huge exponential
@@ -435,6 +445,29 @@ class PLModel():
         self.A = self.PL0-self.contrast*self.PL0*2/3 
         self.B = self.contrast*self.PL0/6 
         
+    def get_coefs(self, name, Gp, Gm, G0):
+        """
+        Return (coefp, coefm), the coefficients of exp(-t*betap) and 
+        exp(-t*betam) in the photoluminescence name ('PL00', 'PLp0', etc.). 
+        They don't depend on the time, such that they can be reused for many
+        times (see model_cache). 
+        
+        G0:
+            np.sqrt(Gp*Gp + Gm*Gm - Gp*Gm)
+        """
+        if   name == 'PL00':
+            return (2*G0 + Gm + Gp)/G0, (2*G0 - Gm - Gp)/G0
+        elif name in ['PLp0', 'PL0p']:
+            return -(G0 - Gm + 2*Gp)/G0, -(G0 + Gm - 2*Gp)/G0
+        elif name in ['PLm0', 'PL0m']:
+            return -(G0 + 2*Gm - Gp)/G0, -(G0 - 2*Gm + Gp)/G0
+        elif name == 'PLpp':
+            return (2*G0 - 2*Gm + Gp)/G0, (2*G0 + 2*Gm - Gp)/G0
+        elif name in ['PLmp', 'PLpm']:
+            return +(-G0 + Gm + Gp)/G0, -(+G0 + Gm + Gp)/G0
+        elif name == 'PLmm':
+            return (2*G0 + Gm - 2*Gp)/G0, (2*G0 - Gm + 2*Gp)/G0
+        
     def PL00(self, t, Gp, Gm):
         """
         Photoluminescence of initializing in ms=0, reading ms=0
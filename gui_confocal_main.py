@@ -74,6 +74,8 @@ class GUIMainConfocal(egg.gui.Window):
         self.gui_optimizer.event_optimize_starts = self.before_optimization
         self.gui_optimizer.event_optimize_ends   = self.after_optimization
         
+        self.gui_map.event_spot_visited = self.spot_visited
+        
         
         
 
@@ -183,6 +185,27 @@ class GUIMainConfocal(egg.gui.Window):
                 # Click only if the count are not already runing
                 self.gui_counts.button_take_counts.click()
             
+    def spot_visited(self, spot):
+        """
+        What to do when the map arrives on a NV that it found. 
+        Optimize on it, if it is asked. 
+        """
+        _debug('GUIMainConfocal: spot_visited')
+        
+        if not(self.gui_map.treeDic_settings['Spots/Optimize_each']):
+            return
+        if self.gui_optimizer.is_optimizing:
+            return
+        
+        # This returns when the optimization is done
+        self.gui_optimizer.button_optimize.click()
+        
+        # Note where the NV really is
+        Vx = self.fpga.get_AO_voltage(self.gui_map.treeDic_settings['AO_x'])
+        Vy = self.fpga.get_AO_voltage(self.gui_map.treeDic_settings['AO_y'])
+        Vz = self.fpga.get_AO_voltage(self.gui_map.treeDic_settings['AO_z'])
+        self.gui_map.note_spot_optimized(Vx, Vy, Vz)
+            
                         
             
         
@@ -18,8 +18,12 @@ import traceback
 _p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
 
 import time
+import threading
 
 from converter import Converter # For converting the pattern for counting
+import scan_order # For the order in which the pixels are scanned
+import map_storage # For storing the scans in binary
+from spot_finder import find_spots # For finding the NVs on the map
 
 
 
@@ -70,6 +74,13 @@ class GUIMap(egg.gui.Window):
         self.nb_max_slice = 5 # Maximum number of slice to store
         
         self.label_slice_date = '' # Label shown on the slice
+        self.measured = None # Which pixels of the scan are measured. None if not known
+        self.strides  = None # Strides of the progressive scan, if it is the one running
+        self.stack = None # Binary stack of scans (map_storage.MapStack), if one is opened
+        self.index_stack_slice = None # Slice of the stack being scanned
+        self.list_spots = [] # NVs found on the map that are still to visit
+        self.list_spots_visited = [] # NVs already visited
+        self.spot_visited = None # NV on which we are now
         
         # Fill up the GUI 
         self.initialize_GUI()
@@ -116,6 +127,25 @@ class GUIMap(egg.gui.Window):
         self.button_load_scans.set_text('Load scan :D')
         self.connect(self.button_load_scans.signal_clicked, self.button_load_scans_clicked)  
         
+        # Place a buttong for opening a binary stack of scans
+        self.button_open_stack = self.place_object(egg.gui.Button(), alignment=1)
+        self.button_open_stack.set_text('Open stack')
+        self.button_open_stack._widget.setToolTip('Select a folder for storing the scans in binary.\n'+
+                                                  'The scans in the folder can be shown with Stack_slice and the next scans are added to it.')
+        self.connect(self.button_open_stack.signal_clicked, self.button_open_stack_clicked)  
+        
+        # Place a buttong for finding the NVs on the map
+        self.button_find_spots = self.place_object(egg.gui.Button(), alignment=1)
+        self.button_find_spots.set_text('Find NVs')
+        self.button_find_spots._widget.setToolTip('Find the bright spots on the map shown.\n'+
+                                                  'They are then visited one by one with "Next NV".')
+        self.connect(self.button_find_spots.signal_clicked, self.button_find_spots_clicked)  
+
+        # Place a buttong for going on the next NV found
+        self.button_next_spot = self.place_object(egg.gui.Button(), alignment=1)
+        self.button_next_spot.set_text('Next NV')
+        self.connect(self.button_next_spot.signal_clicked, self.button_next_spot_clicked)  
+        
         self.new_autorow()
         # Place a progres bar
         self.progress_bar = egg.pyqtgraph.Qt.QtWidgets.QProgressBar()
@@ -182,6 +212,11 @@ class GUIMap(egg.gui.Window):
                                            bounds=[0, self.nb_max_slice-1],
                                            tip='Which scan to shown')  
         
+        self.treeDic_settings.add_parameter('Stack_slice', 0, 
+                                           type='int', 
+                                           bounds=[0, None],
+                                           tip='Which scan of the opened stack to show')  
+        
         list_colormap = PersonalColorMap().get_list_colormaps()
         self.treeDic_settings.add_parameter('Colormap', 0, 
                                            type='list', values=list_colormap)   
@@ -194,14 +229,53 @@ class GUIMap(egg.gui.Window):
                                            bounds=[None,None],
                                            tip='Factor by which we stretch the yaxis')  
         
-        self.list_scanning_mode = ['Sawtooth', 'Snake', 'Random', 'Diagonal_sweep', 'Spiral']
+        self.list_scanning_mode = ['Sawtooth', 'Snake', 'Random', 'Diagonal_sweep', 'Spiral', 'Progressive', 'Adaptive']
         self.treeDic_settings.add_parameter('Scanning_mode', 0, 
                                            type='list', 
                                            values=self.list_scanning_mode,
                                            tip='On which kind of path to scan. \nSee the methods "scan_row_..." for more information.')  
         
+        self.treeDic_settings.add_parameter('Adaptive/Coarse_step', 4, 
+                                           type='int', step=1, 
+                                           bounds=[1,None],
+                                           tip='Adaptive scan: number of pixels between the points of the first coarse grid.\nIt should be about the size of a spot.')  
+        self.treeDic_settings.add_parameter('Adaptive/Nb_sigma', 3, 
+                                           type='float', step=0.5, 
+                                           bounds=[0,None],
+                                           tip='Adaptive scan: a cell is refined if it is brighter than the background,\nor if it has a gradient, by more than this number of standard deviations.')  
+        self.treeDic_settings.add_parameter('Adaptive/SNR', 5, 
+                                           type='float', step=1, 
+                                           bounds=[0,None],
+                                           tip='Adaptive scan: signal to noise ratio aimed for the contrast with the background.\nThis sets the count time of the refined pixels.')  
+        self.treeDic_settings.add_parameter('Adaptive/Max_count_time_factor', 8, 
+                                           type='float', step=1, 
+                                           bounds=[1,None],
+                                           tip='Adaptive scan: maximum count time of a pixel, in unit of Count_time.')  
+        
+        self.treeDic_settings.add_parameter('Spots/Size', 1.5, 
+                                           type='float', step=0.1, 
+                                           bounds=[0.5,None], suffix=' px',
+                                           tip='Standard deviation of a NV on the map, in pixel.\nThis is the size of the filter used for finding them.')  
+        self.treeDic_settings.add_parameter('Spots/Nb_sigma', 5, 
+                                           type='float', step=0.5, 
+                                           bounds=[0,None],
+                                           tip='A spot is kept if it is above the noise by this number of standard deviations.')  
+        self.treeDic_settings.add_parameter('Spots/Nb_max', 20, 
+                                           type='int', step=1, 
+                                           bounds=[1,None],
+                                           tip='Maximum number of NVs to keep, the brightest first.')  
+        self.treeDic_settings.add_parameter('Spots/Optimize_each', True, 
+                                           type='bool',
+                                           tip='Weither or not to optimize on each NV visited.')  
+        
+        self.treeDic_settings.add_parameter('Refresh_rate', 10, 
+                                           type='float', step=1, 
+                                           bounds=[0.1,None], suffix=' Hz',
+                                           tip='How often the image is refreshed during the scan.\nThe acquisition runs on its own, so this does not slow it down.')  
+        
         # Some connections
         self.treeDic_settings.connect_signal_changed('Slice_shown', self.update_slice_shown)
+        self.treeDic_settings.connect_signal_changed('Stack_slice', self.update_stack_slice_shown)
         self.treeDic_settings.connect_signal_changed('Colormap', self.update_colormap)
         self.treeDic_settings.connect_signal_changed('Set_aspect', self.update_image)
         self.treeDic_settings.connect_signal_changed('yfactor_aspect_ratio', self.update_image)
@@ -238,6 +312,11 @@ class GUIMap(egg.gui.Window):
         self.ptROI = egg.pyqtgraph.ROI((0,0),pen=(0,255,255))
         self.plot_image.addItem(self.ptROI)
         self.connect(self.ptROI.sigRegionChanged, self.pos_ptROI_changed)    
+        # Add the markers of the NVs found
+        self.scatter_spots = egg.pyqtgraph.ScatterPlotItem(size=12, symbol='o',
+                                                           pen=(255,255,0), 
+                                                           brush=None)
+        self.plot_image.addItem(self.scatter_spots)
         # A label for the slice
         self.label_slice_date = time.ctime(time.time())
         self.textitem_slice = egg.pyqtgraph.TextItem(text=self.label_slice_date, 
@@ -311,15 +390,139 @@ class GUIMap(egg.gui.Window):
         self.Vymax = self.databox_scan.h('Vy_max')
         self.Ny    = self.databox_scan.h('Ny')
         
-        self.Z = np.zeros([self.Nx, self.Ny])
-        # Add each column 
-        for i in range(self.Ny):
-            self.Z[i] = self.databox_scan['Col%d'%i]      
+        self.Z = map_storage.databox_to_map(self.databox_scan)
+            
+        # Update the image
+        self.initialize_image()
+        self.update_image()
+        
+    def update_stack_slice_shown(self):
+        """
+        Show the slice of the opened stack. Only this slice is read from the 
+        disk. 
+        """
+        _debug('GUIMap: update_stack_slice_shown')
+        
+        if self.stack is None or len(self.stack) == 0:
+            return
+        if self.is_scanning:
+            # Don't mess up with the scan lol
+            return
+        
+        n = self.treeDic_settings['Stack_slice']
+        # Ajdust the value if it exceed the stored data
+        if n>=len(self.stack):
+            self.treeDic_settings['Stack_slice'] = len(self.stack)-1
+            n = self.treeDic_settings['Stack_slice']
             
+        # Extract the data
+        headers = self.stack.get_headers(n)
+        self.label_slice_date = headers['date']
+        self.Vxmin = headers['Vx_min']
+        self.Vxmax = headers['Vx_max']
+        self.Nx    = headers['Nx']
+        self.Vymin = headers['Vy_min']
+        self.Vymax = headers['Vy_max']
+        self.Ny    = headers['Ny']
+        self.Z = np.array(self.stack.get_slice(n))
+        self.measured = self.stack.get_measured(n)
+        self.strides  = None
+        
         # Update the image
         self.initialize_image()
         self.update_image()
         
+    def button_open_stack_clicked(self):
+        """
+        Select the folder of a stack of scans. 
+        If it contains scans, the last one is shown. 
+        The next scans will be added to it. 
+        """
+        _debug('GUIMap: button_open_stack_clicked')
+        
+        path = sm.dialogs.select_directory(text='Select the folder of the stack')
+        if path is None or path == '':
+            return
+        self.stack = map_storage.MapStack(path)
+        self.button_open_stack.set_text('Stack: %d scans'%len(self.stack))
+        
+        # Show the last scan
+        if len(self.stack)>0:
+            self.treeDic_settings['Stack_slice'] = len(self.stack)-1
+            self.update_stack_slice_shown()
+        
+    def button_find_spots_clicked(self):
+        """
+        Find the NVs on the map shown and put them in the list of NVs to 
+        visit, the most significant first. 
+        """
+        _debug('GUIMap: button_find_spots_clicked')
+        
+        if self.is_scanning:
+            # Wait for the complete map
+            return
+        
+        t0 = time.time()
+        self.list_spots = find_spots(self.get_image_shown(), 
+                                     self.Vxmin, self.Vxmax, 
+                                     self.Vymin, self.Vymax,
+                                     size_spot_px=self.treeDic_settings['Spots/Size'],
+                                     nb_sigma    =self.treeDic_settings['Spots/Nb_sigma'],
+                                     nb_max      =self.treeDic_settings['Spots/Nb_max'])
+        self.list_spots_visited = []
+        self.spot_visited = None
+        
+        self.update_spots_shown()
+        self.label_progress.set_text('Found %d NVs in %.1f ms'%(len(self.list_spots), 
+                                                                1e3*(time.time()-t0)))
+        
+    def button_next_spot_clicked(self):
+        """
+        Go on the next NV of the list and call event_spot_visited. 
+        """
+        _debug('GUIMap: button_next_spot_clicked')
+        
+        if self.is_scanning:
+            return
+        if len(self.list_spots) == 0:
+            self.label_progress.set_text('No more NV to visit. Click on "Find NVs".')
+            return
+        
+        # Take the next NV
+        self.spot_visited = self.list_spots.pop(0)
+        self.list_spots_visited.append(self.spot_visited)
+        
+        # Move the cursor on it. This sets the voltages. 
+        self.ptROI.setPos((self.spot_visited['Vx'] - self.size_ptROI_x/2,
+                           self.spot_visited['Vy'] - self.size_ptROI_y/2))
+        self.update_spots_shown()
+        self.label_progress.set_text('NV %d (%d left): snr = %.1f'%(len(self.list_spots_visited),
+                                                                 len(self.list_spots),
+                                                                 self.spot_visited['snr']))
+        
+        self.event_spot_visited(self.spot_visited)
+        
+    def note_spot_optimized(self, Vx, Vy, Vz):
+        """
+        Note the optimized position of the NV visited. 
+        """
+        _debug('GUIMap: note_spot_optimized')
+        
+        if self.spot_visited is None:
+            return
+        self.spot_visited['Vx_opt'] = Vx
+        self.spot_visited['Vy_opt'] = Vy
+        self.spot_visited['Vz_opt'] = Vz
+        
+    def update_spots_shown(self):
+        """
+        Show the markers of the NVs still to visit. 
+        """
+        _debug('GUIMap: update_spots_shown')
+        
+        self.scatter_spots.setData([spot['Vx'] for spot in self.list_spots],
+                                   [spot['Vy'] for spot in self.list_spots])
+        
     def update_colormap(self):
         """
         Update the color of the image to fit the settings
@@ -488,10 +691,9 @@ class GUIMap(egg.gui.Window):
         self.treeDic_settings['Nb_point_X'] = self.Nx 
         self.treeDic_settings['Nb_point_Y'] = self.Ny
         
-        self.Z = np.zeros([self.Ny, self.Nx])
-        # Add each column 
-        for i in range(self.Ny):
-            self.Z[i] = self.databox_scan['Col%d'%i]      
+        self.Z = map_storage.databox_to_map(self.databox_scan)
+        self.measured = None
+        self.strides  = None
             
         # Update the image
         self.initialize_image()
@@ -529,16 +731,31 @@ class GUIMap(egg.gui.Window):
         self.fpga.prepare_DIOs([1], [1]) 
         # Get the actual DIOs, because there might be other DIOs open.
         self.dio_states = self.fpga.get_DIO_states() 
-        # Convert the instruction into the data array
-        conver = Converter() # Load the converter object.
-        self.count_time_ms = self.treeDic_settings['Count_time']
-        nb_ticks = self.count_time_ms*1e3/(conver.tickDuration)
-        self.data_array = conver.convert_into_int32([(nb_ticks, self.dio_states)])
         
         # Update the wait time
         wait_AO_time = self.treeDic_settings['Wait_after_AOs']
         self.fpga.prepare_wait_time(wait_AO_time)
         
+        # Send the counting pulse to the FPGA
+        self.prepare_count_time(self.treeDic_settings['Count_time'])
+        
+    def prepare_count_time(self, count_time_ms):
+        """
+        Send to the fpga the pulse pattern for counting during count_time_ms. 
+        The DIOs must be already noted by prepare_acquisition_pulse. 
+        This doesn't touch the GUI, so it can be called during the scan. 
+        
+        count_time_ms:
+            Count time (in ms)
+        """
+        _debug('GUIMap: prepare_count_time')
+        
+        # Convert the instruction into the data array
+        conver = Converter() # Load the converter object.
+        self.count_time_ms = count_time_ms
+        nb_ticks = self.count_time_ms*1e3/(conver.tickDuration)
+        self.data_array = conver.convert_into_int32([(nb_ticks, self.dio_states)])
+        
          # Send the data_array to the FPGA
         self.fpga.prepare_pulse(self.data_array)
 
@@ -641,6 +858,11 @@ class GUIMap(egg.gui.Window):
         for i in range(N_col):
             col = self.Z[i]
             self.databox_scan['Col%d'%i] = col              
+        # If the scan was stopped before the end, note which pixels are real
+        if not(self.measured is None) and not(np.all(self.measured)):
+            self.databox_scan.insert_header('Nb_measured', int(np.sum(self.measured)))
+            for i in range(N_col):
+                self.databox_scan['Measured%d'%i] = self.measured[i].astype(int)
 
 
         if self.nb_of_slice > self.nb_max_slice:
@@ -682,6 +904,20 @@ class GUIMap(egg.gui.Window):
         
         self.X,self.Y = np.meshgrid(self.xs,self.ys)
         self.Z = np.zeros(np.shape(self.X))
+        self.measured = np.zeros(np.shape(self.X), dtype=bool)
+        self.strides  = None
+        
+        # Prepare the slice in the stack, if there is one opened
+        if not(self.stack is None):
+            headers = {'date'  :self.label_slice_date,
+                       'Vx_min':self.Vxmin,
+                       'Vx_max':self.Vxmax,
+                       'Vy_min':self.Vymin,
+                       'Vy_max':self.Vymax,
+                       'z'     :self.Vz}
+            for key in self.treeDic_settings.get_keys():
+                headers[key] = self.treeDic_settings[key]
+            self.index_stack_slice = self.stack.new_slice(self.Ny, self.Nx, headers)
         
         
         # Note the AOs to take
@@ -704,10 +940,18 @@ class GUIMap(egg.gui.Window):
             self.scan_diagonal_sweep()
         elif self.treeDic_settings['Scanning_mode'] == 'Random':
             self.scan_random_points()   
+        elif self.treeDic_settings['Scanning_mode'] == 'Progressive':
+            self.scan_progressive()   
+        elif self.treeDic_settings['Scanning_mode'] == 'Adaptive':
+            self.scan_adaptive()   
             
         # At this poin the scan is completed or stopped
         # Store the scan
         self.store_scan()
+        if not(self.stack is None):
+            self.stack.close_slice(self.index_stack_slice, self.measured)
+            self.button_open_stack.set_text('Stack: %d scans'%len(self.stack))
+            self.treeDic_settings['Stack_slice'] = self.index_stack_slice
         
         # recenter the Cursor
         self.button_center_cursor_clicked()
@@ -726,54 +970,7 @@ class GUIMap(egg.gui.Window):
         """
         _debug('GUIMap: scan_row_sawtooth')
              
-        # Start the scan
-        self.row = 0
-        while self.is_scanning and self.row<len(self.ys):
-            # Note the time at which the row starts
-            self.time_row_start = time.time()
-            _debug('sawtooth Row ', self.row)
-        
-            # Get the voltrage in Y
-            Vy = self.ys[self.row]
-            
-            for i in range(len(self.xs)):
-                # Get the voltage in x
-                Vx = self.xs[i]
-                
-                # Update the voltage of the AOs
-                self.list_AOs = [self.AOx, self.AOy, self.AOz]
-                self.list_Vs = [Vx, Vy, self.Vz]
-                self.fpga.prepare_AOs(self.list_AOs, self.list_Vs)
-                
-                # Get the count, finally ;) 
-                # Two step: runt he pulse pattern and get the counts. 
-                self.fpga.run_pulse() # This will also write the AOs
-                self.counts =  self.fpga.get_counts()[0]
-                self.counts_per_sec = 1e3*self.counts/self.count_time_ms
-                
-                # Since zero is boring, let's add something
-#                image = self.counts + np.random.poisson( np.abs(1000*np.cos(Vx*Vy*0.5)) )
-#                self.Z[self.row][i]= image
-                self.Z[self.row][i] = self.counts_per_sec
-                    
-            # Update the image after each row   
-            self.update_image()
-            
-            # Note how much time it takes for the row
-            self.time_row_elapsed = time.time() - self.time_row_start
-            
-            # Update the progress bar
-            progress = 100*(self.row+1)/len(self.ys)
-            self.progress_bar.setValue(progress)
-            # Update the label for the progress
-            nb_row_remaining = len(self.ys) - (self.row+1)
-            sec = self.time_row_elapsed*nb_row_remaining
-            self.label_progress.set_text('Time remaining: %.2f s'%sec)
-            
-            # Update the row for the next iteration
-            self.row +=1
-            # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
-            self.process_events()    
+        self.scan_batches(scan_order.sawtooth(self.Nx, self.Ny))
 
     def scan_row_snake(self):
         """
@@ -785,271 +982,256 @@ class GUIMap(egg.gui.Window):
         """
         _debug('GUIMap: scan_row_snake')
              
-        # Start the scan
-        self.row = 0
-        while self.is_scanning and self.row<len(self.ys):
-            # Note the time at which the row starts
-            self.time_row_start = time.time()
-            _debug('Sssssssnake Row ', self.row)
-        
-            # Get the voltrage in Y
-            Vy = self.ys[self.row]
-            
-            # Note the order of the index to scan depending on which row we 
-            # have for doing the snake scan.
-            if self.row%2 == 0:
-                i_s = range(len( self.xs ))
-            else:
-                i_s  = np.flip(range(len( self.xs )))
-            
-            # Scan this set of index
-            for i in i_s:
-                
-                # Get the voltage in x
-                Vx = self.xs[i]
-                
-                # Update the voltage of the AOs
-                self.list_AOs = [self.AOx, self.AOy, self.AOz]
-                self.list_Vs = [Vx, Vy, self.Vz]
-                self.fpga.prepare_AOs(self.list_AOs, self.list_Vs)
-                
-                # Get the count, finally ;) 
-                # Two step: runt he pulse pattern and get the counts. 
-                self.fpga.run_pulse() # This will also write the AOs
-                self.counts =  self.fpga.get_counts()[0]
-                self.counts_per_sec = 1e3*self.counts/self.count_time_ms
-                
-                # Since zero is boring, let's add something
-    #                image = self.counts + np.random.poisson( np.abs(1000*np.cos(Vx*Vy*0.5)) )
-    #                self.Z[self.row][i]= image
-                self.Z[self.row][i] = self.counts_per_sec
-
-
-                   
-            # Update the image after each row   
-            self.update_image()
-            
-            # Note how much time it takes for the row
-            self.time_row_elapsed = time.time() - self.time_row_start
-            
-            # Update the progress bar
-            progress = 100*(self.row+1)/len(self.ys)
-            self.progress_bar.setValue(progress)
-            # Update the label for the progress
-            nb_row_remaining = len(self.ys) - (self.row+1)
-            sec = self.time_row_elapsed*nb_row_remaining
-            self.label_progress.set_text('Time remaining: %.2f s'%sec)
-            
-            # Update the row for the next iteration
-            self.row +=1
-            # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
-            self.process_events()    
-
+        self.scan_batches(scan_order.snake(self.Nx, self.Ny))
+        
     def scan_random_points(self):
         """
         This scans random points on the map. 
+        The order is a random permutation of all the points, computed once. 
+        The image is updated after each batch of Nx points. 
         """
         _debug('GUIMap: scan_random_points')
-        
-        self.Ntotal = self.Nx*self.Ny # Total number of point to scan
-        # create a list for labelling ALL the points
-        self.list_pts = range(self.Ntotal) # This 
-        
-        # Scan until all the points got scanned
-        self.iteration = 0
-        while self.is_scanning and len(self.list_pts)>0:
             
-            # Note the time at which a batch starts
-            self.time_row_start = time.time()
-            self.iteration +=1 
-            _debug('GUIMap: scan_random_points', self.iteration)
-            
-            # To speed up, do batches before updating
-            for i in range(self.Nx):
-                # Pick a random number
-                self.pt_choosen = np.random.choice(self.list_pts)
-                # Extract the corresponding row and column
-                self.row    = int(self.pt_choosen/self.Nx) 
-                self.column = int(self.pt_choosen - self.Nx*self.row)
-                # Delete this number from the list for the next pickup
-                self.index_to_delete = np.where(self.list_pts==self.pt_choosen)[0][0]
-                self.list_pts = np.delete(self.list_pts, self.index_to_delete)
-#                # for debugging
-#                print('self.index_to_delete = ',self.index_to_delete)
-#                print('len(self.list_pts) = ',len(self.list_pts))
-                
-                # Get the voltrage in Y
-                Vy = self.ys[self.row]            
-                # Get the voltage in x
-                Vx = self.xs[self.column]        
-
-                # Update the voltage of the AOs
-                self.list_AOs = [self.AOx, self.AOy, self.AOz]
-                self.list_Vs = [Vx, Vy, self.Vz]
-                self.fpga.prepare_AOs(self.list_AOs, self.list_Vs)
-                
-                # Get the count, finally ;) 
-                # Two step: runt he pulse pattern and get the counts. 
-                self.fpga.run_pulse() # This will also write the AOs
-                self.counts =  self.fpga.get_counts()[0]
-                self.counts_per_sec = 1e3*self.counts/self.count_time_ms
-                
-#                # Since zero is boring, let's add something
-#                image =  100+np.random.poisson( np.abs(10000*np.cos(Vx*Vy*0.5)) )
-#                self.Z[self.row][self.column]= image
-                
-                self.Z[self.row][self.column] = self.counts_per_sec     
-                
-                   
-            # Update the image after each row   
-            self.update_image()
-            
-            # Note how much time it takes for the row
-            self.time_row_elapsed = time.time() - self.time_row_start
-            
-            # Update the progress bar
-            progress = 100*(self.iteration)/self.Ny
-            self.progress_bar.setValue(progress)
-            # Update the label for the progress
-            nb_iter_remaining = self.Ny - self.iteration # Number of iteration remaining
-            sec = self.time_row_elapsed*nb_iter_remaining
-            self.label_progress.set_text('Time remaining: %.2f s'%sec)
-            
-            # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
-            self.process_events()    
-
+        self.scan_batches(scan_order.random_points(self.Nx, self.Ny))
             
     def scan_diagonal_sweep(self):
         """
-        This scans by sweeping in diagonal. 
-        
-        #TODO complete this ! Scan the other half and deal with different
-        # Size for x and y
+        This scans by sweeping in diagonal, from one corner to the opposite 
+        one. The image is updated after each diagonal. 
         """
         _debug('GUIMap: scan_diagonal_sweep')
-        
-        #Note the sizes
-        Nx = len(self.xs)
-        Ny = len(self.ys)
-
-        # Note the indices to scan
-        i_s = range(Nx)
-        j_s = range(Ny)
-        
-        # Estimate the total area for the progress bar
-        total_area = Nx*Ny 
-
-        # Note the time at which we start
-        self.time_start = time.time()
-            
-        # Start the scan
-        self.diagonal = 0
-        # Scan each diagonal
-        while self.is_scanning and self.diagonal<Ny:
-
-            
-            _debug('Diagonal :D ', self.diagonal)
-            # Do the diagonal !
-            for k in range(self.diagonal+1):
-                i = i_s[k]
-                j = j_s[self.diagonal-k]
                 
-                Vx = self.xs[i]
-                Vy = self.ys[j]
-                
-                # Update the voltage of the AOs
-                self.list_AOs = [self.AOx, self.AOy, self.AOz]
-                self.list_Vs = [Vx, Vy, self.Vz]
-                self.fpga.prepare_AOs(self.list_AOs, self.list_Vs)
-                
-                # Get the count, finally ;) 
-                # Two step: runt he pulse pattern and get the counts. 
-                self.fpga.run_pulse() # This will also write the AOs
-                self.counts =  self.fpga.get_counts()[0]
-                self.counts_per_sec = 1e3*self.counts/self.count_time_ms
-                
-                # Since zero is boring, let's add something
-#                image = self.counts + np.random.poisson( np.abs(1000*np.cos(Vx*Vy*0.5)) )
-#                self.Z[j][i]= 100+np.random.poisson( np.abs(10000*np.cos(Vx*Vy*0.5)) )
-                self.Z[j][i] = self.counts_per_sec         
-                
-                
-                    
-            # Update the image after each row   
-            self.update_image()
-            
-            # Note how much time it tooks so far
-            self.time_elapsed = time.time() - self.time_start
-            
-            # Updathe the labels
-            # Update the progress bar
-            area_swept = (self.diagonal+1)**2/2
-            progress = 100*area_swept/total_area
-            self.progress_bar.setValue(progress)
-            # Update the label for the progress
-            t_tot = self.time_elapsed*total_area/area_swept
-            t_remaining=  t_tot - self.time_elapsed
-            self.label_progress.set_text('Time remaining: %.2f s / %.2f'%(t_remaining,t_tot))
-            
-            # Update the row for the next iteration
-            self.diagonal +=1
-            # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
-            self.process_events()    
-            
+        self.scan_batches(scan_order.diagonal_sweep(self.Nx, self.Ny))
             
     def scan_spiral(self):
         """
         This scans by following a spiral. 
         It starts at the middle, than whirl around the image lol. 
+        The image is updated after each turn of the spiral. 
+        """
+        _debug('GUIMap: scan_spiral')
         
+        self.scan_batches(scan_order.spiral(self.Nx, self.Ny))
+        
+    def scan_progressive(self):
+        """
+        This scans a coarse grid first, then refines it by scanning the 
+        pixels in between, with a stride twice smaller each time. 
+        While the finer grid is scanned, the image shows the coarse grid 
+        upsampled, such that we can stop as soon as we see what we want. 
         """
-        _debug('GUIMap: scan_row_spiral')
+        _debug('GUIMap: scan_progressive')
+        
+        self.strides = scan_order.coarse_to_fine_strides(self.Nx, self.Ny)
+        self.scan_batches(scan_order.coarse_to_fine(self.Nx, self.Ny))
         
-        #Note the sizes
-        Nx = len(self.xs)
-        Ny = len(self.ys)
+    def scan_adaptive(self):
+        """
+        This scans a coarse grid, then refines only the cells that are 
+        brighter than the background or have a gradient (quadtree). The count 
+        time of the refined pixels is set by the signal to noise ratio of the 
+        contrast with the background. 
+        The pixels not scanned show the value of the closest scanned pixel of 
+        a coarser grid. 
+        See scan_order.quadtree for the details. 
+        """
+        _debug('GUIMap: scan_adaptive')
         
-        # Note the indices to scan
-        i_s = range(Nx)
-        j_s = range(Ny)
+        stride_max = self.treeDic_settings['Adaptive/Coarse_step']
+        self.strides = scan_order.coarse_to_fine_strides(self.Nx, self.Ny, stride_max)
+        batches = scan_order.quadtree(self.Nx, self.Ny, self.Z, self.measured,
+                                      self.count_time_ms, 
+                                      stride_max=stride_max,
+                                      nb_sigma=self.treeDic_settings['Adaptive/Nb_sigma'],
+                                      snr=self.treeDic_settings['Adaptive/SNR'],
+                                      max_dwell_factor=self.treeDic_settings['Adaptive/Max_count_time_factor'])
+        self.scan_batches(batches)
+        # Put back the usual count time
+        self.prepare_count_time(self.treeDic_settings['Count_time'])
         
-        # Starting point
-        i_start = int(Nx/2)
-        j_start = int(Ny/2)
+    def get_image_shown(self):
+        """
+        Return the image to show during the scan. 
+        For the progressive and adaptive scans, the pixels not measured yet 
+        take the value of the closest measured pixel of a coarser grid. 
+        Otherwise, it is just self.Z. 
+        """
+        if self.strides is None or self.measured is None:
+            return self.Z
+        if np.all(self.measured):
+            return self.Z
+        return scan_order.fill_from_strides(self.Z, self.measured, self.strides)
         
+    def scan_batches(self, batches):
+        """
+        Scan the pixels given by the batches, in order. This is the 
+        acquisition loop shared by all the scanning modes. 
         
+        The acquisition runs in a worker thread (see acquire_batches), which 
+        writes in self.Z. Meanwhile, this method keeps the GUI alive and 
+        refreshes the image at the refresh rate, only when new pixels arrived. 
         
+        batches:
+            List of tuple (rows, columns) of indices to scan, as given by the 
+            functions in scan_order.py. A batch can also be 
+            (rows, columns, count_time_ms) for changing the count time. 
+            This can also be a generator (like scan_order.quadtree), which is 
+            then run in the worker thread. 
+        """
+        _debug('GUIMap: scan_batches')
         
-        # Start the scan
-        self.row = 0
-        while self.is_scanning and self.row<len(self.ys):
-            # Note the time at which the row starts
-            self.time_row_start = time.time()
+        # For the progress bar
+        if type(batches) == list:
+            self.nb_total = sum([len(batch[0]) for batch in batches])
+        else:
+            # We don't know in advance, so it is the maximum 
+            self.nb_total = self.Nx*self.Ny
+        self.nb_done  = 0
+        # Region of self.Z not shown yet [row_min, row_max, col_min, col_max]
+        self.dirty_region = None
+        self.lock_dirty = threading.Lock()
+        self.acquisition_error = None
+        # Show the empty image once, with the axis and colormap. 
+        # The refreshes during the scan only change the pixels. 
+        self.update_image()
+        self.levels = None
+        
+        # Note the time at which we start
+        self.time_start = time.time()
+        
+        # Go for the acquisition
+        self.worker = threading.Thread(target=self.acquire_batches, args=(batches,))
+        self.worker.start()
+        
+        period = 1/self.treeDic_settings['Refresh_rate']
+        time_last_refresh = time.time()
+        while self.worker.is_alive():
+            # Allow the GUI to update. This is important to avoid freezing of 
+            # the GUI. Clicking on stop sets is_scanning to False, which stops 
+            # the worker
+            self.process_events()  
+            if time.time() - time_last_refresh >= period:
+                time_last_refresh = time.time()
+                self.refresh_image()
+            time.sleep(0.005)
+        self.worker.join()
+        
+        # Show the last pixels
+        self.refresh_image()
+        if not(self.acquisition_error is None):
+            print('ERROR: the scan stopped because of ', self.acquisition_error)
             
-            _debug('Spiral ! ')
-            print('THIS IS NOT IMPLEMENTED LOL')
-            time.sleep(0.2)
+    def acquire_batches(self, batches):
+        """
+        Acquire the counts for each pixel of the batches and write them in 
+        self.Z. This runs in the worker thread started by scan_batches, so it 
+        must not touch the GUI. 
+        Each pixel holds the lock of the fpga, such that the GUIs (this one 
+        and the others sharing the fpga) only drive it between two pixels, 
+        like when the scan was in the GUI thread. 
+        
+        batches:
+            Same as in scan_batches. 
+        """
+        _debug('GUIMap: acquire_batches')
+        
+        self.list_AOs = [self.AOx, self.AOy, self.AOz]
+        
+        try:
+            for batch in batches:
+                rows, columns = batch[0], batch[1]
+                # Change the count time if asked
+                if len(batch)>2 and batch[2] != self.count_time_ms:
+                    with self.fpga.lock:
+                        self.prepare_count_time(batch[2])
+                # The voltages of the whole batch at once
+                Vxs = self.xs[columns]
+                Vys = self.ys[rows]
             
-                    
-            # Update the image after each row   
-            self.update_image()
+                nb_acquired = 0 # Less than the batch if the scan is stopped
+                for k in range(len(rows)):
+                    if not(self.is_scanning):
+                        break
+                    with self.fpga.lock:
+                        # Update the voltage of the AOs
+                        self.fpga.prepare_AOs(self.list_AOs, [Vxs[k], Vys[k], self.Vz])
+                        # Get the count, finally ;) 
+                        # Two step: runt he pulse pattern and get the counts. 
+                        self.fpga.run_pulse() # This will also write the AOs
+                        counts =  self.fpga.get_counts()[0]
+                    row, column = rows[k], columns[k]
+                    self.Z[row][column] = 1e3*counts/self.count_time_ms
+                    self.measured[row][column] = True
+                
+                    # Note which part of the image changed
+                    with self.lock_dirty:
+                        d = self.dirty_region
+                        if d is None:
+                            self.dirty_region = [row, row, column, column]
+                        else:
+                            if row    < d[0]: d[0] = row
+                            if row    > d[1]: d[1] = row
+                            if column < d[2]: d[2] = column
+                            if column > d[3]: d[3] = column
+                        self.nb_done += 1
+                    nb_acquired = k + 1
+                # Write the pixels acquired in the stack (only them, such that 
+                # the pixels marked as measured are the ones written)
+                if not(self.stack is None) and nb_acquired > 0:
+                    rows_acquired    = np.asarray(rows[:nb_acquired])
+                    columns_acquired = np.asarray(columns[:nb_acquired])
+                    self.stack.write_pixels(self.index_stack_slice, 
+                                            rows_acquired, columns_acquired, 
+                                            self.Z[rows_acquired, columns_acquired])
+                with self.lock_dirty:
+                    # The whole image may change when a refinement is done 
+                    if not(self.strides is None):
+                        self.dirty_region = [0, self.Ny-1, 0, self.Nx-1]
+                if not(self.is_scanning):
+                    return
+        except Exception as e:
+            # The GUI thread will tell
+            self.acquisition_error = e
+                
+    def refresh_image(self):
+        """
+        Show the pixels acquired since the last refresh. 
+        Lighter than update_image: the view is not re-ranged, the colormap 
+        is not recomputed and the levels are only widened with the new pixels. 
+        """
+        _debug('GUIMap: refresh_image')
+                
+        # Take the region that changed and forget it
+        with self.lock_dirty:
+            region = self.dirty_region
+            self.dirty_region = None
+            nb_done = self.nb_done
+        if region is None:
+            # Nothing new
+            return
             
-            # Note how much time it takes for the row
-            self.time_row_elapsed = time.time() - self.time_row_start
+        # Widen the levels with the new pixels
+        image = self.get_image_shown()
+        new = image[region[0]:region[1]+1, region[2]:region[3]+1]
+        if self.levels is None:
+            self.levels = [np.min(new), np.max(new)]
+        else:
+            self.levels = [min(self.levels[0], np.min(new)),
+                           max(self.levels[1], np.max(new))]
+        # Same scale and position as set in update_image
+        self.plot_image.getImageItem().setImage(image.T, autoLevels=False)
+        if self.levels[1] > self.levels[0]:
+            self.plot_image.setLevels(*self.levels)
             
-            # Update the progress bar
-            progress = 100*(self.row+1)/len(self.ys)
-            self.progress_bar.setValue(progress)
-            # Update the label for the progress
-            nb_row_remaining = len(self.ys) - (self.row+1)
-            sec = self.time_row_elapsed*nb_row_remaining
+        # Update the progress bar
+        self.time_elapsed = time.time() - self.time_start
+        progress = 100*nb_done/self.nb_total
+        self.progress_bar.setValue(int(progress))
+        # Update the label for the progress
+        if nb_done>0:
+            sec = self.time_elapsed*(self.nb_total - nb_done)/nb_done
             self.label_progress.set_text('Time remaining: %.2f s'%sec)
             
-            # Update the row for the next iteration
-            self.row +=1
-            # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
-            self.process_events()    
-            
     def pos_ptROI_changed(self):
         """
         When the centre ROI change.
@@ -1174,6 +1356,17 @@ class GUIMap(egg.gui.Window):
         """           
         return
         
+    def event_spot_visited(self, spot):
+        """
+        Dummy function to be overrid. 
+        
+        It is called when we arrive on a NV found on the map. 
+        
+        spot:
+            Dictionary of the NV (see spot_finder.find_spots)
+        """           
+        return
+        
       
         
 class PersonalColorMap():
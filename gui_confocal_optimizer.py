@@ -18,6 +18,8 @@ _p = traceback.print_last #Very usefull command to use for getting the last-not-
 
 
 from converter import Converter # For converting the pattern for counting
+from psf_optimizer import PSFOptimizer3D # For optimizing with less points
+from drift_tracker import DriftTracker # For remembering the optimizations and following the drift
 
 # Debug stuff.
 _debug_enabled     = False
@@ -55,6 +57,9 @@ class GUIOptimizer(egg.gui.Window):
         self.fpga = fpga
         
         self.is_optimizing = False # Weither or not we are optimizing
+        self.nb_runs = 0 # Number of FPGA runs of the last optimization
+        # History of the optimizations, and the drift learned from it
+        self.drift_tracker = DriftTracker('optimization_history.txt')
 
         # Fill up the GUI 
         self.initialize_GUI()
@@ -95,6 +100,11 @@ class GUIOptimizer(egg.gui.Window):
         self.treeDic_settings.add_parameter('Usual/Scan_points', 25, 
                                            type='int', step=1, 
                                            bounds=[3, None])
+        self.treeDic_settings.add_parameter('Usual/Engine', 0, 
+                                           type='list', 
+                                           values=['1D_scans', 'PSF_fit'],
+                                           tip='1D_scans: scan x, then y, then z and fit a parabola on each.\n'+
+                                               'PSF_fit: measure a few points in 3D and fit a gaussian spot, until the position is known within the tolerances.')
         # THe next three are for the offsets voltages if we want to optimize
         # elsewehre than the position probed. 
         self.treeDic_settings.add_parameter('Usual/Offset_Vx', 0, 
@@ -110,6 +120,39 @@ class GUIOptimizer(egg.gui.Window):
                                            bounds=[-20,20], suffix=' V',
                                            tip='Z_opt - Z_probe')
         
+        # The next parameters are for the PSF_fit engine
+        self.treeDic_settings.add_parameter('PSF/Sigma_xy', 0.02, 
+                                           type='float', step=0.005, 
+                                           bounds=[0,None], suffix=' V',
+                                           tip='Standard deviation of the spot of a NV in x and y.')
+        self.treeDic_settings.add_parameter('PSF/Sigma_z', 0.05, 
+                                           type='float', step=0.005, 
+                                           bounds=[0,None], suffix=' V',
+                                           tip='Standard deviation of the spot of a NV in z.')
+        self.treeDic_settings.add_parameter('PSF/Tolerance_xy', 0.003, 
+                                           type='float', step=0.001, 
+                                           bounds=[0,None], suffix=' V',
+                                           tip='Stop when the uncertainty on x and y is below this.')
+        self.treeDic_settings.add_parameter('PSF/Tolerance_z', 0.008, 
+                                           type='float', step=0.001, 
+                                           bounds=[0,None], suffix=' V',
+                                           tip='Stop when the uncertainty on z is below this.')
+        self.treeDic_settings.add_parameter('PSF/Max_runs', 60, 
+                                           type='int', step=1, 
+                                           bounds=[7,None], 
+                                           tip='Maximum number of points, whatever the uncertainty.')
+        
+        # The next parameters are for following the drift between the optimizations
+        for axis in ['x', 'y', 'z']:
+            self.treeDic_settings.add_parameter('Drift/Pre_shift_'+axis, False, 
+                                               type='bool',
+                                               tip='Shift the AO %s between the optimizations, where the drift model predicts the NV.\n'%axis+
+                                                   'This is done when apply_drift_correction is called, for example between the loops of a pulse sequence.\n'+
+                                                   'Only worth it on an axis that drifts steadily (usually z): elsewhere it adds the noise of the optimizations.')
+        self.treeDic_settings.add_parameter('Drift/Narrow_ranges', False, 
+                                           type='bool',
+                                           tip='Optimize on a smaller range than the usual one when the drift model predicts well the position.')
+        
         # The next parameters are used only for automatic optimization during
         # Pulse sequences or something else. 
         self.treeDic_settings.add_parameter('Automatic/Threshold_fraction', 0.95, 
@@ -117,6 +160,9 @@ class GUIOptimizer(egg.gui.Window):
                                            bounds=[0,None], 
                                            tip='Like in Labview')    
 
+        # A label for the result of the last optimization
+        self.label_info = self.place_object(egg.gui.Label(''), row=6, column=0, column_span=2)
+
         # Add a table for showing the selected R_probed and R_optimize
         self.table_Rs  = egg.gui.Table()
         self.place_object(self.table_Rs, row=2, column=0, column_span=2) 
@@ -375,6 +421,7 @@ class GUIOptimizer(egg.gui.Window):
             # Two step: runt he pulse pattern and get the counts. 
             self.fpga.run_pulse() # This will also write the AOs
             self.counts =  self.fpga.get_counts()[0]
+            self.nb_runs += 1
             
 #            # FOR TESTING ONLY Add some fake to the data
 #            self.counts+= np.random.poisson(1000-200*(V-self.V0)**2/(self.Vmax-self.V0)**2)
@@ -423,6 +470,7 @@ class GUIOptimizer(egg.gui.Window):
             self.event_fpga_change()                
             
             self.fit_worked = True
+            self.sigma_best = np.sqrt(np.abs(self.pcov[0][0]))
             
         except:
             _debug('GUIOptimizer: find_max: Cannot fit!')
@@ -430,6 +478,7 @@ class GUIOptimizer(egg.gui.Window):
             self.fit_worked = False
             # Still not the best V, for keeping track of it..
             self.v_best = self.V0 
+            self.sigma_best = np.nan
             
         _debug('GUIOptimizer: find_max: v_best = ', self.v_best)
  
@@ -465,12 +514,49 @@ class GUIOptimizer(egg.gui.Window):
         # Prepare the pulse sequence for getting the counts
         self.prepare_acquisition_pulse()
         
+        # Ranges on which to optimize
+        self.ranges = np.array([self.treeDic_settings['Usual/Range_Vx'],
+                                self.treeDic_settings['Usual/Range_Vy'],
+                                self.treeDic_settings['Usual/Range_Vz']])
+        ranges_usual = self.ranges.copy()
+        if self.treeDic_settings['Drift/Narrow_ranges']:
+            self.ranges = self.drift_tracker.get_ranges(self.ranges)
+        
+        self.nb_runs = 0
+        if self.treeDic_settings['Usual/Engine'] == 'PSF_fit':
+            self.run_optimizing_psf()
+        else:
+            self.run_optimizing_1D()
+            
+        # Remember the result, if the optimization went to the end
+        if self.is_optimizing:
+            r_best = [self.fpga.get_AO_voltage(AO) for AO in [self.AOx, self.AOy, self.AOz]]
+            self.drift_tracker.add_optimization(r_best, self.counts_best, self.sigmas_best,
+                                                distance_jump=ranges_usual)
+        self.label_info.set_text('Last optimization: %d FPGA runs\n'%self.nb_runs+
+                                 self.drift_tracker.get_info())
+        
+        if self.is_optimizing:
+            # Will stop optimizing and uptage the button
+            self.button_optimize_clicked()
+
+        # Important: Remove the offsets
+        self.offset_remove_them()
+        
+    def run_optimizing_1D(self):
+        """
+        Optimize with a 1D scan along each direction, one after the other. 
+        """
+        _debug('GUIOptimizer: run_optimizing_1D') 
+        
+        self.sigmas_best = [np.nan]*3
+        
         # Optimize the X direction
         self.AO = self.AOx
         # The center voltage will be the actual voltage
         self.V0 = self.fpga.get_AO_voltage(self.AO) 
-        self.Vmin = self.V0 - self.treeDic_settings['Usual/Range_Vx']/2
-        self.Vmax = self.V0 + self.treeDic_settings['Usual/Range_Vx']/2
+        self.Vmin = self.V0 - self.ranges[0]/2
+        self.Vmax = self.V0 + self.ranges[0]/2
         # Trigger the scan
         self.scan_1D()
         # Process the scan only if it wasn't interrupted
@@ -480,14 +566,15 @@ class GUIOptimizer(egg.gui.Window):
             # Update the plots
             self.update_plot_fit(self.plot_fit_x)   
             self.update_plot_position('x')
+            self.sigmas_best[0] = self.sigma_best
             
         
         # Optimize the Y direction
         self.AO = self.AOy
         # The center voltage will be the actual voltage
         self.V0 = self.fpga.get_AO_voltage(self.AO)
-        self.Vmin = self.V0 - self.treeDic_settings['Usual/Range_Vy']/2
-        self.Vmax = self.V0 + self.treeDic_settings['Usual/Range_Vy']/2
+        self.Vmin = self.V0 - self.ranges[1]/2
+        self.Vmax = self.V0 + self.ranges[1]/2
         # Trigger the scan
         self.scan_1D()
         # Process the scan only if it wasn't interrupted
@@ -497,13 +584,14 @@ class GUIOptimizer(egg.gui.Window):
             # Update the plots
             self.update_plot_fit(self.plot_fit_y) 
             self.update_plot_position('y')
+            self.sigmas_best[1] = self.sigma_best
 
         # Optimize the Z direction
         self.AO = self.AOz
         # The center voltage will be the actual voltage
         self.V0 = self.fpga.get_AO_voltage(self.AO)        
-        self.Vmin = self.V0 - self.treeDic_settings['Usual/Range_Vz']/2
-        self.Vmax = self.V0 + self.treeDic_settings['Usual/Range_Vz']/2
+        self.Vmin = self.V0 - self.ranges[2]/2
+        self.Vmax = self.V0 + self.ranges[2]/2
         # Trigger the scan
         self.scan_1D()
         # Process the scan only if it wasn't interrupted
@@ -513,13 +601,96 @@ class GUIOptimizer(egg.gui.Window):
             # Update the plots 
             self.update_plot_fit(self.plot_fit_z)
             self.update_plot_position('z')
+            self.sigmas_best[2] = self.sigma_best
+            # Counts on the NV
+            if self.fit_worked:
+                self.counts_best = self.popt[2]
+            else:
+                self.counts_best = np.max(self.count_array)
+        
+    def run_optimizing_psf(self):
+        """
+        Optimize by fitting a 3D gaussian spot on a few points. 
+        The points are chosen one by one, where they bring the most 
+        information, until the position is known within the tolerances. 
+        See psf_optimizer.py
+        """
+        _debug('GUIOptimizer: run_optimizing_psf') 
+
+        list_AOs = [int(self.AOx), int(self.AOy), int(self.AOz)]
+        r_start = [self.fpga.get_AO_voltage(AO) for AO in list_AOs]
+        ranges = self.ranges
+        sigmas = [self.treeDic_settings['PSF/Sigma_xy'],
+                  self.treeDic_settings['PSF/Sigma_xy'],
+                  self.treeDic_settings['PSF/Sigma_z']]
+        tolerances = [self.treeDic_settings['PSF/Tolerance_xy'],
+                      self.treeDic_settings['PSF/Tolerance_xy'],
+                      self.treeDic_settings['PSF/Tolerance_z']]
+        self.psf_optimizer = PSFOptimizer3D(r_start, sigmas, ranges, tolerances, 
+                                            nb_max=self.treeDic_settings['PSF/Max_runs'])
+        
+        while self.is_optimizing and not(self.psf_optimizer.is_done()):
+            r = self.psf_optimizer.get_next_point()
+            self.fpga.prepare_AOs(list_AOs, list(r))
+            # Two step: runt he pulse pattern and get the counts. 
+            self.fpga.run_pulse() # This will also write the AOs
+            self.counts = self.fpga.get_counts()[0]
+            self.nb_runs += 1
+            self.psf_optimizer.add_point(r, self.counts)
+            # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
+            self.process_events()   
+            # Call the event to say "hey, stuff changed on the fpga"
+            self.event_fpga_change()     
+        
+        if not(self.is_optimizing):
+            # Interrupted. Go back where we were
+            self.fpga.prepare_AOs(list_AOs, r_start)
+            self.event_fpga_change()
+            return
+        
+        # Go on the NV
+        r_best = self.psf_optimizer.get_position()
+        self.counts_best = self.psf_optimizer.get_rate_model(r_best)[0]
+        self.sigmas_best = self.psf_optimizer.get_uncertainty()
+        self.fpga.prepare_AOs(list_AOs, list(r_best))
+        self.event_fpga_change()
+        
+        # Update the plots
+        for i, axis in enumerate(['x', 'y', 'z']):
+            self.v_best = r_best[i]
+            self.update_plot_psf([self.plot_fit_x, self.plot_fit_y, self.plot_fit_z][i], i)
+            self.update_plot_position(axis)
+            
+    def update_plot_psf(self, plot, index_axis):
+        """
+        Plot the points measured by the PSF_fit engine along one axis, with 
+        the fitted spot going through the best position. 
         
-        if self.is_optimizing:
-            # Will stop optimizing and uptage the button
-            self.button_optimize_clicked()
-
-        # Important: Remove the offsets
-        self.offset_remove_them()
+        plot:
+            "self.win_plot_fits.addPlot" object that we want to update. 
+        index_axis:
+            0, 1 or 2 for x, y or z.
+        """
+        _debug('GUIOptimizer: update_plot_psf') 
+        
+        opt = self.psf_optimizer
+        plot.clear() 
+        plot.addLegend() 
+        points = np.array(opt.points)
+        plot.plot(points[:,index_axis], opt.counts, pen=None, symbol='o', 
+                  symbolBrush=(255,255,255), name='Data (all points)')
+        if opt.params is None:
+            return
+        # Cut of the spot along the axis
+        r_best = opt.get_position()
+        Vs = np.linspace(opt.r_min[index_axis], opt.r_max[index_axis], 100)
+        points_cut = np.tile(r_best, (len(Vs), 1))
+        points_cut[:,index_axis] = Vs
+        plot.plot(Vs, opt.get_rate_model(points_cut), pen=(255,0,255), name='Fit')
+        uncertainty = opt.get_uncertainty()
+        text = 'Best' if uncertainty is None else 'Best +- %.4f V'%uncertainty[index_axis]
+        plot.plot([r_best[index_axis]], opt.get_rate_model(r_best), symbolBrush=(255,0,255), 
+                  symbolPen='w', symbol='o', symbolSize=14, name=text)
         
     def update_plot_fit(self, plot):
         """
@@ -587,6 +758,34 @@ class GUIOptimizer(egg.gui.Window):
                                                      ['Number of Optimization','Vz']).plot()
         
 
+    def apply_drift_correction(self):
+        """
+        Shift the AOs by the drift predicted since the last call (or since 
+        the last optimization). 
+        Only the axes with Drift/Pre_shift_x (y, z) on are shifted, and only 
+        if their drift velocity is significant. The new AOs are only 
+        prepared: they are written at the next run of the fpga. 
+        """
+        _debug('GUIOptimizer: apply_drift_correction')
+        
+        if self.is_optimizing:
+            return
+        # Always take the correction, such that it doesn't accumulate while 
+        # the pre-shift is off.
+        shift = self.drift_tracker.get_correction()
+        shift = shift*[self.treeDic_settings['Drift/Pre_shift_'+axis] for axis in ['x', 'y', 'z']]
+        if np.all(shift == 0):
+            return
+        
+        if not(hasattr(self, 'AOx')):
+            self.steal_AO_info()
+        list_AOs = [int(self.AOx), int(self.AOy), int(self.AOz)]
+        list_Vs = [self.fpga.get_AO_voltage(AO) + shift[i] for i, AO in enumerate(list_AOs)]
+        self.fpga.prepare_AOs(list_AOs, list_Vs)
+        
+        # Call the event to say "hey, stuff changed on the fpga"
+        self.event_fpga_change()  
+        
     def update_GUI_with_fpga(self):
         """
         Update the gui such that the widgets match with the fpga. 
@@ -12,11 +12,19 @@ from prepare_mag_sweep_lines import plot_magSweepLinesSettings
 import spinmob     as _s
 from spinmob import egg
 import time
+import os
 import mcphysics   as _mp
 import numpy as np
 from converter import Converter # This convert the sequence object into fpga data
 import api_fpga as _fc # For using the FPGA
 import gui_confocal_optimizer #For sing the optimizer
+from optimize_policy import DriftOptimizePolicy # For deciding when to optimize
+from actuator_poller import ActuatorPoller # For reading the actuators in parallel
+from trajectory_model import LineTrajectory # For predicting the positions along a line
+from path_planner import order_points, order_lines, get_path_duration # For visiting the positions in a short time
+from sweep_result import SweepResult # For the live map of the sweep
+from sweep_storage import SweepWriter, SweepReader, COLUMNS # For saving the sweep line by line
+from adaptive_sweep import AdaptiveSweepPlanner # For sweeping finely around the features
 
 import traceback
 _p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
@@ -145,12 +153,10 @@ class GUISingleActuator(_mp.visa_tools.visa_gui_base):
         """
         _debug('GUISingleActuator._button_move_toggled()')
         
-        #Set the velocity
+        #Set the velocity and the position, in one batch
         v = self.settings['Motion/Speed'] #Extract the velocity from the parameters
-        self.api.set_velocity(v)
-        #Set the position
         r = self.settings['Motion/Target_position'] #Extract the position from the parameters
-        self.api.set_position_abs(r)
+        self.api.move_to(r, v)
         
         #Start to udpate
         self.timer_moving.start()
@@ -173,18 +179,20 @@ class GUISingleActuator(_mp.visa_tools.visa_gui_base):
         
         #Update only if the api exist
         if self.api != None: 
+            # Ask both at once
+            position, state = self.api.get_position_and_state()
             #Update the position of the actuator.
-            strpos = 'Position = ' + str(self.api.get_position()) + ' mm'
+            strpos = 'Position = ' + str(position) + ' mm'
             self.label_position.set_text(strpos)
             _debug(strpos) 
             #Update the state         
-            strState = 'State = ' + self.api.get_state()
+            strState = 'State = ' + state
             self.label_state.set_text(strState)
             _debug(strState) 
             
             #If the actuator doesn't move or is not homing. 
-            cond1 = 'MOVING' == self.api.get_state()
-            cond2 = 'HOMING' == self.api.get_state()
+            cond1 = 'MOVING' == state
+            cond2 = 'HOMING' == state
             if not(cond1 or cond2):
                 #Stop to trigger the update with the timer
                 self.timer_moving.stop()
@@ -356,6 +364,14 @@ class GUIMagnetSweepLines(egg.gui.Window):
         self.data_w = 0 # This is the 4-dimensional data to take at each magnet posiiont. Example: the photo-counts at each position. 
         self.info_date = 'No scan' # String for the data at which the scan is done
         self.speed = 999 # This gonna be the speed along the line
+        self.duration_predicted = 0 # Predicted duration of the sweep (s)
+        self.writer = None # Writes the lines on the disk while sweeping
+        self.adaptive_planner = None # Plans the fine lines after the coarse sweep
+        self.iter_refine_start = None # First iteration of the fine lines
+        self.is_refined = [] # For each iteration from iter_refine_start, True for a fine line
+        # Decide when to optimize, based on the drop of the counts. 
+        # One value per line is given to it. 
+        self.optimize_policy = DriftOptimizePolicy(N_baseline=2)
         
         # Run the basic stuff for the initialization
         egg.gui.Window.__init__(self, title=name, size=size)
@@ -387,6 +403,12 @@ class GUIMagnetSweepLines(egg.gui.Window):
         self.button_save_sweep = self.place_object(egg.gui.Button('Save sweep :D'),
                                                   2,0, alignment=1)
         self.connect(self.button_save_sweep.signal_clicked, self.button_save_sweep_clicked )
+        #Add a button for continuing a sweep saved on the disk
+        self.button_resume = self.place_object(egg.gui.Button('Resume sweep from disk'),
+                                               3,0, alignment=1)
+        self.connect(self.button_resume.signal_clicked, self.button_resume_clicked )
+        self.button_resume._widget.setToolTip('Select the folder of a sweep saved line by line.\n'+
+                                              'The settings and the lines already swept are loaded, and the sweep continues after them.')
         
         # tree dictionnarry for some settings
         self.treeDic_settings = egg.gui.TreeDictionary(autosettings_path='setting_magSweepLines')
@@ -403,7 +425,80 @@ class GUIMagnetSweepLines(egg.gui.Window):
         self.treeDic_settings.add_parameter('nb_line_before_optimize', 1, 
                                             type='int', 
                                             bounds=[0, None],
-                                            tip='Number of line to sweep before triggering the optimization.\nPut zero for never optimizing')
+                                            tip='Maximum number of line to sweep before triggering the optimization.\nPut zero for no maximum')
+        self.treeDic_settings.add_parameter('drop_threshold', 0.9, 
+                                            type='float', step=0.01,
+                                            bounds=[0, 1],
+                                            tip='Optimize when the counts of a line drop below this fraction of the counts after the last optimization.\nPut zero for only using the maximum number of lines.')
+        self.treeDic_settings.add_parameter('Trajectory/Query_every', 1, 
+                                            type='int', 
+                                            bounds=[1, None],
+                                            tip='Read the positions of the actuators only every this number of points.\n'+
+                                                'In between, the positions are predicted from the time and the speeds.\nPut 1 for reading them at each point.')
+        self.treeDic_settings.add_parameter('Trajectory/Acceleration', 10, 
+                                            type='float', 
+                                            bounds=[0, None], suffix=' mm/s^2',
+                                            tip='Acceleration of the actuators, for predicting the positions.\nPut zero for an instantaneous acceleration.')
+        self.treeDic_settings.add_parameter('Trajectory/Tolerance', 1, 
+                                            type='float', 
+                                            bounds=[0, None], suffix=' um',
+                                            tip='If the readings differ from the prediction by more than this (RMS),\nthe positions are interpolated from the readings instead.')
+        self.treeDic_settings.add_parameter('Stream_to_disk', True,
+                                            type='bool',
+                                            tip='Write each line on the disk as soon as it is swept, in a folder asked at the start.\n'+
+                                                'Nothing is lost if the program crashes, and the sweep can be resumed.')
+        self.treeDic_settings.add_parameter('Live_map/Plane', 0,
+                                            type='list',
+                                            values=['xy', 'yz', 'zx'],
+                                            tip='Plane on which the scanned points are projected for the live map.')
+        self.treeDic_settings.add_parameter('Live_map/Nb_pixels', 100,
+                                            type='int',
+                                            bounds=[2, None],
+                                            tip='Number of pixels on each axis of the live map.')
+        self.treeDic_settings.add_parameter('Live_map/Kernel', 0,
+                                            type='list',
+                                            values=['Gaussian', 'IDW'],
+                                            tip='How the points around each pixel are averaged.\n'+
+                                                'Gaussian: weight exp(-d^2/2sigma^2), with sigma the pixel size.\n'+
+                                                'IDW: weight 1/d^2, with the 8 closest points.')
+        self.treeDic_settings.add_parameter('Live_map/Nb_points_max', 200000,
+                                            type='int',
+                                            bounds=[1000, None],
+                                            tip='Maximum number of points kept in memory for the live map.\n'+
+                                                'Above it, the points close to each other are averaged (the data on the disk stay complete).')
+        self.treeDic_settings.add_parameter('Adaptive/Enable', False,
+                                            type='bool',
+                                            tip='After the lines of the table, sweep finely around the features of the counts (dips and steep parts).\n'+
+                                                'The fine lines are planned when the coarse sweep is done and added to the table.')
+        self.treeDic_settings.add_parameter('Adaptive/Time_budget', 30,
+                                            type='float',
+                                            bounds=[0, None], suffix=' min',
+                                            tip='Maximum time for the fine lines, travel between them included.\n'+
+                                                'The most significant features are taken first.')
+        self.treeDic_settings.add_parameter('Adaptive/Resolution', 0.2,
+                                            type='float',
+                                            bounds=[0.0001, None], suffix=' um',
+                                            tip='Distance between each point to record along the fine lines (same time per point).')
+        self.treeDic_settings.add_parameter('Adaptive/Half_width', 0.2,
+                                            type='float',
+                                            bounds=[0, None], suffix=' mm',
+                                            tip='Each fine line goes from this distance before to this distance after the feature.')
+        self.treeDic_settings.add_parameter('Adaptive/Spacing', 0.05,
+                                            type='float',
+                                            bounds=[0, None], suffix=' mm',
+                                            tip='Distance between the fine lines parallel to the line of the feature.')
+        self.treeDic_settings.add_parameter('Adaptive/Nb_offsets', 2,
+                                            type='int',
+                                            bounds=[0, None],
+                                            tip='Number of parallel fine lines on each side of a feature.\n'+
+                                                'They are in the plane of the sweep if it is flat. None if the sweep is a single line.')
+        self.treeDic_settings.add_parameter('Adaptive/Nb_sigma', 5,
+                                            type='float',
+                                            bounds=[0, None],
+                                            tip='Minimum significance of a feature, in standard deviations of the smoothed counts.')
+        self.treeDic_settings.connect_signal_changed('Live_map/Plane'    , self.update_live_map)
+        self.treeDic_settings.connect_signal_changed('Live_map/Nb_pixels', self.update_live_map)
+        self.treeDic_settings.connect_signal_changed('Live_map/Kernel'   , self.update_live_map)
         # Add a table for the trajectories of the lines. 
         self.table_trajectories  = egg.gui.Table()
         self.place_object(self.table_trajectories, row=6, column=0, column_span=2) 
@@ -428,9 +523,23 @@ class GUIMagnetSweepLines(egg.gui.Window):
         self.place_object(self.button_save_settings,row=4, column=2, alignment=1)
         self.connect(self.button_save_settings.signal_clicked, self.button_save_settings_clicked )
 
+        #Add a button for reordering the lines
+        self.button_optimize_path = egg.gui.Button('Optimize path')
+        self.place_object(self.button_optimize_path,row=4, column=3, alignment=1)
+        self.connect(self.button_optimize_path.signal_clicked, self.button_optimize_path_clicked )
+        self.button_optimize_path._widget.setToolTip('Reorder the lines in the table (and their direction) for spending less time between them.\n'+
+                                                     'The lines are the segments between the rows. The first row stays the start.')
+
         # Add a label
         self.label_info = self.place_object(egg.gui.Label(), 1,2 )
         self.label_info_update() 
+
+        # Map of the counts interpolated from the points scanned so far
+        self.sweep_result = SweepResult()
+        self.plot_item = egg.pyqtgraph.PlotItem()
+        self.plot_image = egg.pyqtgraph.ImageView(view=self.plot_item)
+        self.place_object(self.plot_image, row=5, column=2,
+                          row_span=2, column_span=2, alignment=0)
         
         # Attempt to make the button together
         self.set_row_stretch(6, 10)
@@ -539,7 +648,8 @@ class GUIMagnetSweepLines(egg.gui.Window):
                '\nStatut: '+ self.statut +
                '\nSpeed along line: %f mm/s'%self.speed+
                '\nNumber of lines: %d'%(self.nb_iter-1)+
-               '\nCurrent line: %d'%self.iter)
+               '\nCurrent line: %d'%self.iter+
+               '\nPredicted duration: %.1f min'%(self.duration_predicted/60))
         
         self.label_info.set_text( txt ) 
         
@@ -587,6 +697,90 @@ class GUIMagnetSweepLines(egg.gui.Window):
         # Now save
         self.databox_settings.save_file()
         
+    def get_speed_line(self):
+        """
+        Return the speed (mm/s) along the lines from the settings, like in
+        run_sweep.
+        """
+        # The settings are in um/ms = mm/sec
+        speed = self.treeDic_settings['resolution']/self.treeDic_settings['time_per_point']
+        return min(speed, 2)
+
+    def predict_duration(self, xs, ys, zs):
+        """
+        Return the time (s) for sweeping the lines of the path xs, ys, zs.
+        Every segment between two consecutive points is swept at the speed
+        along the line.
+        """
+        _debug('GUIMagnetSweepLines: predict_duration')
+
+        points = np.transpose([xs, ys, zs])
+        return get_path_duration(points, speeds=[2, 2, 2], # Maximum speed of the actuators
+                                 acceleration=self.treeDic_settings['Trajectory/Acceleration'],
+                                 speed_line=self.get_speed_line())
+
+    def button_optimize_path_clicked(self):
+        """
+        Reorder the lines of the table for sweeping them in less time.
+        """
+        _debug('GUIMagnetSweepLines: button_optimize_path_clicked')
+
+        # Take the path in the table
+        self.databox_setting_update()
+        points = np.transpose([self.databox_settings['xs'],
+                               self.databox_settings['ys'],
+                               self.databox_settings['zs']])
+        if len(points) < 3:
+            return
+        duration_before = self.predict_duration(*points.T)
+
+        # Each segment is a line to sweep. Everything in the path is swept, so
+        # the way between two lines is also a line at the same speed.
+        order, is_flipped = order_lines(points[:-1], points[1:], speeds=[2, 2, 2],
+                                        acceleration=self.treeDic_settings['Trajectory/Acceleration'],
+                                        r_start=points[0], speed_line=self.get_speed_line())
+        new_points = [points[0]]
+        for i, flip in zip(order, is_flipped):
+            r_in, r_out = (points[i+1], points[i]) if flip else (points[i], points[i+1])
+            # Go on the line if we are not already on it
+            if np.any(r_in != new_points[-1]):
+                new_points.append(r_in)
+            new_points.append(r_out)
+        new_points = np.array(new_points)
+
+        self.duration_predicted = self.predict_duration(*new_points.T)
+        if self.duration_predicted < duration_before:
+            self.table_trajectories_fill(*new_points.T)
+        else:
+            # Already good
+            self.duration_predicted = duration_before
+        self.statut = 'Path optimized (%.1f min before)'%(duration_before/60)
+        self.label_info_update()
+
+    def update_live_map(self, *a):
+        """
+        Show the points scanned so far, interpolated on a grid in the plane
+        chosen in the settings.
+        """
+        _debug('GUIMagnetSweepLines: update_live_map')
+
+        if len(self.sweep_result) < 2:
+            return
+        plane = self.treeDic_settings['Live_map/Plane']
+        nb_pts = self.treeDic_settings['Live_map/Nb_pixels']
+        (axis_1, axis_2), W = self.sweep_result.regrid(nb_pts, axes=plane,
+                                                       kernel=self.treeDic_settings['Live_map/Kernel'])
+        # The pixels far from the points have no value. Show them as the minimum
+        if np.all(np.isnan(W)):
+            return
+        W[np.isnan(W)] = np.nanmin(W)
+        scale_1 = max(axis_1[-1] - axis_1[0], 1e-6)/nb_pts
+        scale_2 = max(axis_2[-1] - axis_2[0], 1e-6)/nb_pts
+        self.plot_image.setImage(W, pos=(axis_1[0], axis_2[0]),
+                                 scale=(scale_1, scale_2))
+        self.plot_item.setLabel('bottom', text=plane[0]+' (mm)')
+        self.plot_item.setLabel('left'  , text=plane[1]+' (mm)')
+        
     def button_look_setting_clicked(self):
         """
         Show the lines that the magnet should follow
@@ -629,15 +823,100 @@ class GUIMagnetSweepLines(egg.gui.Window):
             # Add each element of the dictionnary three
             self.databox_save_scan.insert_header(key , self.treeDic_settings[key])        
         # Add each column for the scanned points
-        self.databox_save_scan['xs'] = self.xs_scanned
-        self.databox_save_scan['ys'] = self.ys_scanned
-        self.databox_save_scan['zs'] = self.zs_scanned  
-        self.databox_save_scan['ws'] = self.ws_scanned  
+        for key in COLUMNS:
+            self.databox_save_scan[key] = self.get_scanned(key)
         
         # Pop up the window for saving the data
         self.databox_save_scan.save_file()
         
 
+    def get_scanned(self, key):
+        """
+        Return the column key (see sweep_storage.COLUMNS) of the points
+        scanned so far. They are read from the disk if the sweep is streamed.
+        """
+        if not(self.writer is None):
+            return np.array(SweepReader(self.writer.path).get_column(key))
+        return getattr(self, self.get_list_name(key))
+
+    def get_list_name(self, key):
+        """
+        Return the name of the attribute list that keeps the column key when
+        the sweep is not streamed.
+        """
+        if key.endswith('_measured'):
+            return key
+        return key + '_scanned'
+
+    def button_resume_clicked(self):
+        """
+        Load a sweep saved line by line and prepare to continue it after its
+        last completed line.
+        """
+        _debug('GUIMagnetSweepLines: button_resume_clicked')
+
+        if self.is_running:
+            print('Warning: pause the sweep before resuming another one.')
+            return
+        path = _s.dialogs.select_directory(text='Select the folder of the sweep to resume')
+        if path is None or path == '':
+            return
+        reader = SweepReader(path)
+
+        # Put back the settings of the sweep
+        for key in self.treeDic_settings.get_keys():
+            if key in reader.headers:
+                self.treeDic_settings[key] = reader.headers[key]
+        self.path_setting = reader.headers.get('setting_file', path)
+        self.table_trajectories_fill(reader.headers['xs'],
+                                     reader.headers['ys'],
+                                     reader.headers['zs'])
+        self.databox_setting_update()
+        self.extract_sweep_settings()
+        if reader.headers.get('iter_refine_start') is None:
+            # The fine lines are not planned yet, give the coarse lines swept
+            for i in range(len(reader.lines)):
+                line = reader.get_line(i)
+                self.add_line_to_planner(int(reader.lines[i,0]),
+                                         *[line[:, reader.columns.index(key)] for key in ['xs', 'ys', 'zs', 'ws']])
+        else:
+            self.iter_refine_start = reader.headers['iter_refine_start']
+            self.is_refined = reader.headers['is_refined']
+
+        # Continue after the last line on the disk
+        self.iter = reader.get_last_iteration() + 1
+        if self.iter >= self.nb_iter:
+            print('Warning: this sweep is already finished.')
+            self.iter = 0
+            return
+        self.writer = SweepWriter(path, resume=True)
+        # Line by line, such that the points on the disk are never all in memory
+        self.sweep_result = SweepResult(nb_max=self.treeDic_settings['Live_map/Nb_points_max'])
+        for i in range(len(reader.lines)):
+            line = reader.get_line(i)
+            self.sweep_result.add_points(*[line[:, reader.columns.index(key)] for key in ['xs', 'ys', 'zs', 'ws']])
+        self.update_live_map()
+        for key in COLUMNS:
+            setattr(self, self.get_list_name(key), [])
+        self.writer.add_event(self.iter, 'Resumed')
+
+        # Go where the sweep stopped
+        self.initiate_line_sweep()
+        self.statut = 'Reaching the end of the line %d'%(self.iter-1)
+        self.label_info_update()
+        self.X.settings['Motion/Speed'] = 1 # mm/sec
+        self.Y.settings['Motion/Speed'] = 1 # mm/sec
+        self.Z.settings['Motion/Speed'] = 1 # mm/sec
+        self.magnet.go_to_xyz(self.xs_setting[self.iter-1],
+                              self.ys_setting[self.iter-1],
+                              self.zs_setting[self.iter-1],
+                              want_wait=True)
+        self.statut = 'Resumed at line %d'%self.iter
+        self.label_info_update()
+        self.button_run.set_text('Continue')
+        self.button_run.enable()
+        self.button_run.set_colors(background='green')
+
     def button_reset_clicked(self):
         """
         Reset the iteration and stop the running
@@ -724,6 +1003,21 @@ class GUIMagnetSweepLines(egg.gui.Window):
         self.counts_per_sec = 1e3*self.counts/self.count_time_ms  
     
     
+    def get_reference_statistic(self, ws):
+        """
+        Return the statistic of a swept line that tells us if we are still on 
+        the NV. 
+        The counts change with the magnetic field along the line, so we take 
+        the bright part of the line (the 90th percentile of the counts), which 
+        is mostly sensitive to the collection efficiency. 
+        
+        ws:
+            Counts taken along the line. 
+        """
+        _debug('GUIMagnetSweepLines: get_reference_statistic')
+        
+        return np.percentile(ws, 90)
+    
     def one_line_is_swept(self):
         """
         Trigger the optimization. 
@@ -760,27 +1054,30 @@ class GUIMagnetSweepLines(egg.gui.Window):
             
             # Update the settings of the databox
             self.databox_setting_update()
+            self.extract_sweep_settings()
             
-            # Extract the settings for easier access
-            self.resolution = self.treeDic_settings['resolution']
-            self.time_per_point = self.treeDic_settings['time_per_point']
-            self.nb_line_before_optimize = self.treeDic_settings['nb_line_before_optimize']
-            # Determine the scalar speed of the magnet
-            self.speed = self.resolution/self.time_per_point # It should be in mm/s. The settings are in um/ms = mm/sec. Cool 
-            # Adjust the settings if that makes a speed to high
-            if self.speed >2:
-                # Set the speed to its maximum value
-                self.speed = 2 
-                # Inccrease the count time accordingly
-                self.time_per_point = self.resolution/self.speed
-                self.treeDic_settings['time_per_point'] = self.time_per_point
-                print('Warning. Speed was too high. Auto set the time for maximum allowed speed.')
-
-            # Get the path 
-            self.xs_setting = self.databox_settings['xs']
-            self.ys_setting = self.databox_settings['ys']
-            self.zs_setting = self.databox_settings['zs']
-            self.nb_iter = len(self.xs_setting)
+            # Folder where to write the lines as they are swept
+            self.writer = None
+            if self.treeDic_settings['Stream_to_disk']:
+                path = _s.dialogs.select_directory(text='Select an empty folder for saving the sweep line by line')
+                if path is None or path == '':
+                    print('Warning: no folder selected, the sweep is only kept in memory.')
+                else:
+                    headers = {'name':'Hakuna matata',
+                               'date':time.ctime(time.time()),
+                               'setting_file':self.path_setting,
+                               'xs':list(self.xs_setting),
+                               'ys':list(self.ys_setting),
+                               'zs':list(self.zs_setting)}
+                    for key in self.treeDic_settings.get_keys():
+                        headers[key] = self.treeDic_settings[key]
+                    try:
+                        self.writer = SweepWriter(path, headers)
+                    except FileExistsError:
+                        # Never mix two sweeps, this one goes in a subfolder
+                        path = os.path.join(path, time.strftime('sweep_%Y-%m-%d_%H-%M-%S'))
+                        print('Warning: the folder already contains a sweep, saving in '+path)
+                        self.writer = SweepWriter(path, headers)
             
             # Signal the initialization
             self.initiate_line_sweep()
@@ -800,8 +1097,16 @@ class GUIMagnetSweepLines(egg.gui.Window):
             self.xs_scanned = []
             self.ys_scanned = []
             self.zs_scanned = []
+            self.ts_scanned = [] # Time of each checkpoint
+            # Positions interpolated from the readings of the actuators (the 
+            # ones above are predicted by the model of the motion)
+            self.xs_measured = []
+            self.ys_measured = []
+            self.zs_measured = []
             # This will store the 4-Dimensional data, for example the photo-counts
             self.ws_scanned = []
+            # Same points, for the live map
+            self.sweep_result = SweepResult(nb_max=self.treeDic_settings['Live_map/Nb_points_max'])
             # Increase ther iteration for not scanning the first poitn to the first point !
             self.iter = 1
             
@@ -820,32 +1125,49 @@ class GUIMagnetSweepLines(egg.gui.Window):
             y = self.ys_setting[self.iter]
             z = self.zs_setting[self.iter]
             xyzw = self.scan_single_line(x,y,z, 
-                                        speed=self.speed)
+                                        speed=self.get_speed_line_iter(self.iter))
             # Append the point
-            self.xs_scanned.extend(xyzw[0])
-            self.ys_scanned.extend(xyzw[1])
-            self.zs_scanned.extend(xyzw[2])
-            self.ws_scanned.extend(xyzw[3])
+            columns = {'xs':xyzw[0], 'ys':xyzw[1], 'zs':xyzw[2], 'ws':xyzw[3],
+                       'ts':self.ts_line,
+                       'xs_measured':self.xyz_measured_line[0],
+                       'ys_measured':self.xyz_measured_line[1],
+                       'zs_measured':self.xyz_measured_line[2]}
+            if self.writer is None:
+                for key in COLUMNS:
+                    getattr(self, self.get_list_name(key)).extend(columns[key])
+            else:
+                # On the disk right away, not in the memory
+                self.writer.add_line(self.iter, columns)
+            self.sweep_result.add_points(*xyzw)
+            self.update_live_map()
+            self.add_line_to_planner(self.iter, *xyzw)
             
             # Update the info shown
             self.statut = 'The line %d is completed'%self.iter
             self.label_info_update()
 
-            # Optimize if it is appropriate
-            if (self.nb_line_before_optimize>0) and not(self.optimizer==-1):
-                if self.iter%self.nb_line_before_optimize == self.nb_line_before_optimize-1:
+            # Optimize if the counts dropped (or too many lines were swept)
+            if not(self.optimizer==-1) and len(xyzw[3])>0:
+                if self.optimize_policy.add_value(self.get_reference_statistic(xyzw[3])):
                     _debug('GUIMagnetSweepLines: run_sweep: event_optimize sent!')
                     # Update the info
                     self.statut = 'Optimizing after the line %d'%self.iter
                     self.label_info_update()
                     # Optimize !
                     self.optimizer.button_optimize.click()
+                    self.optimize_policy.optimization_done()
+                    if not(self.writer is None):
+                        self.writer.add_event(self.iter, 'Optimized')
                     # The fpga settings change during optimization. 
                     #We need to put them back.
                     self.initiate_line_sweep()
             
             # Update the condition of the scan
             self.iter += 1
+            # At the end of the coarse sweep, add the fine lines
+            if (self.iter>=self.nb_iter and self.is_running and
+                not(self.adaptive_planner is None) and self.iter_refine_start is None):
+                self.plan_refinement()
             condition = self.is_running and self.iter<self.nb_iter
             
         # Update the data
@@ -856,6 +1178,113 @@ class GUIMagnetSweepLines(egg.gui.Window):
             # Reset everything 
             self.button_reset_clicked()
         
+    def extract_sweep_settings(self):
+        """
+        Take the settings of the sweep (speed, path, optimization) from the
+        tree dictionary and the databox of the settings.
+        """
+        _debug('GUIMagnetSweepLines: extract_sweep_settings')
+
+        # Extract the settings for easier access
+        self.resolution = self.treeDic_settings['resolution']
+        self.time_per_point = self.treeDic_settings['time_per_point']
+        self.nb_line_before_optimize = self.treeDic_settings['nb_line_before_optimize']
+        self.optimize_policy.N_max = self.nb_line_before_optimize
+        self.optimize_policy.threshold_fraction = self.treeDic_settings['drop_threshold']
+        self.optimize_policy.restart_baseline()
+        # Determine the scalar speed of the magnet
+        self.speed = self.resolution/self.time_per_point # It should be in mm/s. The settings are in um/ms = mm/sec. Cool
+        # Adjust the settings if that makes a speed to high
+        if self.speed >2:
+            # Set the speed to its maximum value
+            self.speed = 2
+            # Inccrease the count time accordingly
+            self.time_per_point = self.resolution/self.speed
+            self.treeDic_settings['time_per_point'] = self.time_per_point
+            print('Warning. Speed was too high. Auto set the time for maximum allowed speed.')
+
+        # Get the path
+        self.xs_setting = self.databox_settings['xs']
+        self.ys_setting = self.databox_settings['ys']
+        self.zs_setting = self.databox_settings['zs']
+        self.nb_iter = len(self.xs_setting)
+        self.duration_predicted = self.predict_duration(self.xs_setting,
+                                                        self.ys_setting,
+                                                        self.zs_setting)
+
+        # Finer lines around the features, planned after the lines of the table
+        self.iter_refine_start = None
+        self.is_refined = []
+        self.speed_refine = min(self.treeDic_settings['Adaptive/Resolution']/self.time_per_point, 2) # mm/s
+        self.adaptive_planner = None
+        if self.treeDic_settings['Adaptive/Enable']:
+            self.adaptive_planner = AdaptiveSweepPlanner(time_budget_s=60*self.treeDic_settings['Adaptive/Time_budget'],
+                                                         speed_refine=self.speed_refine,
+                                                         speed_transit=self.speed,
+                                                         half_width=self.treeDic_settings['Adaptive/Half_width'],
+                                                         spacing=self.treeDic_settings['Adaptive/Spacing'],
+                                                         nb_offsets=self.treeDic_settings['Adaptive/Nb_offsets'],
+                                                         speeds_max=[2, 2, 2], # Maximum speed of the actuators
+                                                         acceleration=self.treeDic_settings['Trajectory/Acceleration'],
+                                                         nb_sigma=self.treeDic_settings['Adaptive/Nb_sigma'])
+
+    def get_speed_line_iter(self, i):
+        """
+        Return the speed (mm/s) for sweeping the line of the iteration i:
+        slower on the fine lines, for the finer resolution.
+        """
+        if self.iter_refine_start is None or i < self.iter_refine_start:
+            return self.speed
+        if self.is_refined[i - self.iter_refine_start]:
+            return self.speed_refine
+        return self.speed
+
+    def add_line_to_planner(self, i, xs, ys, zs, ws):
+        """
+        Give the points of the line of the iteration i to the planner of the
+        fine lines, if it is a line of the coarse sweep.
+        """
+        if self.adaptive_planner is None or not(self.iter_refine_start is None):
+            return
+        self.adaptive_planner.add_line([self.xs_setting[i-1], self.ys_setting[i-1], self.zs_setting[i-1]],
+                                       [self.xs_setting[i  ], self.ys_setting[i  ], self.zs_setting[i  ]],
+                                       xs, ys, zs, ws)
+
+    def plan_refinement(self):
+        """
+        Plan the fine lines around the features of the coarse sweep and add
+        them at the end of the path (and of the table).
+        """
+        _debug('GUIMagnetSweepLines: plan_refinement')
+
+        self.statut = 'Planning the fine lines'
+        self.label_info_update()
+        r_now = [self.xs_setting[-1], self.ys_setting[-1], self.zs_setting[-1]]
+        xs, ys, zs, is_refined = self.adaptive_planner.plan(r_now)
+        self.iter_refine_start = self.nb_iter
+        self.is_refined = list(is_refined)
+
+        # Continue the path with the fine lines
+        self.xs_setting = list(self.xs_setting) + list(xs)
+        self.ys_setting = list(self.ys_setting) + list(ys)
+        self.zs_setting = list(self.zs_setting) + list(zs)
+        self.nb_iter = len(self.xs_setting)
+        self.duration_predicted += self.adaptive_planner.duration_planned
+        self.table_trajectories_fill(self.xs_setting, self.ys_setting, self.zs_setting)
+        self.databox_setting_update()
+        if not(self.writer is None):
+            self.writer.update_headers({'xs':self.xs_setting,
+                                        'ys':self.ys_setting,
+                                        'zs':self.zs_setting,
+                                        'iter_refine_start':self.iter_refine_start,
+                                        'is_refined':self.is_refined})
+            self.writer.add_event(self.iter_refine_start,
+                                  'Planned %d fine lines around %d features'%(np.sum(self.is_refined),
+                                                                              len(self.adaptive_planner.features)))
+        self.statut = '%d fine lines planned (%.1f min)'%(np.sum(self.is_refined),
+                                                          self.adaptive_planner.duration_planned/60)
+        self.label_info_update()
+        
     def scan_single_line(self, xend=0, yend=0, zend=0, speed=1):
         """
         Move in a straight line from the current position to the target position. 
@@ -871,11 +1300,21 @@ class GUIMagnetSweepLines(egg.gui.Window):
         speed:
             (in mm/sec) Speed of the displacement along the line
             
+        The actuators are read in parallel while the fpga is counting, once 
+        every Trajectory/Query_every points (and at each point once the 
+        actuators should have arrived). The positions returned are predicted 
+        at the middle of each count window by a model of the motion, which is 
+        adjusted on the readings. If the model doesn't match the readings, 
+        the positions are interpolated from the readings. 
+            
         The function returns:
             xzyw:
                 A tuple (xs, ys, zs, ws), where xs, ys and zs are array for the 
                 positions of the actuator at each checkpoint. ws is the array 
                 of the 4-dimension data taken (for example, the counts)
+                The times of the checkpoints are in self.ts_line and the 
+                positions interpolated from the readings are in 
+                self.xyz_measured_line. 
         """
         _debug('GUIMagnetSweepLines: scan_xyz_line')
         
@@ -902,53 +1341,83 @@ class GUIMagnetSweepLines(egg.gui.Window):
         self.Y.settings['Motion/Speed'] = self.vy
         self.Z.settings['Motion/Speed'] = self.vz
         
-        # These will store the position of the magnet at each checkpoint
-        xs = []
-        ys = []
-        zs = []
+        # This will store the time at the middle of each count window
+        ts = []
         # This will store the 4-dimension data at each x,y,z. For example, the photo-counts
         ws = [] 
  
          #Allow the GUI to update. This is important to avoid freezing of the GUI inside loop
         self.process_events()        
         
+        # Model of the motion
+        acceleration = self.treeDic_settings['Trajectory/Acceleration']
+        trajectory = LineTrajectory([self.xin, self.yin, self.zin], [xend, yend, zend], 
+                                    [self.vx, self.vy, self.vz], acceleration)
+        query_every = self.treeDic_settings['Trajectory/Query_every']
+        
         # Go for real
+        t_command = time.time()
         self.X.button_move.click()
         self.Y.button_move.click()
         self.Z.button_move.click()
+        # The actuators are read by the poller during the line. Stop the 
+        # update of their GUI, for not talking to a controller from two 
+        # threads at the same time. 
+        self.X.timer_moving.stop()
+        self.Y.timer_moving.stop()
+        self.Z.timer_moving.stop()
+        
+        poller = ActuatorPoller([self.X.api, self.Y.api, self.Z.api])
         
         # Note the condition for keeping doing
         # As long as the three actuator move
-        condition1 = self.X.api.get_state() == 'MOVING'
-        condition2 = self.Y.api.get_state() == 'MOVING'
-        condition3 = self.Z.api.get_state() == 'MOVING'
-        condition = condition1 or condition2 or condition3
+        states = poller.poll()[2]
+        condition = 'MOVING' in states
         while condition:
+            # Read the actuators only once in a while, or at each point when 
+            # they should have arrived (for noticing it as soon as possible)
+            want_query = ((len(ts)+1)%query_every == 0 or 
+                          trajectory.is_arrived(time.time() - t_command))
+            # Start to read the actuators, they will answer while we count
+            if want_query:
+                poller.start()
 
-            # Let's take the positions
-            xs.append( self.X.api.get_position() )
-            ys.append( self.Y.api.get_position() )
-            zs.append( self.Z.api.get_position() )
-            _debug('GUIMagnetSweepLines: scan_xyz_line: Done')
-            _debug('GUIMagnetSweepLines: scan_xyz_line: %f %f %f'%(xs[-1], ys[-1], zs[-1]))
-             #Allow the GUI to update. This is important to avoid freezing of the GUI inside loop
-            self.process_events()
-            
             # Take the counts from the fpga
             # This function is in charge to give the time delay for not blowing the CPU with an almost infinite loop
+            t_start = time.time()
             self.take_counts() # It updates self.data_w
+            ts.append(0.5*(t_start + time.time()))
             ws.append(self.data_w)
             
-            # Note the condition for keeping doing
-            # As long as the three actuator move
-            condition1 = self.X.api.get_state() == 'MOVING'
-            condition2 = self.Y.api.get_state() == 'MOVING'
-            condition3 = self.Z.api.get_state() == 'MOVING'
-            condition = condition1 or condition2 or condition3
+            if want_query:
+                # Get the reading of the actuators
+                _, positions, states = poller.get()
+                _debug('GUIMagnetSweepLines: scan_xyz_line: %f %f %f'%tuple(positions))
+                # Note the condition for keeping doing
+                # As long as the three actuator move
+                condition = 'MOVING' in states
+             #Allow the GUI to update. This is important to avoid freezing of the GUI inside loop
+            self.process_events()
+        # One last reading, for interpolating the last count window
+        poller.poll()
+        
+        # Positions of the magnet at the middle of each count window, 
+        # from the readings
+        self.xyz_measured_line = poller.get_positions_at(ts)
+        # And from the model adjusted on the readings
+        ts_reading = [np.array(t) - t_command for t in poller.ts_reading]
+        trajectory.fit(ts_reading, poller.positions_reading)
+        xs, ys, zs = trajectory.get_positions(np.array(ts) - t_command)
+        if trajectory.residual*1e3 > self.treeDic_settings['Trajectory/Tolerance']:
+            print('Warning: the actuators did not follow the model of the motion (%.2f um RMS). '%(trajectory.residual*1e3)+
+                  'The positions are interpolated from the readings.')
+            xs, ys, zs = self.xyz_measured_line
+        poller.close()
+        self.ts_line = ts
         
         _debug('GUIMagnetSweepLines: scan_xyz_line: Done')
         
-        return (xs, ys, zs, ws)
+        return (list(xs), list(ys), list(zs), ws)
  
 #TODO Remove the followings if everything is fine. 
 #    def event_initiate_sweep(self):
@@ -990,7 +1459,6 @@ class GUIMagnetSweepList(egg.gui.Window):
     """
     #TODO Rewrite it and make sure that it does what it should.
     #TODO For example, like labview, run a pulse sequence at each position
-    #TODO FOr example, exctrat X, Y and Z components of magnet3
     
     def __init__(self, magnet3, name='Magnet sweep list', show=True, size=[1300,600]):
         """
@@ -1002,6 +1470,11 @@ class GUIMagnetSweepList(egg.gui.Window):
         _debug('GUIMagnetSweepList: __init__', name)
         _debug('Don’t watch the clock; do what it does. Keep going. – Sam Levenson')
         
+        # Get each axis component
+        self.X = magnet3.X
+        self.Y = magnet3.Y
+        self.Z = magnet3.Z
+        
         # Run the basic stuff for the initialization
         egg.gui.Window.__init__(self, title=name, size=size)
         
@@ -1009,11 +1482,16 @@ class GUIMagnetSweepList(egg.gui.Window):
         self.button_load_list   = self.place_object(egg.gui.Button('MAY THE FORCE BE WITH YOU', checkable=True), 2,0).set_width(100).disable()
         self.button_scan_magnet = self.place_object(egg.gui.Button('PLEASE IMPLEMENT THE GUI', checkable=True), 3,1).set_width(150).disable()
         self.label_load_file    = self.place_object(egg.gui.Label('THE GUI IS NOT READY'), 3,0 )
+        self.button_optimize_order = self.place_object(egg.gui.Button('Optimize order'), 4,0).set_width(100)
+        self.label_duration     = self.place_object(egg.gui.Label('Predicted travel: ?'), 4,1 )
         self.table_positions    = self.place_object(egg.gui.Table(columns = 3, rows = 5), 2,1) #Table containing the xyz position of the magnet
         
         #Connect the button !
         self.button_load_list  .signal_toggled.connect(self._button_load_list_toggled)
         self.button_scan_magnet.signal_toggled.connect(self._button_scan_magnet_toggled)   
+        self.connect(self.button_optimize_order.signal_clicked, self.button_optimize_order_clicked)
+        self.button_optimize_order._widget.setToolTip('Reorder the positions in the table for spending less time moving.\n'+
+                                                      'The actuators move one after the other, at their own speed.')
         
         #Enable the button
         self.button_load_list  .set_checked(False,  block_events=True).enable()
@@ -1134,6 +1612,41 @@ class GUIMagnetSweepList(egg.gui.Window):
             self.label_load_file.set_colors(text='red',background=None)
             return 'Error in reading the data from the file :S '
         
+    def get_table_positions(self):
+        """
+        Return the array of the (x, y, z) positions in the table.
+        """
+        N = self.table_positions.get_row_count()
+        return np.array([[float(self.table_positions.get_value(column=j, row=i)) for j in range(3)]
+                         for i in range(N)])
+
+    def button_optimize_order_clicked(self):
+        """
+        Reorder the positions in the table, starting from the actual position
+        of the magnet, and show the predicted travel time.
+        """
+        _debug('GUIMagnetSweepList: button_optimize_order_clicked')
+
+        points = self.get_table_positions()
+        if len(points) == 0:
+            return
+        r_start = [self.X.api.get_position(),
+                   self.Y.api.get_position(),
+                   self.Z.api.get_position()]
+        speeds = [self.X.settings['Motion/Speed'],
+                  self.Y.settings['Motion/Speed'],
+                  self.Z.settings['Motion/Speed']]
+        # go_to moves the actuators one after the other
+        kwargs = {'speeds':speeds, 'simultaneous':False}
+        duration_before = get_path_duration(points, r_start, **kwargs)
+        order = order_points(points, r_start=r_start, **kwargs)
+        duration_after = get_path_duration(points[order], r_start, **kwargs)
+
+        for i, r in enumerate(points[order]):
+            for j in range(3):
+                self.table_positions.set_value(column=j, row=i, value=r[j])
+        self.label_duration.set_text('Predicted travel: %.1f min (%.1f min before)'%(duration_after/60, duration_before/60))
+
     def go_to(self, actuator, column =0, row =0):
         """
         Make the actuator go to the position in the (column, row) in the table. 
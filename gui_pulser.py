@@ -21,6 +21,8 @@ from converter import GUIFPGAInstruction
 from predefined_sequence import PredefinedSequence
 
 import gui_signal_generator
+from checkpoint import Checkpointer
+from optimize_policy import DriftOptimizePolicy, total_counts
 
 import time
 
@@ -71,6 +73,12 @@ class GuiMainPulseSequence(egg.gui.Window):
         self.data_array = []
         self.length_data_block_s = []
         self.selected_experiment = 'Predefined' # This tells which experiment is selected
+        
+        # For saving the accumulated data once in a while. 
+        # The periods are set by the GUI
+        self.checkpointer = Checkpointer('checkpoint_pulser.npz')
+        # For deciding when to optimize, based on the drop of the counts
+        self.optimize_policy = DriftOptimizePolicy()
 
         # Fill the GUI
         self.initialize_GUI() 
@@ -125,8 +133,8 @@ class GuiMainPulseSequence(egg.gui.Window):
         # Place a label for the number of iteration performed
         self.iteration_label = self.place_object(egg.gui.Label('Iteration of FPGA:XX'))      
 
-        # A spinbox for the number of iteration before optimization
-        self.place_object(egg.gui.Label('Number of FPGA loop\nbefore optimization\n0=never optimize'))
+        # A spinbox for the maximum number of iteration before optimization
+        self.place_object(egg.gui.Label('Max number of FPGA loop\nbefore optimization\n0=no maximum'))
         self.NumberBox_Nloop_before_optimize = egg.gui.NumberBox(value=100, step=1, 
                                                       bounds=(0, None), int=True)
         self.place_object(self.NumberBox_Nloop_before_optimize, alignment=1)
@@ -134,6 +142,40 @@ class GuiMainPulseSequence(egg.gui.Window):
                      self.NumberBox_Nloop_before_optimize_changed)     
         self.NumberBox_Nloop_before_optimize_changed() # Initialize the value 
         
+        # A spinbox for the drop of counts that triggers the optimization
+        self.place_object(egg.gui.Label('Optimize when counts\ndrop below this\nfraction. 0=never'))
+        self.NumberBox_drop_threshold = egg.gui.NumberBox(value=0.9, step=0.01, 
+                                                          bounds=(0, 1))
+        self.place_object(self.NumberBox_drop_threshold, alignment=1)
+        self.connect(self.NumberBox_drop_threshold.signal_changed, 
+                     self.NumberBox_drop_threshold_changed)     
+        self.NumberBox_drop_threshold_changed() # Initialize the value 
+        # Label for the state of the drift
+        self.label_drift = self.place_object(egg.gui.Label('Drift: XX'))
+        
+        # Spinboxes for the periods of the checkpoints
+        self.new_autorow()
+        self.place_object(egg.gui.Label('Checkpoint every\nN FPGA loop\n0=never'))
+        self.NumberBox_checkpoint_N = egg.gui.NumberBox(value=100, step=1, 
+                                                        bounds=(0, None), int=True)
+        self.place_object(self.NumberBox_checkpoint_N, alignment=1)
+        self.connect(self.NumberBox_checkpoint_N.signal_changed, 
+                     self.NumberBox_checkpoint_changed)  
+        self.place_object(egg.gui.Label('Checkpoint every\nT seconds\n0=never'))
+        self.NumberBox_checkpoint_T = egg.gui.NumberBox(value=600, step=1, 
+                                                        bounds=(0, None), suffix='s')
+        self.place_object(self.NumberBox_checkpoint_T, alignment=1)
+        self.connect(self.NumberBox_checkpoint_T.signal_changed, 
+                     self.NumberBox_checkpoint_changed)  
+        self.NumberBox_checkpoint_changed() # Initialize the value 
+        
+        # Place the button for resuming from the last checkpoint
+        self.button_resume = egg.gui.Button('Resume checkpoint',
+                                            tip='Reload the data accumulated in the last checkpoint and continue from there.\n'+
+                                            'This does not reconvert the sequence.')
+        self.place_object(self.button_resume)
+        self.connect(self.button_resume.signal_clicked, self.button_resume_clicked)
+        
         
         #######################
         # Place tabs
@@ -240,7 +282,34 @@ class GuiMainPulseSequence(egg.gui.Window):
         """
         _debug('GuiMainPulseSequence: NumberBox_Nloop_before_optimize_changed')
         self.Nloop_before_optimize = self.NumberBox_Nloop_before_optimize.get_value()
+        self.optimize_policy.N_max = self.Nloop_before_optimize
 
+    def NumberBox_drop_threshold_changed(self):
+        """
+        Ajdust the drop of the counts that triggers the optimization. 
+        """
+        _debug('GuiMainPulseSequence: NumberBox_drop_threshold_changed')
+        self.optimize_policy.threshold_fraction = self.NumberBox_drop_threshold.get_value()
+
+    def NumberBox_checkpoint_changed(self):
+        """
+        Ajdust the periods between the checkpoints.
+        """
+        _debug('GuiMainPulseSequence: NumberBox_checkpoint_changed')
+        self.checkpointer.N_iter = self.NumberBox_checkpoint_N.get_value()
+        self.checkpointer.T_s    = self.NumberBox_checkpoint_T.get_value()
+        
+    def button_resume_clicked(self):
+        """
+        Reload the last checkpoint and be ready to continue the accumulation. 
+        """
+        _debug('GuiMainPulseSequence: button_resume_clicked')
+        
+        if self.is_running:
+            print('Warning: stop the pulse sequence before resuming a checkpoint.')
+            return
+        
+        self.load_checkpoint()
 
     def button_convert_sequence_clicked(self):
         """
@@ -771,6 +840,132 @@ class GuiMainPulseSequence(egg.gui.Window):
         # Note that it is resetted
         self.is_reseted = True
         
+        # The counts of the next experiment may be totally different
+        self.optimize_policy.restart_baseline()
+        
+        # Put the last checkpoint aside, in case the reset was an accident. 
+        try:
+            self.checkpointer.archive()
+        except:
+            print('Warning: could not archive the last checkpoint.')
+        
+    def get_sub_gui_name(self):
+        """
+        Return the name of the attribute of the sub GUI that receives the 
+        counts (the one whose after_one_loop is used). Return None if there is 
+        none. 
+        """
+        _debug('GuiMainPulseSequence: get_sub_gui_name')
+        
+        sub_gui = getattr(self.after_one_loop, '__self__', None)
+        for name, value in self.__dict__.items():
+            if name.startswith('gui_') and value is sub_gui:
+                return name
+        return None
+        
+    def save_checkpoint(self):
+        """
+        Save the accumulated counts, the iteration and the settings of the 
+        current experiment. 
+        """
+        _debug('GuiMainPulseSequence: save_checkpoint')
+        
+        name = self.get_sub_gui_name()
+        if name == None:
+            # There is nothing accumulated by a sub GUI
+            return
+        sub_gui = getattr(self, name)
+        
+        # Everything that after_one_loop accumulates
+        if hasattr(sub_gui, 'get_checkpoint_state'):
+            arrays = sub_gui.get_checkpoint_state()
+        else:
+            # The accumulated counts have a name starting with counts_total 
+            arrays = {}
+            for key, value in sub_gui.__dict__.items():
+                if key.startswith('counts_total') and isinstance(value, np.ndarray):
+                    arrays[key] = value
+        # The FPGA instruction, for not having to reconvert the sequence
+        arrays['data_array'] = np.array(self.data_array)
+        arrays['length_data_block_s'] = np.array(self.length_data_block_s)
+        
+        headers = {'date'               : time.ctime(), 
+                   'iter'               : self.iter,
+                   'rep'                : self.rep,
+                   'nb_block'           : self.nb_block,
+                   'CET_mode'           : self.CET_mode,
+                   'selected_experiment': self.selected_experiment,
+                   'sub_gui'            : name}
+        # The settings of the experiment
+        settings = {}
+        if hasattr(sub_gui, 'treeDic_settings'):
+            for key in sub_gui.treeDic_settings.get_keys():
+                settings[key] = sub_gui.treeDic_settings[key]
+        headers['settings'] = settings
+        
+        self.checkpointer.save(self.iter, arrays, headers)
+        
+    def load_checkpoint(self):
+        """
+        Reload the last checkpoint and put back everything, such that the 
+        next loops continue to accumulate on top of the saved counts. 
+        The sequence is not reconverted: the FPGA instruction are taken from 
+        the checkpoint. 
+        """
+        _debug('GuiMainPulseSequence: load_checkpoint')
+        
+        checkpoint = self.checkpointer.load()
+        if checkpoint == None:
+            print('ERROR: there is no checkpoint to resume.')
+            return
+        arrays, headers = checkpoint
+        
+        name = headers['sub_gui']
+        if not(hasattr(self, name)):
+            print('ERROR: the checkpoint is for an unknown experiment: '+name)
+            return
+        sub_gui = getattr(self, name)
+
+        # Put back the settings and prepare the experiment as if the user 
+        # clicked. This sets the sub GUI, the signal generator and 
+        # after_one_loop. 
+        if hasattr(sub_gui, 'treeDic_settings'):
+            for key, value in headers['settings'].items():
+                try:
+                    sub_gui.treeDic_settings[key] = value
+                except:
+                    print('Warning: could not set the setting '+key)
+        sub_gui.button_prepare_experiment_clicked()
+        
+        # Put back the FPGA instruction, without converting
+        self.rep      = headers['rep']
+        self.nb_block = headers['nb_block']
+        self.CET_mode = headers['CET_mode']
+        self.data_array          = arrays['data_array']
+        self.length_data_block_s = list(arrays['length_data_block_s'])
+        self.label_data_length.set_text('FPGA data length: %d'%len(self.data_array)+
+                                        '\nResumed from checkpoint')
+        
+        # Put back the accumulated counts. Since iter>=0, after_one_loop will 
+        # add the new counts on top of them. 
+        if hasattr(sub_gui, 'set_checkpoint_state'):
+            sub_gui.set_checkpoint_state(arrays)
+        else:
+            for key, value in arrays.items():
+                if key.startswith('counts_total'):
+                    setattr(sub_gui, key, value)
+        self.iter = headers['iter']
+        self.is_reseted = False
+        self.iteration_label.set_text('Iteration %d'%self.iter)
+        # Keep writing in the same checkpoint
+        self.checkpointer.reset()
+        self.checkpointer.iter_last = self.iter
+        
+        # Ready to continue
+        self.button_start.enable()
+        self.button_start.set_text('Continue')
+        self.button_start.set_colors(background='green')  
+        
     def prepare_THE_run_loop(self):
         """
         Prepare the fpga settings for the run loop
@@ -780,6 +975,32 @@ class GuiMainPulseSequence(egg.gui.Window):
         self.fpga.prepare_pulse(self.data_array) 
         # Specify the counting mode again
         self.fpga.set_counting_mode(self.CET_mode)        
+        # Simulate the counts with the RF, when everything is simulated
+        self.attach_simulated_signal_generator()
+
+    def attach_simulated_signal_generator(self):
+        """
+        If the fpga is the fake one and the signal generator is in simulation
+        mode, attach the simulated instrument to the fake fpga, such that the
+        counts follow its RF (see FPGA_fake_api.set_signal_generator).
+        The trigger of the list is the DIO_change_frequency of the selected
+        experiment (7 if it doesn't have one).
+        """
+        _debug('GuiMainPulseSequence: attach_simulated_signal_generator')
+        
+        instrument = getattr(self.sig_gen.api, 'instrument', None)
+        if not hasattr(self.fpga, 'set_signal_generator'):
+            return # Real fpga
+        if not isinstance(instrument, gui_signal_generator.scpi_simulator):
+            return # Real or no signal generator
+        
+        # The sub GUI of the selected experiment
+        gui = getattr(self.after_one_loop, '__self__', None)
+        try:
+            DIO_trigger = gui.treeDic_settings['DIO_change_frequency']
+        except:
+            DIO_trigger = 7
+        self.fpga.set_signal_generator(instrument, DIO_trigger=DIO_trigger)
     
     def run_loops(self):
         """
@@ -811,6 +1032,14 @@ class GuiMainPulseSequence(egg.gui.Window):
             # Note that the data are no longer reseted
             self.is_reseted = False
             
+            # Save the accumulated data once in a while. A full disk should 
+            # not stop the run. 
+            if self.checkpointer.is_due(self.iter):
+                try:
+                    self.save_checkpoint()
+                except OSError as e:
+                    print('Warning: could not save the checkpoint: '+str(e))
+            
             # Allow the GUI to update. This is important to avoid freezing of the GUI inside loops
             self.process_events()    
             # Update the condition for the while loop
@@ -818,26 +1047,56 @@ class GuiMainPulseSequence(egg.gui.Window):
             _debug('GuiMainPulseSequence: run_loops: MIDDLE self.iter, self.N_loopFPGA, self.is_running, condition_loop',
                    self.iter,self.N_loopFPGA, self.is_running, condition_loop)
             
-            # Call the function for optimizing if the condition is met
-            # Note that the condition is not meet if N=0. Clever. 
-            if (self.Nloop_before_optimize>0) and not(self.optimizer==-1):
-                if self.iter%self.Nloop_before_optimize == self.Nloop_before_optimize-1:
+            # Call the function for optimizing if the counts dropped (or if 
+            # the maximum number of loops is reached)
+            if not(self.optimizer==-1):
+                value = self.get_reference_statistic(self.counts)
+                if self.optimize_policy.add_value(value):
                     _debug('GuiMainPulseSequence: run_loops: event_optimize sent!')
                     self.optimizer.button_optimize.click()
+                    self.optimize_policy.optimization_done()
                     # The fpga settings change during optimization. 
                     #We need to put them back.
                     self.prepare_THE_run_loop()
+                self.label_drift.set_text(self.optimize_policy.get_info())
+                # Follow the drift of the NV until the next optimization
+                self.optimizer.apply_drift_correction()
                             
             _debug('GuiMainPulseSequence: run_loops: END self.iter, self.N_loopFPGA, self.is_running, condition_loop',
                    self.iter,self.N_loopFPGA, self.is_running, condition_loop)
         
         # Loop ended.         
+        # Save what we have, whatever the reason of the stop
+        if self.iter>=0:
+            try:
+                self.save_checkpoint()
+            except OSError as e:
+                print('Warning: could not save the checkpoint: '+str(e))
         # Update the buttons
         if self.is_running:
             # Click on stop if it is still running
             self.button_start_clicked()   
 
 
+    def get_reference_statistic(self, counts):
+        """
+        Return the statistic that tells us if we are still on the NV. 
+        If the sub GUI of the selected experiment has a reference readout 
+        (its own get_reference_statistic), this is the counts of that 
+        readout, which don't depend on what is measured. Otherwise it is the 
+        total counts of the loop. 
+        
+        counts:
+            Array of counts that the fpga get. 
+        """
+        _debug('GuiMainPulseSequence: get_reference_statistic')
+        
+        # The sub GUI of the selected experiment
+        gui = getattr(self.after_one_loop, '__self__', None)
+        if hasattr(gui, 'get_reference_statistic'):
+            return gui.get_reference_statistic(counts)
+        return total_counts(counts, self.CET_mode)
+
     def after_one_loop(self, counts, iteration, rep):
         """
         DUmmy function to be overrid
@@ -1842,6 +2101,21 @@ class GUIRabi(egg.gui.Window):
         # Update the plot
         self.databoxplot_update()
         
+    def get_reference_statistic(self, counts):
+        """
+        Return the counts of the reference readout of the loop (the second 
+        readout of each block, after the laser put back the state in ms=0). 
+        They don't follow the Rabi oscillation, so they only drop when we 
+        leave the NV. 
+        after_one_loop must have processed the same counts. 
+        
+        counts:
+            Array of counts that the fpga get. 
+        """
+        _debug('GUIRabi: get_reference_statistic')
+        
+        return float(np.sum(self.counts[1]))
+        
     def event_prepare_experiment(self): 
         """
         Dummy function to be overrid
@@ -3269,6 +3543,21 @@ class GUIT1TimeTrace2(egg.gui.Window):
         # Update the plot
         self.databoxplot_update()
         
+    def get_reference_statistic(self, counts):
+        """
+        Return the counts of the ms=0 readouts of the loop (the first readout 
+        of each block), for knowing if we are still on the NV. The readouts 
+        of ms=+-1 are left out, because they are the ones that change with 
+        what we measure. 
+        after_one_loop must have processed the same counts. 
+        
+        counts:
+            Array of counts that the fpga get. 
+        """
+        _debug('GUIT1TimeTrace2: get_reference_statistic')
+        
+        return float(np.sum(self.counts[0]))
+        
     def event_prepare_experiment(self): 
         """
         Dummy function to be overrid
@@ -3985,6 +4274,21 @@ class GUIT1TimeTrace3(egg.gui.Window):
 #        # Update the plot
 #        self.databoxplot_update()
         
+    def get_reference_statistic(self, counts):
+        """
+        Return the counts of the ms=0 readouts of the loop (the first 
+        N_repeat_same_state readouts of each block), for knowing if we are 
+        still on the NV. The readouts of ms=+1 and ms=-1 are left out, 
+        because they are the ones that change with what we measure. 
+        after_one_loop must have processed the same counts. 
+        
+        counts:
+            Array of counts that the fpga get. 
+        """
+        _debug('GUIT1TimeTrace3: get_reference_statistic')
+        
+        return float(np.sum(self.counts[:self.N_repeat_same_state]))
+        
     def event_prepare_experiment(self): 
         """
         Dummy function to be overrid
@@ -4375,6 +4679,45 @@ class GUIT1probeOneTime(egg.gui.Window):
         self.label_estimates.set_text(text)
         
         
+    def get_reference_statistic(self, counts):
+        """
+        Return the counts of the reference readout of the loop (the fourth 
+        one), for knowing if we are still on the NV. 
+        after_one_loop must have processed the same counts. 
+        
+        counts:
+            Array of counts that the fpga get. 
+        """
+        _debug('GUIT1probeOneTime: get_reference_statistic')
+        
+        return float(self.counts_ref)
+        
+    def get_checkpoint_state(self):
+        """
+        Return a dictionary of the arrays accumulated by after_one_loop, for 
+        the checkpoints. 
+        """
+        _debug('GUIT1probeOneTime: get_checkpoint_state')
+        
+        return {'count_per_iter_ms0_s' : np.array(self.count_per_iter_ms0_s ),
+                'count_per_iter_msm1_s': np.array(self.count_per_iter_msm1_s),
+                'count_per_iter_msp1_s': np.array(self.count_per_iter_msp1_s),
+                'count_per_iter_ref_s' : np.array(self.count_per_iter_ref_s ),
+                'total_nb_readout'     : np.array(self.total_nb_readout)}
+        
+    def set_checkpoint_state(self, arrays):
+        """
+        Put back the arrays of get_checkpoint_state, such that after_one_loop 
+        continues to accumulate on top of them. 
+        """
+        _debug('GUIT1probeOneTime: set_checkpoint_state')
+        
+        self.count_per_iter_ms0_s  = list(arrays['count_per_iter_ms0_s' ])
+        self.count_per_iter_msm1_s = list(arrays['count_per_iter_msm1_s'])
+        self.count_per_iter_msp1_s = list(arrays['count_per_iter_msp1_s'])
+        self.count_per_iter_ref_s  = list(arrays['count_per_iter_ref_s' ])
+        self.total_nb_readout = int(arrays['total_nb_readout'])
+        
     def event_prepare_experiment(self): 
         """
         Dummy function to be overrid
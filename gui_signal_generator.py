@@ -3,6 +3,7 @@ import spinmob     as _s
 import spinmob.egg as _egg
 import mcphysics   as _mp
 import time        as _t
+import hashlib     as _hashlib
 
 _g = _egg.gui
 
@@ -20,6 +21,14 @@ def _debug(*a):
         print(', '.join(s))
 x = []
 
+def _list_to_string(values, format='%.15g'):
+    """
+    Return the values as the string 'v0, v1, v2, ...' of a list command.
+    All the numbers are formatted at once by numpy, which is much faster than
+    adding them one by one to the string for lists of thousands of points.
+    """
+    return ', '.join(_n.char.mod(format, _n.asarray(values, dtype=float)))
+
 
 class signal_generator_api(_mp.visa_tools.visa_api_base):
     """
@@ -35,6 +44,12 @@ class signal_generator_api(_mp.visa_tools.visa_api_base):
         
         # Run the core setup.
         _mp.visa_tools.visa_api_base.__init__(self, name, pyvisa_py, simulation, timeout=timeout, write_sleep=write_sleep)
+
+        # In simulation, talk to a simulated instrument instead of nothing
+        # Its behavior is set by the dictionary simulation_settings
+        if simulation:
+            self.instrument = scpi_simulator(**simulation_settings)
+            self.idn        = self.instrument.query('*IDN?')
         
         # Inherit the functionality based on the idn
         if self.idn.split(',')[0] in ['AnaPico AG']: 
@@ -60,14 +75,29 @@ class signal_generator_api(_mp.visa_tools.visa_api_base):
         self._api.resource_manager = self.resource_manager
         self._api._write_sleep     = self._write_sleep
 
+        # Hash of the last list sent, for not sending the same list again
+        self._list_hash = None
+
 
     def reset(self):
         """
         Resets the device to factory defaults (RF off).
         """
+        self._list_hash = None
         return self._api.reset()
     
-    def send_list(self, frequencies=[1e9,2e9,3e9,4e9], powers=[-10,-5,-2,0], dwell=0, delay=0):
+    def get_list_hash(self, frequencies, powers, dwell, delay):
+        """
+        Returns a hash of the list values, for knowing if they are already in
+        the instrument.
+        """
+        h = _hashlib.sha1()
+        for values in [frequencies, powers, [dwell, delay]]:
+            h.update(_n.atleast_1d(_n.asarray(values, dtype=float)).tobytes())
+            h.update(b'|')
+        return h.hexdigest()
+
+    def send_list(self, frequencies=[1e9,2e9,3e9,4e9], powers=[-10,-5,-2,0], dwell=0, delay=0, force=False):
         """
         Sends the specified list values.
         
@@ -85,8 +115,25 @@ class signal_generator_api(_mp.visa_tools.visa_api_base):
         
         delay=0
             How long to delay after triggering the next step.
+
+        force=False
+            If False, the list is not sent when it is the same as the last
+            list sent (nothing is written to the instrument).
+
+        Returns True if the list was sent, False if it was already there.
         """
-        return self._api.send_list(frequencies, powers, dwell, delay)
+        list_hash = self.get_list_hash(frequencies, powers, dwell, delay)
+        if list_hash == self._list_hash and not force:
+            _debug('signal_generator_api.send_list() same list as before, not sent')
+            return False
+
+        # Forget the previous list, in case the sending fails in the middle
+        self._list_hash = None
+        self._api.send_list(frequencies, powers, dwell, delay)
+        # Remember it only if the lengths make sense (otherwise nothing was sent)
+        N_f, N_p = _n.size(frequencies), _n.size(powers)
+        if N_f == N_p or N_f == 1 or N_p == 1: self._list_hash = list_hash
+        return True
 
     def set_mode(self, mode='List'):
         """
@@ -202,13 +249,15 @@ class sma100b_api(_mp.visa_tools.visa_api_base):
     API for SMA100B. This object just defines the functions to be used by the
     base class signal_generator_api.
     """
-    def __init__(self): return
+    def __init__(self):
+        self._mode = None # Last mode set or read, None if unknown
         
     def reset(self):
         """
         Resets the device to factory defaults (RF off).
         """
         _debug('api.reset()')
+        self._mode = None
         self.write('*RST')
         self.query('*IDN?') # Pauses operation until fully reset?
     
@@ -252,20 +301,18 @@ class sma100b_api(_mp.visa_tools.visa_api_base):
         
         #The mode switch to Fixed  when we write a power and dwell list. 
         #So I track the initial mode to put it back at the end. 
-        initial_mode = self.get_mode()
+        #It is only asked if we don't already know it.
+        initial_mode = self._mode
+        if initial_mode == None: initial_mode = self.get_mode()
         
         #First choose a list, otherwise SMA100B is mad
         #To know the available list, the query is 'SOUR1:LIST:CAT?'
         self.write('SOUR1:LIST:SEL "/var/user/list1.lsw"') 
          
         #Prepare the strings for the list command
-        str_freq = 'SOUR1:LIST:FREQ ' + str(frequencies[0]) #String for the frequency list command
-        str_pow = 'SOUR1:LIST:POW ' + str(powers[0]) #String for the power list command
-        str_dwell = 'SOUR1:LIST:DWEL:LIST '+str(dwell) #String for the dwell list command
-        for i in range(1,len(frequencies)):
-            str_freq += ', ' + str(frequencies[i])
-            str_pow += ', ' + str(powers[i])
-            str_dwell += ', '+str(dwell)
+        str_freq  = 'SOUR1:LIST:FREQ ' + _list_to_string(frequencies) #String for the frequency list command
+        str_pow   = 'SOUR1:LIST:POW '  + _list_to_string(powers) #String for the power list command
+        str_dwell = 'SOUR1:LIST:DWEL:LIST ' + ', '.join([str(dwell)]*len(frequencies)) #String for the dwell list command
         
         self.write(str_freq)
         self.write(str_pow)
@@ -295,9 +342,11 @@ class sma100b_api(_mp.visa_tools.visa_api_base):
             self.write('OUTP1:STAT ON') #Somehow the SMA100B wants the RF to be ON for switching into list mode.
             self.write('SOUR1:LIST:MODE STEP') #Make Step mode in order to not automatically sweep all the frequencies
             self.write('SOURce1:FREQuency:MODE LIST')
+            self._mode = 'List'
         else:
             #CW and FIXed are synonyms for SMA100B
             self.write('SOURce1:FREQuency:MODE CW')
+            self._mode = 'Fixed'
     
     def get_mode(self):
         """
@@ -307,11 +356,12 @@ class sma100b_api(_mp.visa_tools.visa_api_base):
         if s == None: return None
         
         s = s.strip()
-        if   s == 'CW':  return 'Fixed'
-        elif s == 'LIST': return 'List'
+        if   s == 'CW':  self._mode = 'Fixed'
+        elif s == 'LIST': self._mode = 'List'
         else:
             print('ERROR: Unknown mode '+str(s))
-            return
+            self._mode = None
+        return self._mode
     
     def set_list_index(self, n=0):
         """
@@ -340,7 +390,9 @@ class sma100b_api(_mp.visa_tools.visa_api_base):
         """
         #Note that, for SMA, switiching off the output set the automatically the mode to Fixed.... !!
         if on: self.write("OUTP1:STAT ON")
-        else:  self.write("OUTP1:STAT OFF")
+        else:
+            self.write("OUTP1:STAT OFF")
+            self._mode = None # Ask it next time
         
 
     def get_output(self):
@@ -446,13 +498,15 @@ class smb100a_api(_mp.visa_tools.visa_api_base):
     API for SMB100A. This object just defines the functions to be used by the
     base class signal_generator_api.
     """
-    def __init__(self): return
+    def __init__(self):
+        self._mode = None # Last mode set or read, None if unknown
         
     def reset(self):
         """
         Resets the device to factory defaults (RF off).
         """
         _debug('api.reset()')
+        self._mode = None
         self.write('*RST')
         self.query('*IDN?') # Pauses operation until fully reset?
     
@@ -496,20 +550,18 @@ class smb100a_api(_mp.visa_tools.visa_api_base):
         
         #The mode switch to Fixed  when we write a power and dwell list. 
         #So I track the initial mode to put it back at the end. 
-        initial_mode = self.get_mode()
+        #It is only asked if we don't already know it.
+        initial_mode = self._mode
+        if initial_mode == None: initial_mode = self.get_mode()
         
         #First choose a list, otherwise SMA100B is mad
         #To know the available list, the query is 'SOUR1:LIST:CAT?'
         self.write('SOUR1:LIST:SEL "/var/user/list1.lsw"') 
          
         #Prepare the strings for the list command
-        str_freq = 'SOUR1:LIST:FREQ ' + str(frequencies[0]) #String for the frequency list command
-        str_pow = 'SOUR1:LIST:POW ' + str(powers[0]) #String for the power list command
-        str_dwell = 'SOUR1:LIST:DWEL:LIST '+str(dwell) #String for the dwell list command
-        for i in range(1,len(frequencies)):
-            str_freq += ', ' + str(frequencies[i])
-            str_pow += ', ' + str(powers[i])
-            str_dwell += ', '+str(dwell)
+        str_freq  = 'SOUR1:LIST:FREQ ' + _list_to_string(frequencies) #String for the frequency list command
+        str_pow   = 'SOUR1:LIST:POW '  + _list_to_string(powers) #String for the power list command
+        str_dwell = 'SOUR1:LIST:DWEL:LIST ' + ', '.join([str(dwell)]*len(frequencies)) #String for the dwell list command
         
         self.write(str_freq)
         self.write(str_pow)
@@ -539,9 +591,11 @@ class smb100a_api(_mp.visa_tools.visa_api_base):
             self.write('OUTP1:STAT ON') #Somehow the SMA100B wants the RF to be ON for switching into list mode.
             self.write('SOUR1:LIST:MODE STEP') #Make Step mode in order to not automatically sweep all the frequencies
             self.write('SOURce1:FREQuency:MODE LIST')
+            self._mode = 'List'
         else:
             #CW and FIXed are synonyms for SMA100B
             self.write('SOURce1:FREQuency:MODE CW')
+            self._mode = 'Fixed'
     
     def get_mode(self):
         """
@@ -551,11 +605,12 @@ class smb100a_api(_mp.visa_tools.visa_api_base):
         if s == None: return None
         
         s = s.strip()
-        if   s == 'CW':  return 'Fixed'
-        elif s == 'LIST': return 'List'
+        if   s == 'CW':  self._mode = 'Fixed'
+        elif s == 'LIST': self._mode = 'List'
         else:
             print('ERROR: Unknown mode '+str(s))
-            return
+            self._mode = None
+        return self._mode
     
     def set_list_index(self, n=0):
         """
@@ -584,7 +639,9 @@ class smb100a_api(_mp.visa_tools.visa_api_base):
         """
         #Note that, for SMA, switiching off the output set the automatically the mode to Fixed.... !!
         if on: self.write("OUTP1:STAT ON")
-        else:  self.write("OUTP1:STAT OFF")
+        else:
+            self.write("OUTP1:STAT OFF")
+            self._mode = None # Ask it next time
         
 
     def get_output(self):
@@ -1465,6 +1522,182 @@ class fake_api():
 
     
 
+# Settings of the simulated instrument created by signal_generator_api in
+# simulation mode.
+simulation_settings = {'model'      :'SMA100B', # Or 'SMB100A'
+                       'latency_s'  :0.005, # Time for each command (s)
+                       'bytes_per_s':1e6}   # Transfer rate, matters for the long lists
+
+class scpi_simulator():
+    """
+    Simulated R&S signal generator (SMA100B or SMB100A). It has the write,
+    read, query and close methods of the pyvisa instrument, such that
+    signal_generator_api can talk to it in SCPI like to the real one (its
+    query writes the message and then reads the answer).
+
+    It understands the commands used by sma100b_api and smb100a_api: the
+    list (frequencies, powers, dwells, index, mode), the mode, the output,
+    the frequency and the power. Each command takes latency_s, plus the time
+    to transfer it. Like the real SMA100B, it goes in fixed mode when the
+    power or dwell list is written and when the output is switched off.
+
+    The RF that it outputs (see get_rf) is given to the rate model of
+    FPGA_fake_api (see api_fpga.py), which steps the list with trigger()
+    like the external trigger in ESR.
+    """
+    def __init__(self, model='SMA100B', latency_s=0.005, bytes_per_s=1e6):
+        """
+        model:
+            Model given in the *IDN? answer, which decides the api used by
+            signal_generator_api.
+        latency_s:
+            Time for each command (s).
+        bytes_per_s:
+            Transfer rate of the commands.
+        """
+        _debug('scpi_simulator.__init__()', model)
+
+        self.model       = model
+        self.latency_s   = latency_s
+        self.bytes_per_s = bytes_per_s
+        self.timeout     = 100e3 # Like the pyvisa instrument (ms)
+        self.answer      = None  # Answer of the last query, until it is read
+        self.reset()
+
+    def reset(self):
+        """
+        Put the factory defaults (RF off, fixed mode).
+        """
+        self.mode      = 'CW'
+        self.is_on     = False
+        self.frequency = 1e9
+        self.power     = -30
+        self.list_frequencies = _n.array([1e9])
+        self.list_powers      = _n.array([-30.])
+        self.list_dwells      = _n.array([1e-3])
+        self.list_index       = 0
+
+    def get_key(self, header):
+        """
+        Return the header of a command in short form without the SOURce node,
+        for example 'LIST:FREQ' for 'SOURce1:LIST:FREQuency'.
+        """
+        nodes = []
+        for node in header.strip(':').upper().split(':'):
+            node = node.rstrip('0123456789')
+            # Short form of SCPI: 4 letters, or 3 if the fourth is a vowel
+            if len(node) > 4:
+                node = node[:3] if node[3] in 'AEIOU' else node[:4]
+            nodes.append(node)
+        if nodes[0] == 'SOUR':
+            nodes = nodes[1:]
+        return ':'.join(nodes)
+
+    def get_list_length(self):
+        """
+        Return the number of points in the list.
+        """
+        return min(len(self.list_frequencies), len(self.list_powers))
+
+    def write(self, message):
+        """
+        Apply a command, like pyvisa.
+        """
+        self.execute(message)
+        return len(message)
+
+    def read(self):
+        """
+        Return the answer of the last query written, like pyvisa.
+        """
+        answer, self.answer = self.answer, None
+        if answer is None:
+            print('ERROR: scpi_simulator: nothing to read')
+            return ''
+        return answer
+
+    def query(self, message):
+        """
+        Return the answer of a query, like pyvisa.
+        """
+        self.write(message)
+        return self.read()
+
+    def close(self):
+        return
+
+    def execute(self, message):
+        """
+        Apply a command, or return the answer if it is a query.
+        """
+        # Time for the round trip and the transfer
+        _t.sleep(self.latency_s + len(message)/self.bytes_per_s)
+
+        header, _, argument = message.strip().partition(' ')
+        argument = argument.strip()
+        key = self.get_key(header.rstrip('?'))
+        if header.endswith('?'):
+            # Kept for the next read
+            self.answer = self.get_answer(key)
+            return self.answer
+
+        if   key == '*RST': self.reset()
+        elif key == 'FREQ:MODE': self.mode = 'LIST' if argument.upper().startswith('LIST') else 'CW'
+        elif key in ['FREQ', 'FREQ:CW']: self.frequency = float(argument)
+        elif key in ['POW', 'POW:POW']: self.power = float(argument)
+        elif key in ['OUTP', 'OUTP:STAT']:
+            self.is_on = argument.upper() in ['ON', '1']
+            if not self.is_on: self.mode = 'CW'
+        elif key == 'LIST:FREQ': self.list_frequencies = _n.array(argument.split(','), dtype=float)
+        elif key == 'LIST:POW':
+            self.list_powers = _n.array(argument.split(','), dtype=float)
+            self.mode = 'CW'
+        elif key in ['LIST:DWEL', 'LIST:DWEL:LIST']:
+            self.list_dwells = _n.array(argument.split(','), dtype=float)
+            self.mode = 'CW'
+        elif key == 'LIST:IND': self.list_index = int(float(argument))
+        elif key in ['LIST:SEL', 'LIST:MODE', 'LIST:LEAR']: pass # A single list, stepped
+        else: print('ERROR: scpi_simulator: unknown command '+str(message))
+
+    def get_answer(self, key):
+        """
+        Return the answer of the query key (see get_key).
+        """
+        if   key == '*IDN': return 'Rohde&Schwarz,%s,1419.8888K02/000000,Simulation'%self.model
+        elif key == 'FREQ:MODE': return self.mode
+        elif key in ['FREQ', 'FREQ:CW']: return repr(self.frequency)
+        elif key in ['POW', 'POW:POW']: return repr(self.power)
+        elif key in ['OUTP', 'OUTP:STAT']: return '1' if self.is_on else '0'
+        elif key == 'LIST:FREQ': return _list_to_string(self.list_frequencies)
+        elif key == 'LIST:POW': return _list_to_string(self.list_powers)
+        elif key in ['LIST:DWEL', 'LIST:DWEL:LIST']: return _list_to_string(self.list_dwells)
+        elif key == 'LIST:FREQ:POIN': return str(len(self.list_frequencies))
+        elif key == 'LIST:IND': return str(self.list_index)
+        elif key == 'LIST:CAT': return '"list1"'
+        print('ERROR: scpi_simulator: unknown query '+str(key))
+        return ''
+
+    def get_rf(self, nb_triggers=0):
+        """
+        Return (frequency (Hz), power (dBm), is_on) of the output after
+        nb_triggers more triggers. If nb_triggers is an array, the frequency
+        and the power are arrays of the same shape.
+        """
+        nb_triggers = _n.asarray(nb_triggers)
+        if self.mode == 'LIST':
+            i = (self.list_index + nb_triggers) % self.get_list_length()
+            return self.list_frequencies[i], self.list_powers[i], self.is_on
+        return (self.frequency + 0*nb_triggers, self.power + 0*nb_triggers,
+                self.is_on)
+
+    def trigger(self, nb_triggers=1):
+        """
+        Go to the next point of the list, like the external trigger.
+        """
+        if self.mode == 'LIST':
+            self.list_index = int(self.list_index + nb_triggers) % self.get_list_length()
+
+
 class GUISignalGenerator(_mp.visa_tools.visa_gui_base):
     """
     Graphical front-end for the Anapico signal generator.
@@ -1782,8 +2015,15 @@ class GUISignalGenerator(_mp.visa_tools.visa_gui_base):
             # Send it
             self.label_list_status.set_text('Sending...')
             self.window.process_events()
-            self.api.send_list(self.plot_list['f_Hz'], self.plot_list['P_dBm'], 
-                               dwell=1000, delay=0)
+            is_sent = self.api.send_list(self.plot_list['f_Hz'], self.plot_list['P_dBm'],
+                                         dwell=1000, delay=0)
+
+            # Same list as the last one sent, the instrument already has it
+            if is_sent == False:
+                self.label_list_status.set_text(str(len(self.plot_list['f_Hz'])) + ' points in list memory')
+                self.button_send_list.disable()
+                self.button_send_list.set_checked(False, block_events=True)
+                return
             
         # Check it
         self.label_list_status.set_text('Double-checking...')
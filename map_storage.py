@@ -0,0 +1,244 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 15:20:54 2026
+
+Goal: Store the confocal maps (a z-stack of 2D scans) in binary, instead of
+the text databoxes with one column per row.
+
+A stack is a folder containing:
+    - header.json: list of the headers of each slice (Vx_min, Vx_max, Nx,
+      Vy_min, Vy_max, Ny, z, date, settings, etc.)
+    - slice_0000.npy, slice_0001.npy, ...: the map of each slice, Z[row][column]
+    - measured_0000.npy, ...: which pixels are measured (only if a scan was
+      stopped before the end)
+
+The .npy files are written row by row while scanning and are read with a
+memory map, so only the slice shown is actually read from the disk.
+
+@author: Childresslab
+"""
+
+import numpy as np
+import json
+import os
+import tempfile
+
+from checkpoint import _to_json_friendly # For writting the headers
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def databox_to_map(databox):
+    """
+    Return the 2D array Z[row][column] of a scan saved in a databox with one
+    column 'Col%d' per row (the format of GUIMap).
+    """
+    Ny = int(databox.h('Ny'))
+    return np.array([databox['Col%d'%i] for i in range(Ny)], dtype=float)
+
+
+class MapStack():
+    """
+    Stack of confocal maps stored in a folder. See the description of the
+    module for the format.
+    """
+    def __init__(self, path):
+        """
+        Open the stack in the folder path. The folder is created if it does
+        not exist.
+
+        path:
+            Path of the folder.
+        """
+        _debug('MapStack: __init__')
+        _debug('Well done is better than well said. – Benjamin Franklin')
+
+        self.path = path
+        if not(os.path.exists(path)):
+            os.makedirs(path)
+
+        self.path_header = os.path.join(path, 'header.json')
+        if os.path.exists(self.path_header):
+            with open(self.path_header, 'r') as f:
+                self.headers = json.load(f)
+        else:
+            self.headers = []
+            self.save_headers()
+
+        # Opened memory maps for writting, one per slice
+        self.maps_writting = {}
+
+    def __len__(self):
+        return len(self.headers)
+
+    def save_headers(self):
+        """
+        Write the header file. It is written in a temporary file first, such
+        that a crash never leaves a corrupted header.
+        """
+        _debug('MapStack: save_headers')
+
+        fd, path_temp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.headers, f, indent=1)
+        os.replace(path_temp, self.path_header)
+
+    def get_path_slice(self, index, name='slice'):
+        """
+        Return the path of the file for the slice index.
+        """
+        return os.path.join(self.path, '%s_%04d.npy'%(name, index))
+
+    def new_slice(self, Ny, Nx, headers):
+        """
+        Add an empty slice (filled with zeros) to the stack and return its
+        index. The rows are then written with write_rows.
+
+        Ny, Nx:
+            Number of rows and columns of the map.
+        headers:
+            Dictionary of the information of the slice (Vx_min, z, date, ...).
+            The values must be convertible to json.
+        """
+        _debug('MapStack: new_slice')
+
+        index = len(self.headers)
+        headers = dict(headers)
+        headers['Ny'] = int(Ny)
+        headers['Nx'] = int(Nx)
+        # The map is created on the disk right away, and filled later
+        Z = np.lib.format.open_memmap(self.get_path_slice(index), mode='w+',
+                                      dtype=np.float64, shape=(int(Ny), int(Nx)))
+        self.maps_writting[index] = Z
+        self.headers.append(_to_json_friendly(headers))
+        self.save_headers()
+        return index
+
+    def write_rows(self, index, row_start, rows):
+        """
+        Write some consecutive rows of the slice index.
+
+        row_start:
+            Index of the first row to write.
+        rows:
+            2D array of the rows to write.
+        """
+        _debug('MapStack: write_rows')
+
+        if not(index in self.maps_writting):
+            self.maps_writting[index] = np.load(self.get_path_slice(index),
+                                                mmap_mode='r+')
+        Z = self.maps_writting[index]
+        Z[row_start:row_start+len(rows)] = rows
+        Z.flush()
+
+    def write_pixels(self, index, rows, columns, values):
+        """
+        Write some pixels of the slice index, anywhere in the map (for the
+        scans that are not row by row). Only the pages of the file containing
+        these pixels are written.
+
+        rows, columns:
+            Arrays of the row and column of each pixel.
+        values:
+            Array of the value of each pixel.
+        """
+        _debug('MapStack: write_pixels')
+
+        if not(index in self.maps_writting):
+            self.maps_writting[index] = np.load(self.get_path_slice(index),
+                                                mmap_mode='r+')
+        Z = self.maps_writting[index]
+        Z[np.asarray(rows), np.asarray(columns)] = values
+        Z.flush()
+
+    def close_slice(self, index, measured=None, headers={}):
+        """
+        Finish the writting of the slice index.
+
+        measured:
+            2D boolean array of which pixels are measured. It is saved only if
+            some pixels are not measured.
+        headers:
+            Extra information to add to the headers of the slice.
+        """
+        _debug('MapStack: close_slice')
+
+        if index in self.maps_writting:
+            self.maps_writting[index].flush()
+            del self.maps_writting[index]
+        if not(measured is None) and not(np.all(measured)):
+            np.save(self.get_path_slice(index, 'measured'), np.asarray(measured, dtype=bool))
+            self.headers[index]['Nb_measured'] = int(np.sum(measured))
+        self.headers[index].update(_to_json_friendly(headers))
+        self.save_headers()
+
+    def add_slice(self, Z, headers, measured=None):
+        """
+        Add a complete slice at once. Return its index.
+        """
+        _debug('MapStack: add_slice')
+
+        index = self.new_slice(np.shape(Z)[0], np.shape(Z)[1], headers)
+        self.write_rows(index, 0, Z)
+        self.close_slice(index, measured)
+        return index
+
+    def get_slice(self, index):
+        """
+        Return the map of the slice index, as a read-only memory map. Nothing
+        is read from the disk until the values are used.
+        """
+        _debug('MapStack: get_slice')
+
+        return np.load(self.get_path_slice(index), mmap_mode='r')
+
+    def get_measured(self, index):
+        """
+        Return which pixels are measured in the slice index, or None if they
+        are all measured.
+        """
+        path = self.get_path_slice(index, 'measured')
+        if os.path.exists(path):
+            return np.load(path)
+        return None
+
+    def get_headers(self, index):
+        """
+        Return the dictionary of the headers of the slice index.
+        """
+        return self.headers[index]
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import shutil
+    import time
+
+    path = 'stack_test'
+    stack = MapStack(path)
+    Ny, Nx = 500, 500
+    for k in range(4):
+        index = stack.new_slice(Ny, Nx, {'z':k*0.1, 'Vx_min':-1, 'Vx_max':1})
+        for row in range(Ny):
+            stack.write_rows(index, row, np.random.poisson(100, (1, Nx)))
+        stack.close_slice(index)
+
+    t0 = time.time()
+    stack = MapStack(path)
+    Z = np.array(stack.get_slice(2))
+    print('Loading one slice of %d: %.4f s'%(len(stack), time.time()-t0), Z.shape, Z.mean())
+    shutil.rmtree(path)
@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Fri Oct 23 14:05:37 2026
+
+Goal: Evaluate the model functions f0, fp, fm of the Bayes inference on the
+grid of the rates only once per time to probe.
+
+The adaptive protocol probes the same few times over and over, and each
+measurement needs f0, fp and fm on the whole grid (gamma+, gamma-). The tables
+are kept for the last times used (least recently used are forgotten) and are
+forgotten when the grid changes (rediscretization).
+
+If the functions are methods of a PLModel that has get_coefs, all the terms
+that don't depend on the time (G0, betap, betam and the coefficients of each
+function) are computed once per grid, and the two exponentials once per time
+for the three functions. Otherwise the functions are simply called and their
+tables kept.
+
+@author: Childresslab
+"""
+
+import numpy as np
+from collections import OrderedDict
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+class ModelCache():
+    """
+    Tables of the model functions on a grid, for each time to probe.
+
+    Typical use:
+        cache = ModelCache([f0, fp, fm])
+        cache.set_grid(Gp_Axis, Gm_Axis) # Again each time the grid changes
+        f0s, fps, fms = cache.get(t_probe)
+    """
+    def __init__(self, model_functions, maxsize=8):
+        """
+        model_functions = [f0, fp, fm]
+
+        f0,fp,fm:
+            Function with signature (t,Gp,Gm).
+        maxsize:
+            Maximum number of times to probe kept. Each one takes three
+            arrays of the size of the grid.
+        """
+        _debug('ModelCache: __init__')
+        _debug('Work smarter, not harder. – Allen F. Morgenstern')
+
+        self.model_functions = model_functions
+        self.maxsize = maxsize
+
+        # The shared terms can be precomputed if the functions are methods of
+        # a model giving their coefficients
+        self.model = getattr(model_functions[0], '__self__', None)
+        self.is_structured = True
+        for f in model_functions:
+            if not(getattr(f, '__self__', None) is self.model and hasattr(self.model, 'get_coefs')):
+                self.is_structured = False
+
+        self.grid_id = 0 # Changes with each grid, part of the keys of the tables
+        self.tables  = OrderedDict() # (t_probe, grid_id): (f0s, fps, fms)
+        self.nb_hits   = 0
+        self.nb_misses = 0
+        self.Gp_Axis = None
+        self.Gm_Axis = None
+
+    def set_grid(self, Gp_Axis, Gm_Axis):
+        """
+        Use a new grid (meshgrid of gamma+ and gamma-). The tables of the
+        previous grid are forgotten.
+        """
+        _debug('ModelCache: set_grid')
+
+        self.Gp_Axis = Gp_Axis
+        self.Gm_Axis = Gm_Axis
+        self.grid_id += 1
+        self.tables.clear()
+
+        if self.is_structured:
+            # Everything that doesn't depend on the time
+            Gp, Gm = Gp_Axis, Gm_Axis
+            self.G0    = np.sqrt(Gp*Gp + Gm*Gm - Gp*Gm)
+            self.betap = Gm + Gp + self.G0
+            self.betam = Gm + Gp - self.G0
+            self.coefs = [self.model.get_coefs(f.__name__, Gp, Gm, self.G0)
+                          for f in self.model_functions]
+
+    def is_grid(self, Gp_Axis, Gm_Axis):
+        """
+        Return True if the arrays are the grid of the cache.
+        """
+        return (Gp_Axis is self.Gp_Axis) and (Gm_Axis is self.Gm_Axis)
+
+    def get(self, t_probe):
+        """
+        Return the list of the tables [f0s, fps, fms] of the model functions
+        on the grid at the time t_probe. The tables are read-only.
+        """
+        key = (float(t_probe), self.grid_id)
+        if key in self.tables:
+            self.nb_hits += 1
+            self.tables.move_to_end(key)
+            return self.tables[key]
+        self.nb_misses += 1
+
+        if self.is_structured:
+            # The two exponentials are shared by all the functions
+            exp_p = np.exp(-t_probe*self.betap)
+            exp_m = np.exp(-t_probe*self.betam)
+            A, B = self.model.A, self.model.B
+            tables = [A + B*(coefm*exp_m + coefp*exp_p) for coefp, coefm in self.coefs]
+        else:
+            tables = [f(t_probe, self.Gp_Axis, self.Gm_Axis) for f in self.model_functions]
+        for table in tables:
+            table.flags.writeable = False
+
+        self.tables[key] = tables
+        if len(self.tables) > self.maxsize:
+            self.tables.popitem(last=False) # The least recently used
+        return tables
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import time
+
+    # A model with the same form as PLModel
+    class Model():
+        A, B = 0.04 - 0.2*0.04*2/3, 0.2*0.04/6
+        def get_coefs(self, name, Gp, Gm, G0):
+            return {'PL00':((2*G0 + Gm + Gp)/G0, (2*G0 - Gm - Gp)/G0),
+                    'PLp0':(-(G0 - Gm + 2*Gp)/G0, -(G0 + Gm - 2*Gp)/G0),
+                    'PLm0':(-(G0 + 2*Gm - Gp)/G0, -(G0 - 2*Gm + Gp)/G0)}[name]
+        def evaluate(self, name, t, Gp, Gm):
+            G0 = np.sqrt(Gp*Gp + Gm*Gm - Gp*Gm)
+            coefp, coefm = self.get_coefs(name, Gp, Gm, G0)
+            return self.A + self.B*(coefm*np.exp(-t*(Gm + Gp - G0)) + coefp*np.exp(-t*(Gm + Gp + G0)))
+        def PL00(self, t, Gp, Gm): return self.evaluate('PL00', t, Gp, Gm)
+        def PLp0(self, t, Gp, Gm): return self.evaluate('PLp0', t, Gp, Gm)
+        def PLm0(self, t, Gp, Gm): return self.evaluate('PLm0', t, Gp, Gm)
+
+    model = Model()
+    model_functions = [model.PL00, model.PLp0, model.PLm0]
+    Gp_Axis, Gm_Axis = np.meshgrid(np.linspace(1e3, 100e3, 500), np.linspace(1e3, 100e3, 500))
+    cache = ModelCache(model_functions)
+    cache.set_grid(Gp_Axis, Gm_Axis)
+
+    # The adaptive protocol probing a few times over and over
+    t_probes = [5e-6, 10e-6, 20e-6]*10
+    t0 = time.time()
+    for t in t_probes:
+        tables = [f(t, Gp_Axis, Gm_Axis) for f in model_functions]
+    t_direct = time.time() - t0
+    t0 = time.time()
+    for t in t_probes:
+        tables_cache = cache.get(t)
+    t_cache = time.time() - t0
+    print('%d evaluations: %.0f ms with the cache instead of %.0f ms (%d hits, %d misses)'%(
+          len(t_probes), t_cache*1e3, t_direct*1e3, cache.nb_hits, cache.nb_misses))
+    print('Largest difference:', max([np.max(np.abs(a - b)) for a, b in zip(tables, tables_cache)]))
@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 11:03:27 2026
+
+Goal: Decide when to re-optimize the position on the NV, based on the drop
+of the counts instead of a fixed number of loops.
+
+Right after an optimization, the first few values of a reference statistic
+(for example the total counts of one FPGA loop) define a baseline. The
+following values are smoothed and the optimization is triggered when the
+smoothed value drops significantly below a fraction of the baseline.
+
+The policy also keeps track of the time between two needed optimizations,
+which gives an idea of how fast the setup drifts.
+
+@author: Childresslab
+"""
+
+import numpy as np
+import time
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def total_counts(counts, CET_mode=False):
+    """
+    Return the total number of counts in the output of the fpga.
+
+    counts:
+        Output of FPGA_api.get_counts()
+    CET_mode:
+        If True, the counts are in Count Each Tick mode. Each int32 is then
+        32 ticks, each bit being one count.
+    """
+    counts = np.asarray(counts)
+    if CET_mode:
+        # Count the bits that are on, all at once
+        bytes_ = np.ascontiguousarray(counts, dtype=np.uint32).view(np.uint8)
+        return int(np.unpackbits(bytes_).sum())
+    return float(np.sum(counts))
+
+
+class DriftOptimizePolicy():
+    """
+    Decide when to optimize, based on the drop of a reference statistic.
+    """
+    def __init__(self, threshold_fraction=0.9, nb_sigma=3, N_baseline=5,
+                 smoothing=0.3, N_max=0, nb_interval_memory=20):
+        """
+        threshold_fraction:
+            The optimization is triggered when the smoothed statistic drops
+            below this fraction of the baseline. Put zero for never
+            triggering on the drop.
+        nb_sigma:
+            The drop must also be larger than this number of standard
+            deviations, for not optimizing on a noise fluctuation.
+        N_baseline:
+            Number of values taken after an optimization for defining the
+            baseline.
+        smoothing:
+            Weight of the new value in the exponential moving average
+            (between 0 and 1). 1 means no smoothing.
+        N_max:
+            Maximum number of values before forcing an optimization, whatever
+            the counts are doing. Put zero for no maximum.
+        nb_interval_memory:
+            Number of intervals between optimizations to remember for the
+            drift model.
+        """
+        _debug('DriftOptimizePolicy: __init__')
+        _debug('It always seems impossible until it’s done. – Nelson Mandela')
+
+        self.threshold_fraction = threshold_fraction
+        self.nb_sigma           = nb_sigma
+        self.N_baseline         = N_baseline
+        self.smoothing          = smoothing
+        self.N_max              = N_max
+        self.nb_interval_memory = nb_interval_memory
+
+        self.reset()
+
+    def reset(self):
+        """
+        Forget everything, including the drift model.
+        """
+        _debug('DriftOptimizePolicy: reset')
+
+        self.intervals_s    = [] # Time between two needed optimizations
+        self.intervals_iter = [] # Same, but in number of values
+        self.time_last_optimization = None
+        self.restart_baseline()
+
+    def restart_baseline(self):
+        """
+        Start a new baseline with the next values. Call this when the
+        reference statistic changes meaning (for example a new experiment).
+        """
+        _debug('DriftOptimizePolicy: restart_baseline')
+
+        self.baseline_values = []
+        self.baseline_mean   = None
+        self.baseline_std    = None
+        self.smoothed        = None
+        self.nb_values       = 0 # Since the last optimization
+        self.times  = [] # Time of each value since the baseline
+        self.values = [] # Each value since the baseline
+        self.trigger_reason = None # 'drop' or 'maximum', when it is time to optimize
+
+    def optimization_done(self, triggered_by_drift=None, t=None):
+        """
+        Note that an optimization was done.
+
+        triggered_by_drift:
+            If True, the interval since the last optimization is used for
+            learning how fast the setup drifts. By default, this is True only
+            if the last call of add_value detected a drop of the counts.
+        t:
+            Time of the optimization (in s). Default is now.
+        """
+        _debug('DriftOptimizePolicy: optimization_done')
+
+        if t is None:
+            t = time.time()
+        if triggered_by_drift is None:
+            triggered_by_drift = self.trigger_reason == 'drop'
+        if triggered_by_drift and not(self.time_last_optimization is None):
+            self.intervals_s   .append(t - self.time_last_optimization)
+            self.intervals_iter.append(self.nb_values)
+            self.intervals_s    = self.intervals_s   [-self.nb_interval_memory:]
+            self.intervals_iter = self.intervals_iter[-self.nb_interval_memory:]
+        self.time_last_optimization = t
+        self.restart_baseline()
+
+    def add_value(self, value, t=None):
+        """
+        Add one value of the reference statistic.
+        Return True if it is time to optimize.
+
+        value:
+            Reference statistic (for example the total counts of one loop).
+        t:
+            Time of the value (in s). Default is now.
+        """
+        _debug('DriftOptimizePolicy: add_value')
+
+        if t is None:
+            t = time.time()
+        if self.time_last_optimization is None:
+            self.time_last_optimization = t
+
+        self.nb_values += 1
+        self.times .append(t)
+        self.values.append(value)
+
+        # Safety net
+        if self.N_max>0 and self.nb_values >= self.N_max:
+            self.trigger_reason = 'maximum'
+            return True
+
+        # Build the baseline first
+        if self.baseline_mean is None:
+            self.baseline_values.append(value)
+            if len(self.baseline_values) >= self.N_baseline:
+                self.baseline_mean = np.mean(self.baseline_values)
+                # The statistic is made of counts, so it is at least as noisy
+                # as a Poisson process
+                std_measured = np.std(self.baseline_values, ddof=1) if self.N_baseline>1 else 0
+                std_poisson  = np.sqrt(max(self.baseline_mean, 0))
+                self.baseline_std = max(std_measured, std_poisson)
+                self.smoothed = self.baseline_mean
+            return False
+
+        # Smooth the values
+        a = self.smoothing
+        self.smoothed = a*value + (1-a)*self.smoothed
+
+        if self.threshold_fraction <= 0:
+            return False
+        # Standard deviation of the moving average for uncorrelated values
+        std_smoothed = self.baseline_std*np.sqrt(a/(2-a))
+        drop = self.baseline_mean - self.smoothed
+        is_below = self.smoothed < self.threshold_fraction*self.baseline_mean
+        is_significant = drop > self.nb_sigma*std_smoothed
+        if is_below and is_significant:
+            self.trigger_reason = 'drop'
+            return True
+        return False
+
+    def get_drift_rate(self):
+        """
+        Return the fractional change of the statistic per second since the
+        baseline, from a linear fit (negative when the counts drop).
+        Return None if there is not enough values.
+        """
+        _debug('DriftOptimizePolicy: get_drift_rate')
+
+        if self.baseline_mean is None or self.baseline_mean <= 0 or len(self.values)<3:
+            return None
+        ts = np.array(self.times) - self.times[0]
+        if ts[-1] <= 0:
+            return None
+        slope = np.polyfit(ts, self.values, 1)[0]
+        return slope/self.baseline_mean
+
+    def get_typical_interval(self):
+        """
+        Return the typical time (in s) between two needed optimizations,
+        learned from the previous optimizations. Return None if it is not
+        known yet.
+        """
+        _debug('DriftOptimizePolicy: get_typical_interval')
+
+        if len(self.intervals_s) == 0:
+            return None
+        # Median, for not being fooled by one weird interval
+        return float(np.median(self.intervals_s))
+
+    def get_time_before_next(self, t=None):
+        """
+        Return the expected time (in s) before the next optimization.
+        Use the current drift rate if it is known, otherwise the typical
+        interval. Return None if nothing is known.
+        """
+        _debug('DriftOptimizePolicy: get_time_before_next')
+
+        if t is None:
+            t = time.time()
+        rate = self.get_drift_rate()
+        if not(rate is None) and rate<0 and not(self.smoothed is None):
+            fraction_now = self.smoothed/self.baseline_mean
+            return max(0, (fraction_now - self.threshold_fraction)/(-rate))
+        typical = self.get_typical_interval()
+        if typical is None or self.time_last_optimization is None:
+            return None
+        return max(0, typical - (t - self.time_last_optimization))
+
+    def get_info(self):
+        """
+        Return a short string describing the state of the policy.
+        """
+        if self.baseline_mean is None or self.baseline_mean <= 0:
+            return 'Drift: building baseline (%d/%d)'%(len(self.baseline_values),
+                                                       self.N_baseline)
+        text = 'Drift: %.1f %% of baseline'%(100*self.smoothed/self.baseline_mean)
+        typical = self.get_typical_interval()
+        if not(typical is None):
+            text += '\nTypical time between optimizations: %.0f s'%typical
+        return text
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Fake a slow drift of the counts
+    policy = DriftOptimizePolicy(threshold_fraction=0.9)
+    rate = 1000
+    for i in range(500):
+        rate *= 0.998
+        if policy.add_value(np.random.poisson(rate), t=i):
+            print('Optimize at', i, policy.get_info())
+            policy.optimization_done(t=i)
+            rate = 1000
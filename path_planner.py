@@ -0,0 +1,317 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 14:26:51 2026
+
+Goal: Choose the order in which the magnet visits the positions (or sweeps
+the lines), for spending less time moving the actuators.
+
+The actuators are slow (2 mm/s at most), so the time between the
+measurements is mostly the travel. The time of a move is computed from the
+speed limit of each axis (with a trapezoidal speed profile when the
+acceleration is given):
+    - If the three actuators move at the same time, the move lasts as long
+      as the slowest axis.
+    - If they move one after the other, the times of the axes add up.
+    - Along a swept line, the magnet goes in a straight line at a given
+      speed, reduced if an axis would go faster than its limit.
+
+The order is found with the nearest neighbour (always go to the closest
+position not visited yet), then improved with 2-opt (reverse a part of the
+path when it makes it shorter) until nothing improves. For the lines, each
+line can also be swept in both directions.
+
+@author: Childresslab
+"""
+
+import numpy as np
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def get_axis_duration(distances, speed, acceleration=None):
+    """
+    Return the time to travel the distances on one axis, starting and
+    stopping at rest.
+
+    distances:
+        Array of distances (positive).
+    speed:
+        Maximum speed. The time is infinite if it is zero and the distance is
+        not.
+    acceleration:
+        Acceleration and deceleration. None (or zero) for instantaneous.
+    """
+    distances = np.abs(np.asarray(distances, dtype=float))
+    speed = np.asarray(speed, dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        if acceleration is None or acceleration <= 0:
+            durations = distances/speed
+        else:
+            # Trapezoid if the distance is long enough for reaching the speed,
+            # triangle otherwise
+            durations = np.where(distances*acceleration >= speed**2,
+                                 distances/speed + speed/acceleration,
+                                 2*np.sqrt(distances/acceleration))
+    return np.where(distances == 0, 0, durations)
+
+def get_durations(points_a, points_b, speeds, acceleration=None,
+                  speed_line=None, simultaneous=True):
+    """
+    Return the matrix of the time for moving from each point of points_a to
+    each point of points_b (shape (len(points_a), len(points_b))).
+
+    points_a, points_b:
+        Arrays of (x, y, z) positions (mm).
+    speeds:
+        (vx, vy, vz) speed limit of each axis (mm/s).
+    acceleration:
+        Acceleration of the actuators (mm/s^2). None for instantaneous.
+    speed_line:
+        If not None, the magnet moves in a straight line at this speed
+        (mm/s), like when a line is swept. Otherwise each axis moves at its
+        own speed.
+    simultaneous:
+        True if the axes move at the same time, False if they move one after
+        the other. Only used when speed_line is None.
+    """
+    points_a = np.atleast_2d(np.asarray(points_a, dtype=float))
+    points_b = np.atleast_2d(np.asarray(points_b, dtype=float))
+    speeds   = np.asarray(speeds, dtype=float)
+    ds = np.abs(points_a[:,None,:] - points_b[None,:,:]) # (Na, Nb, 3)
+
+    if speed_line is None:
+        durations = get_axis_duration(ds, speeds, acceleration)
+        if simultaneous:
+            return np.max(durations, axis=2)
+        return np.sum(durations, axis=2)
+
+    # Straight line: the speed along the line is reduced if the projection on
+    # an axis is faster than its limit.
+    lengths = np.sqrt(np.sum(ds**2, axis=2))
+    with np.errstate(divide='ignore', invalid='ignore'):
+        speed_max = np.min(np.where(ds > 0, speeds*lengths[:,:,None]/ds, np.inf), axis=2)
+    return get_axis_duration(lengths, np.minimum(speed_line, speed_max), acceleration)
+
+def get_path_duration(points, r_start=None, **kwargs):
+    """
+    Return the time for visiting the points in their order.
+
+    points:
+        Array of (x, y, z) positions.
+    r_start:
+        (x, y, z) position before going to the first point. None for starting
+        on the first point.
+    kwargs:
+        Are sent to get_durations.
+    """
+    points = np.asarray(points, dtype=float)
+    if not(r_start is None):
+        points = np.vstack([r_start, points])
+    if len(points) < 2:
+        return 0
+    moves = [get_durations(points[i], points[i+1], **kwargs)[0,0] for i in range(len(points)-1)]
+    return np.sum(moves)
+
+def improve_2opt(D, path, nb_pass_max=50):
+    """
+    Improve an open path with the 2-opt moves: reverse the part of the path
+    between two positions when it makes the total shorter. The first node is
+    kept fixed. Return the new path.
+
+    D:
+        Matrix of the durations between the nodes (it must be symmetric).
+    path:
+        List of the nodes in the order of the visit.
+    nb_pass_max:
+        Maximum number of passes over the whole path.
+    """
+    path = np.array(path)
+    N = len(path)
+    for n in range(nb_pass_max):
+        improved = False
+        for i in range(1, N-1):
+            # Reverse path[i:j+1] for all j at once. The edge after j doesn't
+            # exist for the last node.
+            js = np.arange(i+1, N)
+            after = np.minimum(js+1, N-1)
+            has_after = js+1 < N
+            old = D[path[i-1], path[i]] + np.where(has_after, D[path[js], path[after]], 0)
+            new = D[path[i-1], path[js]] + np.where(has_after, D[path[i], path[after]], 0)
+            gains = old - new
+            k = np.argmax(gains)
+            if gains[k] > 1e-12:
+                j = js[k]
+                path[i:j+1] = path[i:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return path
+
+def order_points(points, speeds, acceleration=None, r_start=None,
+                 simultaneous=True, nb_pass_max=50):
+    """
+    Return the order (array of indices) in which to visit the points for
+    spending the less time moving.
+
+    points:
+        Array of (x, y, z) positions.
+    speeds, acceleration, simultaneous:
+        See get_durations.
+    r_start:
+        (x, y, z) position of the magnet before the visit. If None, the visit
+        starts with the first point.
+    """
+    _debug('order_points')
+
+    points = np.asarray(points, dtype=float)
+    if len(points) < 3:
+        return np.arange(len(points))
+    # The first node is the start (the magnet or the first point)
+    if r_start is None:
+        nodes = points
+    else:
+        nodes = np.vstack([r_start, points])
+    D = get_durations(nodes, nodes, speeds, acceleration, simultaneous=simultaneous)
+    # Make it symmetric, in case the limits are not
+    D = 0.5*(D + D.T)
+
+    # Nearest neighbour
+    is_visited = np.zeros(len(nodes), dtype=bool)
+    path = [0]
+    is_visited[0] = True
+    for n in range(len(nodes)-1):
+        durations = np.where(is_visited, np.inf, D[path[-1]])
+        path.append(int(np.argmin(durations)))
+        is_visited[path[-1]] = True
+
+    path = improve_2opt(D, path, nb_pass_max)
+    if r_start is None:
+        return path
+    return path[1:] - 1
+
+def order_lines(starts, ends, speeds, acceleration=None, r_start=None,
+                speed_line=None, simultaneous=True, nb_pass_max=50):
+    """
+    Return (order, is_flipped) for sweeping the lines with the less time
+    between them. order is the array of the indices of the lines and
+    is_flipped tells, for each line in order, if it must be swept from its
+    end to its start.
+
+    starts, ends:
+        Arrays of the (x, y, z) start and end of each line.
+    speeds, acceleration, speed_line, simultaneous:
+        How the magnet goes from a line to the next, see get_durations.
+    r_start:
+        (x, y, z) position of the magnet before the first line. If None, the
+        first line is the first one, not flipped.
+    """
+    _debug('order_lines')
+
+    starts = np.asarray(starts, dtype=float)
+    ends   = np.asarray(ends  , dtype=float)
+    N = len(starts)
+    kwargs = {'speeds':speeds, 'acceleration':acceleration,
+              'speed_line':speed_line, 'simultaneous':simultaneous}
+
+    # Durations between the extremities. Extremity 2k is the start of the
+    # line k and 2k+1 its end.
+    extremities = np.empty((2*N, 3))
+    extremities[0::2] = starts
+    extremities[1::2] = ends
+    D = get_durations(extremities, extremities, **kwargs)
+    D = 0.5*(D + D.T)
+
+    # Nearest neighbour, on the closest extremity of each line
+    is_visited = np.zeros(N, dtype=bool)
+    if r_start is None:
+        order, is_flipped = [0], [False]
+        is_visited[0] = True
+        D_from = D[1]
+    else:
+        order, is_flipped = [], []
+        D_from = get_durations(r_start, extremities, **kwargs)[0]
+    for n in range(N - len(order)):
+        durations = np.where(np.repeat(is_visited, 2), np.inf, D_from)
+        e = int(np.argmin(durations))
+        order     .append(e//2)
+        is_flipped.append(e%2 == 1)
+        is_visited[e//2] = True
+        # We leave from the other extremity
+        D_from = D[e^1]
+
+    # 2-opt: reversing a part of the sequence also flips its lines. Only the
+    # moves at the two ends of that part change.
+    order      = np.array(order)
+    is_flipped = np.array(is_flipped)
+    D_start = None if r_start is None else get_durations(r_start, extremities, **kwargs)[0]
+    i_min = 1 if r_start is None else 0
+    for n in range(nb_pass_max):
+        improved = False
+        for i in range(i_min, N):
+            entries = 2*order + is_flipped       # Extremity where we arrive
+            exits   = 2*order + 1 - is_flipped   # Extremity where we leave
+            js = np.arange(i, N)
+            after = np.minimum(js+1, N-1)
+            has_after = js+1 < N
+            if i == 0:
+                # Coming from r_start
+                old = D_start[entries[i]] + 0*js
+                new = D_start[exits[js]]
+            else:
+                old = D[exits[i-1], entries[i]] + 0*js
+                new = D[exits[i-1], exits[js]]
+            old = old + np.where(has_after, D[exits[js], entries[after]], 0)
+            new = new + np.where(has_after, D[entries[i], entries[after]], 0)
+            gains = old - new
+            k = np.argmax(gains)
+            if gains[k] > 1e-12:
+                j = js[k]
+                order     [i:j+1] = order[i:j+1][::-1]
+                is_flipped[i:j+1] = ~is_flipped[i:j+1][::-1]
+                improved = True
+        if not improved:
+            break
+    return order, is_flipped
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import time
+
+    speeds = [2, 2, 2]
+    acceleration = 10
+
+    # Positions of a list sweep, in a random order
+    points = np.random.uniform(10, 20, (200, 3))
+    r_start = np.array([15, 15, 15])
+    t0 = time.time()
+    order = order_points(points, speeds, acceleration, r_start)
+    dt = time.time() - t0
+    before = get_path_duration(points, r_start, speeds=speeds, acceleration=acceleration)
+    after  = get_path_duration(points[order], r_start, speeds=speeds, acceleration=acceleration)
+    print('Points: %.0f s -> %.0f s of travel (planned in %.2f s)'%(before, after, dt))
+
+    # Lines entered in any order and direction
+    starts = np.random.uniform(10, 20, (40, 3))
+    ends   = starts + np.random.uniform(-2, 2, (40, 3))
+    def get_transit(starts, ends):
+        return sum([get_durations(ends[i], starts[i+1], speeds, acceleration)[0,0]
+                    for i in range(len(starts)-1)])
+    order, is_flipped = order_lines(starts, ends, speeds, acceleration)
+    new_starts = np.where(is_flipped[:,None], ends[order], starts[order])
+    new_ends   = np.where(is_flipped[:,None], starts[order], ends[order])
+    print('Lines: %.0f s -> %.0f s between the lines'%(get_transit(starts, ends),
+                                                         get_transit(new_starts, new_ends)))
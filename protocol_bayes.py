@@ -11,10 +11,14 @@ Goal: Implement the Bayes protocole in object.
 
 import numpy as np
 import time 
-from scipy import interpolate # Useful for the rediscretization of the domain
-from scipy.optimize import minimize # For some method for determining the best time to probe
+from scipy.interpolate import RegularGridInterpolator # Useful for the rediscretization of the domain
+from concurrent.futures import ThreadPoolExecutor # For evaluating the times to probe in parallel
+from model_cache import ModelCache # For evaluating the model only once per time to probe
 
 import matplotlib.pyplot as plt 
+# Trapezoidal rule. np.trapz is called np.trapezoid since numpy 2.0, and 
+# removed in the latest numpy
+_trapz = getattr(np, 'trapezoid', None) or np.trapz
 
 
 from protocol_baseclass import Protocol
@@ -43,8 +47,61 @@ def integral_2D(x,y, Z):
 #               'x:', x,
 #               'y:', y,
 #               'Z:', Z)
-    firstInt = np.trapz(Z, x=x, axis=1) #First integrate along the first axis
-    return     np.trapz(firstInt, x=y) #Integrate over the remaining axis
+    firstInt = _trapz(Z, x=x, axis=1) #First integrate along the first axis
+    return     _trapz(firstInt, x=y) #Integrate over the remaining axis
+
+def trapz_weights(x):
+    """
+    Return the weights w of the trapezoidal rule on the axis x, such that 
+    _trapz(z, x=x) = np.sum(w*z). Works for non-uniform axis. 
+    """
+    dx = np.diff(x)
+    w = np.zeros(len(x))
+    w[:-1] += 0.5*dx
+    w[1: ] += 0.5*dx
+    return w
+
+def likelihood_3measure(exp0, expp, expm, diffp, diffm):
+    """
+    Return L, minus the logarithm of the like-lihood of the measured 
+    differences (not normalized), for each element of the domain. 
+    In the following, R is the total number of readout performed. 
+    
+    exp0, expp, expm:
+        (array) Expectation for R*f0, R*fp and R*fm.
+    diffp, diffm:
+        (float) Measured TOTAL differences R*(f0-fp) and R*(f0-fm). 
+    """
+    # Precompute arrays for simplification
+    ZZZ = expp*expm +exp0*(expp+expm)
+    
+    A = (exp0 + expp + expm +2*(diffp+diffm) 
+        + diffp*diffp/expp + diffm*diffm/expm )
+    
+    B = (expp*diffm + expm*(3*expp+diffp))**2       
+    C = exp0/(expp*expm*ZZZ)
+    # THE like-lihood
+    L = 0.5*(np.log(ZZZ) + A - B*C )
+    
+    return L  
+
+def get_adaptive_axis(lower, upper, N, center, width, concentration=0.5):
+    """
+    Return an axis of N points from lower to upper, denser near center. 
+    
+    A fraction concentration (between 0 and 1, excluded) of the points is 
+    distributed like a gaussian of standard deviation width centered on 
+    center, the rest uniformly. With concentration=0, this is 
+    np.linspace(lower, upper, N).
+    """
+    if concentration <= 0 or not(width > 0):
+        return np.linspace(lower, upper, N)
+    # Inverse of the cumulative distribution of the density of points
+    x = np.linspace(lower, upper, 20*N)
+    density = ((1-concentration)/(upper-lower) + 
+               concentration*np.exp(-0.5*((x-center)/width)**2)/(np.sqrt(2*np.pi)*width))
+    cdf = np.concatenate([[0], np.cumsum(0.5*(density[1:]+density[:-1])*np.diff(x))])
+    return np.interp(np.linspace(0, cdf[-1], N), cdf, x)
 
 
 
@@ -58,7 +115,7 @@ class Bayes3Measure(Protocol):
      
     """
 
-    def __init__(self, model_functions, constants):
+    def __init__(self, model_functions, constants, use_float32=False):
         """
         model_functions = [f0, fp, fm]
         constants = [PL0, contrast]
@@ -74,6 +131,10 @@ class Bayes3Measure(Protocol):
             defined such that the photoluminescence coming from ms=+-1 is 
             PL0*(1-contrast)      
                      
+        use_float32:
+            If True, the exponential of the posterior and its moments are 
+            computed in single precision. Faster and half the memory for large
+            grids. The logarithm of the posterior stays in double precision.
             
         """
         _debug('Bayes3Measure: __init__')
@@ -91,6 +152,18 @@ class Bayes3Measure(Protocol):
         # they are not taken into account 
         self.constants = constants
         
+        # Precision of the posterior
+        if use_float32:
+            self.dtype = np.float32
+        else:
+            self.dtype = np.float64
+        
+        # Threads for evaluating the times to probe, created when needed
+        self.executor = None
+        
+        # Tables of the model functions on the grid, for each time probed
+        self.model_cache = ModelCache(model_functions)
+        
     def __repr__(self):
         """
         Returns the string that appears when you inspect the object.
@@ -113,38 +186,86 @@ class Bayes3Measure(Protocol):
         """
         Update the likehihood, from the knowledge of the cumulated measurement
         
-        TODO Epxlain the inputs
+        See likelihood_3measure for the inputs. 
             
         """
         _debug('Bayes3Measure: get_likelihood_3measure')
-        # Precompute arrays for simplification
-        ZZZ = expp*expm +exp0*(expp+expm)
-        
-        A = (exp0 + expp + expm +2*(diffp+diffm) 
-            + diffp*diffp/expp + diffm*diffm/expm )
-        
-        B = (expp*diffm + expm*(3*expp+diffp))**2       
-        C = exp0/(expp*expm*ZZZ)
-        # THE like-lihood
-        L = 0.5*(np.log(ZZZ) + A - B*C )
-        
-        return L  
+        return likelihood_3measure(exp0, expp, expm, diffp, diffm)
             
     def update_post(self):
         """
         Update the posterior. 
         Compute it from the like-lihood and the prior, than normalize it
+        
+        Everything is done with the logarithm log(post) = log(prior) - L, which
+        is shifted by its maximum before taking the exponential. The 
+        normalization is thus a logsumexp (weighted by the trapezoidal rule) 
+        and nothing can overflow or underflow, however large L is. 
+        The normalization, the mean, the covariance and the maximum are 
+        obtained in the same pass over the grid. 
         """
         _debug('Bayes3Measure: update_post' )
             
-        #Get the posterior from the like-lihood and the prior
-        self.Ppost  = np.exp(-self.L)*self.prior
-        self.Ppost /= self.integral2D(self.gp_axis, self.gm_axis, self.Ppost) #Normalize 
+        #Get the logarithm of the posterior from the like-lihood and the prior (not normalized)
+        self.logPost = self.log_prior - self.L 
+        # Position of the maximum of the posterior
+        self.ind = np.unravel_index(np.argmax(self.logPost), self.logPost.shape)
+        i = self.ind[0]
+        j = self.ind[1]
+        logPost_max = self.logPost[i][j]
+        # Posterior shifted such that its maximum is 1
+        W = np.exp(self.logPost - logPost_max, dtype=self.dtype)
+        
+        # Moments of W, centered on the maximum to avoid the cancellations.
+        # With the weights of the trapezoidal rule in the matrices, 
+        # M[a][b] = integral of W*dGm**a*dGp**b, for a,b = 0,1,2
+        dGp = self.gp_axis - self.gp_axis[j]
+        dGm = self.gm_axis - self.gm_axis[i]
+        wp = trapz_weights(self.gp_axis)
+        wm = trapz_weights(self.gm_axis)
+        Xp = np.column_stack([wp, wp*dGp, wp*dGp*dGp]).astype(self.dtype)
+        Xm = np.column_stack([wm, wm*dGm, wm*dGm*dGm]).astype(self.dtype)
+        W_rows = np.dot(W, Xp)
+        M = np.dot(Xm.T, W_rows).astype(np.float64)
+        # Probability of each row (gamma-), for drawing points from the posterior
+        self.mass_rows = W_rows[:,0]*wm
+        
+        #Normalize 
+        self.log_norm = logPost_max + np.log(M[0][0]) # Logarithm of the integral of exp(logPost)
+        W /= M[0][0]
+        self.Ppost = W
+        M /= M[0][0]
+        
+        # Mean and covariance matrix, about the mean and about the maximum
+        self.Gp_mean = self.gp_axis[j] + M[0][1]
+        self.Gm_mean = self.gm_axis[i] + M[1][0]
+        self.cov_post_max = np.array([[M[0][2], M[1][1]],
+                                      [M[1][1], M[2][0]]])
+        self.cov_post = self.cov_post_max - np.outer([M[0][1], M[1][0]], [M[0][1], M[1][0]])
         if _debug_enabled:
             #Put this debug into an extra of, because the extra calculation of the volume might be expensive 
             _debug('Volume of posterior (its not fun)  = ', self.integral2D(self.gp_axis, self.gm_axis, self.Ppost ) )    
    
 
+    def get_curvatures(self, i, j):
+        """
+        Return the second derivatives (A, B, C) of self.logP at the point 
+        [i][j] (not on the edge), in the direction of gamma+, gamma- and both.
+        The axis don't need to be uniform. 
+        """
+        f = self.logP
+        # Spacing before and after the point
+        hp1, hp2 = self.gp_axis[j] - self.gp_axis[j-1], self.gp_axis[j+1] - self.gp_axis[j]
+        hm1, hm2 = self.gm_axis[i] - self.gm_axis[i-1], self.gm_axis[i+1] - self.gm_axis[i]
+        # Second derivative in the direction of gamma+
+        A = 2*(hp1*f[i][j+1] - (hp1+hp2)*f[i][j] + hp2*f[i][j-1])/(hp1*hp2*(hp1+hp2))
+        # Second derivative in the direction of gamma-
+        B = 2*(hm1*f[i+1][j] - (hm1+hm2)*f[i][j] + hm2*f[i-1][j])/(hm1*hm2*(hm1+hm2))
+        #Second derivative in both direction
+        C = (f[i+1][j+1] + f[i-1][j-1]
+            -f[i-1][j+1] - f[i+1][j-1])/((hp1+hp2)*(hm1+hm2))
+        return A, B, C
+        
     def compute_variance(self, method='integral'):
         """
         Computhe the variance the the posterior. 
@@ -152,14 +273,10 @@ class Bayes3Measure(Protocol):
             string 
         """
         if method =='integral':
-            # Simplify the integral by first calculate the second orde moements
-            mean_Gp2  = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gp_Axis*self.Gp_Axis)) 
-            mean_Gm2  = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gm_Axis*self.Gm_Axis)) 
-            mean_GpGm = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gp_Axis*self.Gm_Axis)) 
-            # From the moments, get the covariances
-            self.cov_Gp   = mean_Gp2  - self.Gp_guess*self.Gp_guess
-            self.cov_Gm   = mean_Gm2  - self.Gm_guess*self.Gm_guess
-            self.cov_GpGm = mean_GpGm - self.Gp_guess*self.Gm_guess            
+            # The second order moments are already computed with the posterior
+            self.cov_Gp   = self.cov_post[0][0]
+            self.cov_Gm   = self.cov_post[1][1]
+            self.cov_GpGm = self.cov_post[0][1]
         
     def process_post(self, method='mix'):
         """
@@ -184,9 +301,9 @@ class Bayes3Measure(Protocol):
             """
             _debug('Integral')
             #Get the expected mean for both rates
-            #Integrate in 2D. 
-            self.Gp_guess  = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*self.Gp_Axis)
-            self.Gm_guess  = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*self.Gm_Axis)
+            #Integrated in 2D with the posterior. 
+            self.Gp_guess  = self.Gp_mean
+            self.Gm_guess  = self.Gm_mean
             #Get the covariant matrix element
             self.compute_variance()
         
@@ -198,10 +315,9 @@ class Bayes3Measure(Protocol):
             _debug('Parabola')
             # Take the maximum of the posterior for the best estimate
             # Use the logarithm of the posterior, to ease the calculation
-            self.logP = -np.log(self.Ppost) # DO NOT take self.L, because we also need the prior
-            # Get the indices of the minimum 
+            self.logP = self.log_norm - self.logPost # DO NOT take self.L, because we also need the prior
+            # Get the indices of the minimum (found with the posterior)
             shape = self.logP.shape
-            self.ind = np.unravel_index(self.logP.argmin(), shape)
             i = self.ind[0]
             j = self.ind[1]
 
@@ -217,15 +333,8 @@ class Bayes3Measure(Protocol):
             self.Gp_guess = self.Gp_Axis[i][j]  # The mean is for if there are more than one max
             self.Gm_guess = self.Gm_Axis[i][j] 
           
-            # Second derivative in the direction of gamma+
-            dGp = self.Gp_Axis[i][j+1] - self.Gp_Axis[i][j]
-            A = (self.logP[i][j+1]+self.logP[i][j-1]-2*self.logP[i][j])/(dGp*dGp) 
-            # Second derivative in the direction of gamma-
-            dGm = self.Gm_Axis[i+1][j+1] - self.Gm_Axis[i][j]
-            B = (self.logP[i+1][j]+self.logP[i-1][j]-2*self.logP[i][j])/(dGm*dGm)                       
-            #Second derivative in both direction
-            C = (self.logP[i+1][j+1] + self.logP[i-1][j-1]
-                -self.logP[i-1][j+1] - self.logP[i+1][j-1])/(4*dGp*dGm)
+            # Second derivatives of -log(post) around the maximum
+            A, B, C = self.get_curvatures(i, j)
             # Get the covariance matrix element 
             D2 = A*B-C*C
             # IF is too flat
@@ -254,10 +363,9 @@ class Bayes3Measure(Protocol):
             _debug('Mix')
             # Take the maximum of the posterior for the best estimate
             # Use the logarithm of the posterior, to ease the calculation
-            self.logP = -np.log(self.Ppost) # DO NOT take self.L, because we also need the prior
-            # Get the indices of the minimum 
+            self.logP = self.log_norm - self.logPost # DO NOT take self.L, because we also need the prior
+            # Get the indices of the minimum (found with the posterior)
             shape = self.logP.shape
-            self.ind = np.unravel_index(self.logP.argmin(), shape)
             i = self.ind[0]
             j = self.ind[1]
             
@@ -267,20 +375,13 @@ class Bayes3Measure(Protocol):
             # If on the edge, get the error from the integral
             if (i==0) or (i==shape[0]-1) or (j==0) or (j == shape[1]-1):
                 _debug('Readout ', self.R_tot, 'Method Integral')
-                self.cov_Gp   = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gp_Axis-self.Gp_guess)**2)
-                self.cov_Gm   = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gm_Axis-self.Gm_guess)**2)
-                self.cov_GpGm = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gm_Axis-self.Gm_guess)*(self.Gp_Axis-self.Gp_guess)) #Non-diagonal element of the cov matrix               
+                self.cov_Gp   = self.cov_post_max[0][0]
+                self.cov_Gm   = self.cov_post_max[1][1]
+                self.cov_GpGm = self.cov_post_max[0][1] #Non-diagonal element of the cov matrix               
             else:
                 _debug('Readout ', self.R_tot, 'Method Parabola')
-                # Second derivative in the direction of gamma+
-                dGp = self.Gp_Axis[i][j+1] - self.Gp_Axis[i][j]
-                A = (self.logP[i][j+1]+self.logP[i][j-1]-2*self.logP[i][j])/(dGp*dGp) 
-                # Second derivative in the direction of gamma-
-                dGm = self.Gm_Axis[i+1][j+1] - self.Gm_Axis[i][j]
-                B = (self.logP[i+1][j]+self.logP[i-1][j]-2*self.logP[i][j])/(dGm*dGm)                       
-                #Second derivative in both direction
-                C = (self.logP[i+1][j+1] + self.logP[i-1][j-1]
-                    -self.logP[i-1][j+1] - self.logP[i+1][j-1])/(4*dGp*dGm)
+                # Second derivatives of -log(post) around the maximum
+                A, B, C = self.get_curvatures(i, j)
                 # Get the covariance matrix element 
                 D2 = A*B-C*C
                 self.cov_Gp = B/D2
@@ -295,10 +396,9 @@ class Bayes3Measure(Protocol):
             _debug('egde_is_uncertain')
             # Take the maximum of the posterior for the best estimate
             # Use the logarithm of the posterior, to ease the calculation
-            self.logP = -np.log(self.Ppost) # DO NOT take self.L, because we also need the prior
-            # Get the indices of the minimum 
+            self.logP = self.log_norm - self.logPost # DO NOT take self.L, because we also need the prior
+            # Get the indices of the minimum (found with the posterior)
             shape = self.logP.shape
-            self.ind = np.unravel_index(self.logP.argmin(), shape)
             i = self.ind[0]
             j = self.ind[1]
             
@@ -313,15 +413,8 @@ class Bayes3Measure(Protocol):
                 self.cov_GpGm = 0
             else:
                 _debug('Readout ', self.R_tot, 'Method Parabola')
-                # Second derivative in the direction of gamma+
-                dGp = self.Gp_Axis[i][j+1] - self.Gp_Axis[i][j]
-                A = (self.logP[i][j+1]+self.logP[i][j-1]-2*self.logP[i][j])/(dGp*dGp) 
-                # Second derivative in the direction of gamma-
-                dGm = self.Gm_Axis[i+1][j+1] - self.Gm_Axis[i][j]
-                B = (self.logP[i+1][j]+self.logP[i-1][j]-2*self.logP[i][j])/(dGm*dGm)                       
-                #Second derivative in both direction
-                C = (self.logP[i+1][j+1] + self.logP[i-1][j-1]
-                    -self.logP[i-1][j+1] - self.logP[i+1][j-1])/(4*dGp*dGm)
+                # Second derivatives of -log(post) around the maximum
+                A, B, C = self.get_curvatures(i, j)
                 # Get the covariance matrix element 
                 D2 = A*B-C*C
                 self.cov_Gp = B/D2
@@ -338,19 +431,19 @@ class Bayes3Measure(Protocol):
             _debug('Mix')
             # Take the maximum of the posterior for the best estimate
             # Use the logarithm of the posterior, to ease the calculation
-            self.logP = -np.log(self.Ppost) # DO NOT take self.L, because we also need the prior
-            # Get the indices of the minimum 
+            self.logP = self.log_norm - self.logPost # DO NOT take self.L, because we also need the prior
+            # Get the indices of the minimum (found with the posterior)
             shape = self.logP.shape
-            self.ind = np.unravel_index(self.logP.argmin(), shape)
             i = self.ind[0]
             j = self.ind[1]
             
             self.Gp_guess = self.Gp_Axis[i][j]  # The mean is for if there are more than one max
             self.Gm_guess = self.Gm_Axis[i][j] 
             
-            self.cov_Gp   = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gp_Axis-self.Gp_guess)**2)
-            self.cov_Gm   = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gm_Axis-self.Gm_guess)**2)
-            self.cov_GpGm = self.integral2D(self.gp_axis, self.gm_axis, self.Ppost*(self.Gm_Axis-self.Gm_guess)*(self.Gp_Axis-self.Gp_guess)) #Non-diagonal element of the cov matrix               
+            # Covariances about the maximum
+            self.cov_Gp   = self.cov_post_max[0][0]
+            self.cov_Gm   = self.cov_post_max[1][1]
+            self.cov_GpGm = self.cov_post_max[0][1] #Non-diagonal element of the cov matrix               
             
         # Get the error from the covariant diagonal
         self.eGp_guess  = np.sqrt(self.cov_Gp)
@@ -379,6 +472,7 @@ class Bayes3Measure(Protocol):
         self.NGm    = len(self.gm_axis)       #Number of discrete point along the gamma- axis for the probability distributions. 
         #Meshgrid
         self.Gp_Axis, self.Gm_Axis = np.meshgrid(self.gp_axis, self.gm_axis)  
+        self.model_cache.set_grid(self.Gp_Axis, self.Gm_Axis)
         #Note the bounds of the prior
         self.Gp_upperBound = np.max(self.gp_axis)
         self.Gp_lowerBound  = np.min(self.gp_axis)
@@ -387,6 +481,15 @@ class Bayes3Measure(Protocol):
         
         #Get the prior and normalize it
         self.prior = prior #Prior distribution
+        # Its logarithm, for the posterior. It is -inf where the prior is zero.
+        with np.errstate(divide='ignore'):
+            self.log_prior = np.log(prior)
+        # Keep it on its original grid, for resampling it on the new domains
+        self.prior_interpolator = RegularGridInterpolator((self.gm_axis, self.gp_axis), 
+                                                          np.asarray(prior, dtype=float))
+        
+        # No measurement yet for computing the like-lihood on new domains
+        self.likelihood_stats = None
         
         # Initial the like-lihood. With now measurement for now.
         self.L = np.zeros(np.shape(self.Gp_Axis)) #This will be related to the logatirhtm of the like-lihood. It simplify a lot the calculation and reduce the number of calculation 
@@ -428,13 +531,36 @@ class Bayes3Measure(Protocol):
         
         # Everything is multiplyied by R, because the like-lihood doens't 
         # distinguish the withd of the distribution with the mean. 
+        # Note what defines the like-lihood, for computing it on other domains
+        self.likelihood_stats = (self.t_probe, R, self.diff_p*R, self.diff_m*R)
+        self.L = self.compute_L(self.Gp_Axis, self.Gm_Axis)
+            
+        # Update the posterior
+        self.update_post()
+        # Process the posterior for extracting informations 
+        self.process_post()
+        
+    def compute_L(self, Gp_Axis, Gm_Axis):
+        """
+        Return the like-lihood L (minus its logarithm) of the measurements so
+        far, on the grid Gp_Axis, Gm_Axis. 
+        It is computed exactly from self.likelihood_stats, which contains 
+        everything needed: (t_probe, R, diff_p*R, diff_m*R)
+        """
+        _debug('Bayes3Measure: compute_L')
+        
+        t_probe, R, diff_p, diff_m = self.likelihood_stats
+        # Get the model functions, only evaluated the first time at t_probe on the domain
+        if self.model_cache.is_grid(Gp_Axis, Gm_Axis):
+            f0s, fps, fms = self.model_cache.get(t_probe)
+        else:
+            f0s = self.f0(t_probe, Gp_Axis, Gm_Axis)
+            fps = self.fp(t_probe, Gp_Axis, Gm_Axis)
+            fms = self.fm(t_probe, Gp_Axis, Gm_Axis)
         # Get the expectation
-        t_probe = self.t_probe
-        exp_0 = self.f0(t_probe, self.Gp_Axis, self.Gm_Axis)*R
-        exp_p = self.fp(t_probe, self.Gp_Axis, self.Gm_Axis)*R
-        exp_m = self.fm(t_probe, self.Gp_Axis, self.Gm_Axis)*R
-        self.L = self.get_likelihood_3measure(exp_0, exp_p, exp_m, 
-                                              self.diff_p*R, self.diff_m*R)
+        exp_0 = f0s*R
+        exp_p = fps*R
+        exp_m = fms*R
 
         # Save the expecation if debug is on
         if _debug_enabled:
@@ -442,17 +568,132 @@ class Bayes3Measure(Protocol):
             self.exp_m = exp_m
             self.exp_0 = exp_0
             
-        # Update the posterior
-        self.update_post()
-        # Process the posterior for extracting informations 
-        self.process_post()
+        return self.get_likelihood_3measure(exp_0, exp_p, exp_m, diff_p, diff_m)
+        
+    def get_posterior_samples(self, nb_points=400):
+        """
+        Return (Gp, Gm), nb_points points of the grid drawn from the posterior
+        (systematic sampling, each point has the same weight). This is a 
+        downsampled version of the posterior, for computing expectations. 
+        """
+        # First the rows, from their probability found with the posterior
+        mass_rows = np.asarray(self.mass_rows, dtype=np.float64)
+        cdf = np.cumsum(mass_rows)
+        positions = (np.arange(nb_points)+0.5)*cdf[-1]/nb_points
+        i = np.minimum(np.searchsorted(cdf, positions), len(cdf)-1)
+        # Position of each point inside its row (fraction of the row)
+        fractions = np.clip((positions - cdf[i] + mass_rows[i])/mass_rows[i], 0, 1)
+        # Then the column in each row, only for the rows drawn. 
+        # Each row is normalized and shifted by its index, such that all the 
+        # rows are searched at once. 
+        rows, k = np.unique(i, return_inverse=True)
+        cdf = np.cumsum(self.Ppost[rows]*trapz_weights(self.gp_axis), axis=1, dtype=np.float64)
+        cdf = cdf/cdf[:,-1:] + np.arange(len(rows))[:,None]
+        j = np.searchsorted(cdf.ravel(), k + fractions) - k*cdf.shape[1]
+        j = np.clip(j, 0, cdf.shape[1]-1)
+        return self.gp_axis[j], self.gm_axis[i]
+    
+    def get_fisher_information(self, t_probes, Gp, Gm, R):
+        """
+        Return (Jpp, Jmm, Jpm), the elements of the Fisher information of a 
+        measurement of the differences with R readouts, for each time in 
+        t_probes, averaged over the points (Gp, Gm). 
+        The model functions are evaluated at once for all the times and all
+        the points. 
+        """
+        t = np.asarray(t_probes, dtype=float)[:,None]
+        Gp = np.asarray(Gp, dtype=float)[None,:]
+        Gm = np.asarray(Gm, dtype=float)[None,:]
+        
+        # Expected PL (per readout)
+        e0 = self.f0(t, Gp, Gm)
+        ep = self.fp(t, Gp, Gm)
+        em = self.fm(t, Gp, Gm)
+        
+        def get_diffs(Gp, Gm):
+            f0 = self.f0(t, Gp, Gm)
+            return f0 - self.fp(t, Gp, Gm), f0 - self.fm(t, Gp, Gm)
+        # Derivatives of the expected differences (per readout)
+        hp, hm = 1e-4*Gp, 1e-4*Gm
+        dp, dm = e0 - ep, e0 - em
+        dp1, dm1 = get_diffs(Gp+hp, Gm)
+        u = ((dp1-dp)/hp, (dm1-dm)/hp) # With respect to gamma+
+        dp1, dm1 = get_diffs(Gp, Gm+hm)
+        v = ((dp1-dp)/hm, (dm1-dm)/hm) # With respect to gamma-
+        
+        # Inverse of the covariance of the differences of the counts (per readout)
+        # It is [[e0+em, -e0], [-e0, e0+ep]]/Z 
+        Z = ep*em + e0*(ep+em)
+        def product(a, b):
+            return ((e0+em)*a[0]*b[0] - e0*(a[0]*b[1] + a[1]*b[0]) + (e0+ep)*a[1]*b[1])/Z
+        
+        Jpp = R*np.mean(product(u, u), axis=1)
+        Jmm = R*np.mean(product(v, v), axis=1)
+        Jpm = R*np.mean(product(u, v), axis=1)
+        return Jpp, Jmm, Jpm
+    
+    def get_expected_gain(self, t_probes, R=1e4, t_ps_0=0, t_ps_pm=0, 
+                          nb_points=400, nb_workers=1):
+        """
+        Return, for each time in t_probes, the expected reduction of the 
+        variance of the posterior (variance of gamma+ plus variance of 
+        gamma-) per unit of time spent measuring, if the next measurement is
+        done at this time. 
         
-    def determine_best_time_to_probe(self, method='betap'):
+        The Fisher information of the measurement, averaged over the 
+        posterior, is added to the inverse of the current covariance matrix.
+        
+        t_probes:
+            1D array of the candidate times to probe. 
+        R:
+            Number of readout of the next measurement, for each ms state. 
+        t_ps_0, t_ps_pm: 
+            Durations of the pulse sequences for the measurement of ms=0 and 
+            ms=+-1, NOT INCLUDING THE PROBING TIME. The time spent is 
+            R*(3*t_probe + t_ps_0 + 2*t_ps_pm)
+        nb_points:
+            Number of points of the posterior used for the average. See 
+            get_posterior_samples. 
+        nb_workers:
+            Number of threads over which the times are split. 
+        """
+        _debug('Bayes3Measure: get_expected_gain')
+        
+        t_probes = np.asarray(t_probes, dtype=float)
+        Gp, Gm = self.get_posterior_samples(nb_points)
+        if nb_workers > 1 and len(t_probes) > nb_workers:
+            if self.executor is None or self.executor._max_workers != nb_workers:
+                self.executor = ThreadPoolExecutor(max_workers=nb_workers)
+            chunks = np.array_split(t_probes, nb_workers)
+            results = list(self.executor.map(lambda t: self.get_fisher_information(t, Gp, Gm, R), chunks))
+            Jpp, Jmm, Jpm = [np.concatenate(J) for J in zip(*results)]
+        else:
+            Jpp, Jmm, Jpm = self.get_fisher_information(t_probes, Gp, Gm, R)
+        
+        # Expected covariance after the measurement, inverse of the information
+        C = self.cov_post
+        det_C = C[0][0]*C[1][1] - C[0][1]*C[0][1]
+        App = C[1][1]/det_C + Jpp
+        Amm = C[0][0]/det_C + Jmm
+        Apm = -C[0][1]/det_C + Jpm
+        det_A = App*Amm - Apm*Apm
+        var_after = (Amm + App)/det_A # Variance of gamma+ plus variance of gamma- 
+        
+        t_spent = R*(3*t_probes + t_ps_0 + 2*t_ps_pm)
+        return (C[0][0] + C[1][1] - var_after)/t_spent
+        
+    def determine_best_time_to_probe(self, method='betap', t_probes=None, R=1e4, 
+                                     t_ps_0=0, t_ps_pm=0, nb_points=400, nb_workers=1):
         """
         Determine the best time to probe with the current knowledge of the situation.
+        
+        method:
+            'betap' for 0.5/beta+ with the best guess. 
+            'expSensitivity' for the time which reduces the most the 
+            variances per unit of time. See get_expected_gain for the other 
+            inputs. If t_probes is None, 64 times around 0.5/beta+ are tried.
         """
         _debug('Bayes3Measure: determine_best_time_to_probe')
-        # TODO really minimize the HitOn sensitivity or something like that instead. 
         if method == 'betap':
             #take 0.5/beta+
             Gp = self.Gp_guess
@@ -466,12 +707,14 @@ class Bayes3Measure(Protocol):
             Find the time to probe which minimize the expected sensitivity.
             We minimize the sum in quadrature of the sensitivites for gamma+ and gamma-
             """
-            _debug('Probably time consuming ;D ')
-        
-            # Take the guess for the best time to be the gu 
-            t_guess = self.best_time(method='betap')
-            res = minimize(self.expected_sensitivity, [t_guess], method='Nelder-Mead')
-            self.t_probe =  res.x[0] #Optimal tp 
+            if t_probes is None:
+                # Around the guess for the best time
+                self.determine_best_time_to_probe(method='betap')
+                t_probes = self.t_probe*np.geomspace(0.05, 5, 64)
+            # All the candidates at once
+            gains = self.get_expected_gain(t_probes, R, t_ps_0, t_ps_pm, 
+                                           nb_points, nb_workers)
+            self.t_probe = t_probes[np.argmax(gains)] #Optimal tp 
     
     def get_t_probe(self):
         """
@@ -534,7 +777,9 @@ class Bayes3Measure(Protocol):
         self.store_info()    
         # Compute entropy is wanted
         if self.compute_entropy:
-            Z = -self.Ppost*np.log(self.Ppost)
+            # With the logarithm of the posterior, for never taking log(0)
+            with np.errstate(invalid='ignore'):
+                Z = np.where(self.Ppost > 0, (self.log_norm - self.logPost)*self.Ppost, 0)
             S = self.integral2D(self.gp_axis, self.gm_axis, Z)
             self.entropy_s.append(S)
         else:
@@ -565,7 +810,8 @@ class Bayes3Measure(Protocol):
         """
         
         #Initialize the simulation
-        self.initialize(t_probe, gp_axis, gm_axis, prior)
+        self.initialize(gp_axis, gm_axis, prior)
+        self.t_probe = t_probe # Same time for all the iterations
         
         self.compute_entropy = compute_entropy # After initializae, to make it true
         
@@ -588,14 +834,28 @@ class Bayes3Measure(Protocol):
         """
         return integral_2D(x,y,Z)
         
-    def rediscretization(self, nb_std_from_mean=5):
+    def rediscretization(self, nb_std_from_mean=5, concentration=0, method='exact'):
         """
         Rediscretization of the domain (=gamma+ and gamma- axis'es) based on 
         the standard deviation of the distribution in both direction. 
+        The prior is resampled from its original grid and the posterior is 
+        updated on the new domain. 
         
         nb_std_from_mean:
             Number of standart deviation away from the mean for the boundary of the domain. 
-            
+        concentration:
+            Fraction of the points of each axis that are concentrated near the
+            best guess (like a gaussian with the standard deviation). The 
+            others are uniform. 0 for uniform axis. See get_adaptive_axis.
+        method:
+            How to get the like-lihood on the new domain. 
+            'exact': compute it again from the measurements. This is as fast 
+                     as interpolating it, because only three model functions 
+                     are evaluated. 
+            'interpolate': linear interpolation of the like-lihood on the 
+                           previous domain. It is extrapolated if the new domain 
+                           is larger.
+            It is interpolated if there is no measurement yet. 
         """
         _debug('Bayes3Measure: rediscretization' )  
         
@@ -606,8 +866,9 @@ class Bayes3Measure(Protocol):
         self.update_post()
         self.process_post()          
         
-        # Define the interpolator for L and post before redefining the axis
-        f_inter_L    = interpolate.interp2d(self.gp_axis, self.gm_axis, self.L, kind='linear')
+        # Define the interpolator for L before redefining the axis
+        f_inter_L = RegularGridInterpolator((self.gm_axis, self.gp_axis), self.L, 
+                                            bounds_error=False, fill_value=None)
         # Define the new bounds
         delta_Gp = self.nbStdFromMean*np.sqrt(self.cov_Gp)
         delta_Gm = self.nbStdFromMean*np.sqrt(self.cov_Gm)
@@ -630,12 +891,25 @@ class Bayes3Measure(Protocol):
             Gm_upperBound = self.Gm_upperBound     
         
         #ReDefine the axis over which we estimate the rates and the probability distribution
-        self.gp_axis = np.linspace(Gp_lowerBound, Gp_upperBound, self.NGp) 
-        self.gm_axis = np.linspace(Gm_lowerBound, Gm_upperBound, self.NGm) 
+        self.gp_axis = get_adaptive_axis(Gp_lowerBound, Gp_upperBound, self.NGp, 
+                                         self.Gp_guess, np.sqrt(self.cov_Gp), concentration) 
+        self.gm_axis = get_adaptive_axis(Gm_lowerBound, Gm_upperBound, self.NGm, 
+                                         self.Gm_guess, np.sqrt(self.cov_Gm), concentration) 
         #Meshgrid
         self.Gp_Axis, self.Gm_Axis = np.meshgrid(self.gp_axis, self.gm_axis)
-        #Interpolate the quantities 
-        self.L = f_inter_L(self.gp_axis, self.gm_axis)
+        self.model_cache.set_grid(self.Gp_Axis, self.Gm_Axis) # Forget the tables of the previous domain
+        #Get the quantities on the new domain
+        points = np.stack([self.Gm_Axis, self.Gp_Axis], axis=-1)
+        if method == 'exact' and not(self.likelihood_stats is None):
+            self.L = self.compute_L(self.Gp_Axis, self.Gm_Axis)
+        else:
+            self.L = f_inter_L(points)
+        # The prior is always inside its original grid
+        self.prior = self.prior_interpolator(points)
+        with np.errstate(divide='ignore'):
+            self.log_prior = np.log(self.prior)
+        # The posterior on the new domain
+        self.update_post()
         
         #Get useful information for seeign how is going the rediscretization
         _debug('Bayes3Measure: rediscretization: delta_Gp = %f kHz'%(delta_Gp*1e-3) )
@@ -1108,6 +1382,40 @@ class PlotBayes():
 
 if __name__ == '__main__': 
     from traceback import print_exception as _p
+    
+    # Benchmark of the update of the posterior on a 500x500 grid, compared
+    # with the successive passes over the grid that were done before. 
+    N = 500
+    bench = Bayes3Measure([None]*3, [1, 0.1])
+    gp_axis = np.linspace(1e3, 100e3, N) 
+    gm_axis = np.linspace(1e3, 100e3, N) 
+    bench.gp_axis, bench.gm_axis = gp_axis, gm_axis
+    bench.Gp_Axis, bench.Gm_Axis = np.meshgrid(gp_axis, gm_axis)
+    bench.log_prior = np.zeros([N, N])
+    bench.L = ((bench.Gp_Axis-30e3)**2 + (bench.Gm_Axis-50e3)**2)/(2*1e3**2)
+    
+    t0 = time.time()
+    for k in range(10):
+        Ppost  = np.exp(-bench.L)
+        Ppost /= integral_2D(gp_axis, gm_axis, Ppost)
+        with np.errstate(divide='ignore'):
+            logP = -np.log(Ppost) # Infinite where exp(-L) underflows
+        Gp = integral_2D(gp_axis, gm_axis, Ppost*bench.Gp_Axis)
+        Gm = integral_2D(gp_axis, gm_axis, Ppost*bench.Gm_Axis)
+        cov_Gp   = integral_2D(gp_axis, gm_axis, Ppost*bench.Gp_Axis*bench.Gp_Axis) - Gp*Gp
+        cov_Gm   = integral_2D(gp_axis, gm_axis, Ppost*bench.Gm_Axis*bench.Gm_Axis) - Gm*Gm
+        cov_GpGm = integral_2D(gp_axis, gm_axis, Ppost*bench.Gp_Axis*bench.Gm_Axis) - Gp*Gm
+    t_passes = (time.time() - t0)/10
+    for dtype in [np.float64, np.float32]:
+        bench.dtype = dtype
+        t0 = time.time()
+        for k in range(10):
+            bench.update_post()
+        t_fused = (time.time() - t0)/10
+        print('%s: %.1f ms instead of %.1f ms. sqrt(cov_Gp) = %f Hz (before: %f Hz)'%(
+              dtype.__name__, t_fused*1e3, t_passes*1e3, 
+              np.sqrt(bench.cov_post[0][0]), np.sqrt(cov_Gp)))
+    
     _debug_enabled = True
     # Load the model
     import protocol_model
@@ -0,0 +1,291 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 17:32:15 2026
+
+Goal: Find the position of a NV in 3D with as few FPGA runs as possible.
+
+Instead of three 1D scans with a parabola fit, the counts around the NV are
+modeled with a 3D gaussian point spread function (PSF) on a background:
+    rate(r) = b + A*exp( -sum_i (r_i - r0_i)^2/(2*sigma_i^2) )
+and the counts of each point are Poissonian. The parameters (r0, A, b) are
+found by maximizing the likelihood of all the points measured so far. The
+widths sigma_i are known (they are the PSF of the microscope).
+
+After each point, the uncertainty on r0 is computed from the Fisher
+information. The next point is the one (among the points at one sigma of the
+estimate along each axis) that reduces the most the worst uncertainty. It
+stops when the uncertainty on each axis is below the tolerance.
+
+@author: Childresslab
+"""
+
+import numpy as np
+from scipy.optimize import minimize
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+class PSFOptimizer3D():
+    """
+    Decide where to measure the counts and estimate the position of the NV.
+
+    Typical use:
+        opt = PSFOptimizer3D(r_start, sigmas, ranges, tolerances)
+        while not(opt.is_done()):
+            r = opt.get_next_point()
+            counts = ... measure at r ...
+            opt.add_point(r, counts)
+        r_best = opt.get_position()
+    """
+    def __init__(self, r_start, sigmas, ranges, tolerances, nb_max=60):
+        """
+        r_start:
+            (Vx, Vy, Vz) where to start. The NV should be within the ranges
+            around it.
+        sigmas:
+            (sigma_x, sigma_y, sigma_z) standard deviation of the PSF (in V).
+        ranges:
+            (range_x, range_y, range_z) full range (in V) allowed around
+            r_start, like the ranges of the 1D scans.
+        tolerances:
+            (tol_x, tol_y, tol_z) stop when the standard deviation of the
+            position is below these (in V).
+        nb_max:
+            Maximum number of points (FPGA runs), whatever the uncertainty.
+        """
+        _debug('PSFOptimizer3D: __init__')
+        _debug('The best way out is always through. – Robert Frost')
+
+        self.r_start    = np.array(r_start, dtype=float)
+        self.sigmas     = np.array(sigmas, dtype=float)
+        self.ranges     = np.array(ranges, dtype=float)
+        self.tolerances = np.array(tolerances, dtype=float)
+        self.nb_max     = nb_max
+
+        self.r_min = self.r_start - self.ranges/2
+        self.r_max = self.r_start + self.ranges/2
+
+        # Directions for the next points: one and two sigmas along each axis
+        eye = np.eye(3)
+        self.directions = np.concatenate([eye, -eye, 2*eye, -2*eye])
+
+        # First points: the center and one sigma on each side of each axis
+        self.points_to_do = [self.r_start] + list(self.r_start + self.directions[:6]*self.sigmas)
+
+        self.points = [] # Points measured
+        self.counts = [] # Counts measured at these points
+        self.nb_runs = 0 # Number of FPGA runs
+        # Parameters (x0, y0, z0, ln(A), ln(b))
+        self.params = None
+        self.cov    = None
+
+    def get_rate(self, params, points):
+        """
+        Return the expected counts at the points, and their derivative with
+        respect to the parameters (shape (N,5)).
+        """
+        r0 = params[:3]
+        A, b = np.exp(params[3]), np.exp(params[4])
+        u = (points - r0)/self.sigmas
+        gaussian = np.exp(-0.5*np.sum(u**2, axis=1))
+        rate = b + A*gaussian
+        gradient = np.empty((len(points), 5))
+        gradient[:,:3] = (A*gaussian)[:,None]*u/self.sigmas
+        gradient[:,3]  = A*gaussian
+        gradient[:,4]  = b
+        return rate, gradient
+
+    def negative_log_likelihood(self, params):
+        """
+        Poisson negative log likelihood of the points measured (without the
+        constant terms), and its gradient.
+        """
+        rate, gradient = self.get_rate(params, self.points_array)
+        nll = np.sum(rate - self.counts_array*np.log(rate))
+        dnll = np.dot(1 - self.counts_array/rate, gradient)
+        return nll, dnll
+
+    def fit(self):
+        """
+        Update the parameters with the maximum likelihood and their
+        covariance with the Fisher information.
+        """
+        _debug('PSFOptimizer3D: fit')
+
+        self.points_array = np.array(self.points)
+        self.counts_array = np.array(self.counts, dtype=float)
+
+        # Guesses: the previous parameters, and the brightest points measured.
+        # Starting from many points avoids to get stuck in a local minimum
+        # when the NV is far from the start.
+        b = max(np.min(self.counts_array), 1)
+        A = max(np.max(self.counts_array) - b, 1)
+        list_guess = [] if self.params is None else [self.params]
+        for i in np.argsort(-self.counts_array)[:3]:
+            list_guess.append(np.concatenate([self.points_array[i], [np.log(A), np.log(b)]]))
+
+        # Don't let the position go far outside of the ranges, nor the counts
+        # go crazy
+        bounds = [(self.r_min[i]-self.ranges[i], self.r_max[i]+self.ranges[i]) for i in range(3)]
+        ln_max = np.log(10*max(np.max(self.counts_array), 1))
+        bounds += [(-5, ln_max), (-5, ln_max)]
+        nll_best = np.inf
+        for guess in list_guess:
+            result = minimize(self.negative_log_likelihood, guess, jac=True,
+                              method='L-BFGS-B', bounds=bounds)
+            if np.all(np.isfinite(result.x)) and result.fun < nll_best:
+                nll_best = result.fun
+                self.params = result.x
+
+        # Fisher information of Poisson counts
+        rate, gradient = self.get_rate(self.params, self.points_array)
+        fisher = np.dot(gradient.T, gradient/rate[:,None])
+        try:
+            self.cov = np.linalg.inv(fisher)
+        except np.linalg.LinAlgError:
+            self.cov = None
+        if not(self.cov is None) and not(np.all(np.isfinite(self.cov))):
+            self.cov = None
+
+    def add_point(self, r, counts):
+        """
+        Add a measured point and update the estimate.
+
+        r:
+            (Vx, Vy, Vz) where the counts were measured.
+        counts:
+            Counts measured at r.
+        """
+        _debug('PSFOptimizer3D: add_point')
+
+        self.points.append(np.array(r, dtype=float))
+        self.counts.append(counts)
+        self.nb_runs += 1
+        # Wait for the first points before to fit
+        if len(self.points_to_do) == 0:
+            self.fit()
+
+    def get_next_point(self):
+        """
+        Return the next point (Vx, Vy, Vz) to measure.
+        """
+        _debug('PSFOptimizer3D: get_next_point')
+
+        if len(self.points_to_do)>0:
+            return self.points_to_do.pop(0)
+
+        r0 = self.get_position()
+        candidates = np.clip(r0 + self.directions*self.sigmas, self.r_min, self.r_max)
+        if self.cov is None:
+            # Not enough information yet, take them in turn
+            return candidates[self.nb_runs%len(candidates)]
+
+        # Covariance after adding each candidate (Sherman-Morrison), all at once
+        rate, gradient = self.get_rate(self.params, candidates)
+        cov_g = np.dot(gradient, self.cov) # (N,5)
+        denominator = rate + np.sum(cov_g*gradient, axis=1)
+        var_new = np.diag(self.cov)[:3][None,:] - cov_g[:,:3]**2/denominator[:,None]
+        # The worst axis, relative to its tolerance
+        score = np.max(var_new/self.tolerances**2, axis=1)
+        return candidates[np.argmin(score)]
+
+    def get_position(self):
+        """
+        Return the estimated position (Vx, Vy, Vz) of the NV, kept within
+        the ranges.
+        """
+        if self.params is None:
+            return self.r_start.copy()
+        return np.clip(self.params[:3], self.r_min, self.r_max)
+
+    def get_uncertainty(self):
+        """
+        Return the standard deviation of the position (in V), or None if it
+        is not known yet.
+        """
+        if self.cov is None:
+            return None
+        return np.sqrt(np.abs(np.diag(self.cov)[:3]))
+
+    def get_rate_model(self, points):
+        """
+        Return the counts expected at the points, with the parameters found.
+        """
+        return self.get_rate(self.params, np.atleast_2d(points))[0]
+
+    def is_done(self):
+        """
+        Return True when the position is known within the tolerances, or
+        when the maximum number of runs is reached.
+        """
+        if self.nb_runs >= self.nb_max:
+            return True
+        uncertainty = self.get_uncertainty()
+        if uncertainty is None or len(self.points_to_do)>0:
+            return False
+        # The estimate must also be within the ranges, otherwise it is not
+        # trustable yet
+        r0 = self.params[:3]
+        is_inside = np.all(r0 >= self.r_min) and np.all(r0 <= self.r_max)
+        return is_inside and np.all(uncertainty <= self.tolerances)
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Compare with three 1D scans with parabola fits, like GUIOptimizer
+    from scipy.optimize import curve_fit
+
+    sigmas = np.array([0.02, 0.02, 0.05])
+    ranges = np.array([0.1, 0.1, 0.2])
+    A, b = 200, 50 # Counts per point
+
+    def measure(r, r_nv):
+        u = (r - r_nv)/sigmas
+        return np.random.poisson(b + A*np.exp(-0.5*np.sum(u**2)))
+
+    def optimize_1D(r_nv, N=25):
+        r = np.zeros(3)
+        for axis in range(3):
+            Vs = np.linspace(-ranges[axis]/2, ranges[axis]/2, N) + r[axis]
+            counts = []
+            for V in Vs:
+                r_probe = r.copy()
+                r_probe[axis] = V
+                counts.append(measure(r_probe, r_nv))
+            parabola = lambda x, x0, dx, y0: y0-((x-x0)/dx)**2
+            try:
+                y0 = np.mean(counts)
+                dx = max((Vs[-1]-r[axis])/np.sqrt(np.abs(y0-counts[-1])),
+                         (Vs[0] -r[axis])/np.sqrt(np.abs(y0-counts[0])))
+                popt = curve_fit(parabola, Vs, counts, p0=[r[axis], dx, y0])[0]
+                r[axis] = np.clip(popt[0], Vs[0], Vs[-1])
+            except:
+                pass
+        return r, 3*N
+
+    errors_1D, errors_psf, runs_psf = [], [], []
+    for trial in range(200):
+        r_nv = np.random.uniform(-1, 1, 3)*sigmas
+        r, n = optimize_1D(r_nv)
+        errors_1D.append(r - r_nv)
+        opt = PSFOptimizer3D(np.zeros(3), sigmas, ranges, tolerances=sigmas/8)
+        while not(opt.is_done()):
+            r = opt.get_next_point()
+            opt.add_point(r, measure(r, r_nv))
+        errors_psf.append(opt.get_position() - r_nv)
+        runs_psf.append(opt.nb_runs)
+    print('1D scans : %d runs, rms error (x,y,z) ='%n, np.sqrt(np.mean(np.array(errors_1D)**2, axis=0)))
+    print('PSF fit  : %.1f runs, rms error (x,y,z) ='%np.mean(runs_psf), np.sqrt(np.mean(np.array(errors_psf)**2, axis=0)))
@@ -0,0 +1,379 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 13:41:08 2026
+
+Goal: Define the order in which the pixels of a map are scanned.
+
+Each function returns a list of batches. A batch is a tuple (rows, columns)
+of integer arrays, giving the indices of the pixels to scan, in order.
+The image is typically updated after each batch (for example after each row).
+All the pixels of a Ny x Nx map are visited exactly once.
+
+@author: Childresslab
+"""
+
+import numpy as np
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def sawtooth(Nx, Ny):
+    """
+    Scan each row from left to right. After each row, the x index comes back
+    to zero.
+    One batch per row.
+    """
+    _debug('sawtooth')
+
+    cols = np.arange(Nx)
+    return [(np.full(Nx, row), cols) for row in range(Ny)]
+
+def snake(Nx, Ny):
+    """
+    Scan each row, alternating the direction. After each row, the x index
+    starts where it was, instead of coming back to zero like the sawtooth.
+    One batch per row.
+    """
+    _debug('snake')
+
+    cols = np.arange(Nx)
+    batches = []
+    for row in range(Ny):
+        if row%2 == 0:
+            batches.append((np.full(Nx, row), cols))
+        else:
+            batches.append((np.full(Nx, row), cols[::-1]))
+    return batches
+
+def random_points(Nx, Ny, batch_size=None, seed=None):
+    """
+    Scan the pixels in a random order.
+    The order is a permutation computed once, such that each pick is O(1).
+
+    batch_size:
+        Number of pixels per batch. Default is Nx (same as a row).
+    seed:
+        Seed of the random generator. None for a different order each time.
+    """
+    _debug('random_points')
+
+    if batch_size is None:
+        batch_size = Nx
+    order = np.random.RandomState(seed).permutation(Nx*Ny)
+    rows, cols = np.divmod(order, Nx)
+    batches = []
+    for start in range(0, Nx*Ny, batch_size):
+        batches.append((rows[start:start+batch_size],
+                        cols[start:start+batch_size]))
+    return batches
+
+def diagonal_sweep(Nx, Ny):
+    """
+    Scan along the anti-diagonals (column + row = constant), starting at the
+    corner (0,0) and finishing at the opposite corner.
+    Works for any Nx and Ny.
+    One batch per diagonal.
+    """
+    _debug('diagonal_sweep')
+
+    batches = []
+    for d in range(Nx+Ny-1):
+        # Column indices that keep the row inside the map
+        col_min = max(0, d-(Ny-1))
+        col_max = min(d, Nx-1)
+        cols = np.arange(col_min, col_max+1)
+        batches.append((d - cols, cols))
+    return batches
+
+def spiral(Nx, Ny):
+    """
+    Scan by following a square spiral. It starts at the middle, then whirls
+    around until all the map is covered.
+    For a rectangular map, the parts of the spiral falling outside of the map
+    are simply skipped.
+    One batch per turn of the spiral.
+    """
+    _debug('spiral')
+
+    N = Nx*Ny
+    rows = np.zeros(N, dtype=int)
+    cols = np.zeros(N, dtype=int)
+    turn_ends = [] # Number of pixels done after each turn
+
+    # Starting point
+    row, col = int(Ny/2), int(Nx/2)
+    rows[0], cols[0] = row, col
+    n = 1
+    # Direction: right, up, left, down, with legs of length 1,1,2,2,3,3,...
+    directions = [(0,1), (1,0), (0,-1), (-1,0)]
+    leg = 1
+    k = 0
+    while n < N:
+        drow, dcol = directions[k%4]
+        for _ in range(leg):
+            row += drow
+            col += dcol
+            if 0<=row<Ny and 0<=col<Nx:
+                rows[n], cols[n] = row, col
+                n += 1
+        # A turn is complete after the four directions
+        if k%4 == 3:
+            turn_ends.append(n)
+        # The leg gets longer every two directions
+        if k%2 == 1:
+            leg += 1
+        k += 1
+    turn_ends.append(N)
+
+    batches = []
+    start = 0
+    for end in turn_ends:
+        if end > start:
+            batches.append((rows[start:end], cols[start:end]))
+        start = end
+    return batches
+
+
+def coarse_to_fine_strides(Nx, Ny, stride_max=None):
+    """
+    Return the list of strides used by coarse_to_fine, from the coarsest to 1.
+    The coarsest stride is the largest power of two giving at least about
+    4 points along the longest side.
+
+    stride_max:
+        If not None, the coarsest stride is also at most this.
+    """
+    stride = 1
+    while 2*stride <= max(Nx, Ny)/4:
+        if not(stride_max is None) and 2*stride > stride_max:
+            break
+        stride *= 2
+    strides = []
+    while stride >= 1:
+        strides.append(stride)
+        stride = int(stride/2)
+    return strides
+
+def coarse_to_fine(Nx, Ny, stride_max=None):
+    """
+    Progressive scan. First scan a coarse sub-lattice (every stride pixels),
+    then refine by scanning the pixels of the lattices with half the stride
+    that are not already scanned, until the stride is 1.
+    One batch per stride, in the order given by coarse_to_fine_strides.
+    Inside a batch, the pixels are scanned row by row, like a snake.
+
+    stride_max:
+        Same as in coarse_to_fine_strides.
+    """
+    _debug('coarse_to_fine')
+
+    rows_all, cols_all = np.mgrid[0:Ny, 0:Nx]
+    # Snake order, for not jumping too much
+    cols_all[1::2] = cols_all[1::2, ::-1]
+    rows_all = rows_all.ravel()
+    cols_all = cols_all.ravel()
+
+    batches = []
+    previous = None
+    for stride in coarse_to_fine_strides(Nx, Ny, stride_max):
+        on_lattice = (rows_all%stride == 0) & (cols_all%stride == 0)
+        if previous is None:
+            to_scan = on_lattice
+        else:
+            to_scan = on_lattice & ~((rows_all%previous == 0) & (cols_all%previous == 0))
+        batches.append((rows_all[to_scan], cols_all[to_scan]))
+        previous = stride
+    return batches
+
+def fill_from_strides(Z, measured, strides):
+    """
+    Return a copy of the map Z where the pixels not measured are replaced by
+    the value of the corner of their cell (the pixel at the top left) on the
+    finest lattice where this corner is measured. This upsamples a coarse or
+    partial scan (coarse_to_fine, quadtree) such that it looks like a full
+    image.
+
+    Z:
+        2D array of the map, Z[row][column]
+    measured:
+        2D boolean array, True where the pixel is measured.
+    strides:
+        List of the strides of the lattices, from the coarsest to 1.
+    """
+    Ny, Nx = np.shape(Z)
+    image = np.array(Z, dtype=float)
+    for stride in strides:
+        rows = (np.arange(Ny)//stride)*stride
+        cols = (np.arange(Nx)//stride)*stride
+        corner_is_measured = measured[np.ix_(rows, cols)]
+        image = np.where(corner_is_measured, Z[np.ix_(rows, cols)], image)
+    return np.where(measured, Z, image)
+
+def quadtree(Nx, Ny, Z, measured, count_time_ms, stride_max=4, nb_sigma=3,
+             snr=5, max_dwell_factor=8):
+    """
+    Adaptive scan. This is a generator: it decides the next batch from what
+    is already measured in Z, so Z and measured must be filled by the caller
+    between each batch.
+
+    First, a coarse grid is scanned (same as the first step of
+    coarse_to_fine). Then, at each step, the stride is divided by two and
+    only the cells touching an interesting pixel are refined. A pixel is
+    interesting if it is significantly brighter than the background (median
+    of the coarse grid), or significantly different from its neighbor on the
+    grid (a gradient). Significant means more than nb_sigma standard
+    deviations of the Poisson noise.
+
+    The count time of the new pixels is chosen such that the contrast with
+    the background is measured with the signal to noise ratio snr. Bright
+    cells thus need less time than dim cells. The count time is a power of
+    two times count_time_ms, at most max_dwell_factor times count_time_ms.
+
+    Yield batches (rows, columns, count_time_ms), one per count time and step.
+
+    Z:
+        2D array, Z[row][column], where the counts per second are written.
+    measured:
+        2D boolean array, True where the pixel is measured.
+    count_time_ms:
+        Count time (in ms) of the coarse grid and minimum count time.
+    stride_max:
+        Stride of the coarse grid (in pixel). It should be about the size of
+        a spot, otherwise the spots can fall between the points of the grid.
+    """
+    _debug('quadtree')
+
+    strides = coarse_to_fine_strides(Nx, Ny, stride_max)
+    dwell = np.zeros([Ny, Nx]) # Count time of each pixel (ms)
+
+    # The coarse grid
+    rows, cols = coarse_to_fine(Nx, Ny, stride_max)[0]
+    dwell[rows, cols] = count_time_ms
+    yield rows, cols, count_time_ms
+    background = max(np.median(Z[rows, cols]), 1e-9)
+
+    for k in range(1, len(strides)):
+        S = strides[k-1] # Stride of the grid already there
+        s = strides[k]   # Stride of the new pixels
+
+        # Values on the coarse grid. The nodes not measured are ignored.
+        node_rows = np.arange(0, Ny, S)
+        node_cols = np.arange(0, Nx, S)
+        V = Z       [np.ix_(node_rows, node_cols)]
+        M = measured[np.ix_(node_rows, node_cols)]
+        T = dwell   [np.ix_(node_rows, node_cols)]*1e-3 # In second
+        T[T==0] = count_time_ms*1e-3
+
+        # Bright nodes
+        sigma_bg = np.sqrt(background/T)
+        interesting = M & (V > background + nb_sigma*sigma_bg)
+        # Gradients with the neighbors on the right and below
+        for axis in [0, 1]:
+            V1 = np.delete(V, -1, axis=axis)
+            V2 = np.delete(V, 0, axis=axis)
+            M12 = np.delete(M, -1, axis=axis) & np.delete(M, 0, axis=axis)
+            T12 = np.minimum(np.delete(T, -1, axis=axis), np.delete(T, 0, axis=axis))
+            sigma = np.sqrt((np.abs(V1) + np.abs(V2))/T12)
+            steep = M12 & (np.abs(V1 - V2) > nb_sigma*sigma)
+            # Both nodes of a steep pair are interesting
+            if axis == 0:
+                interesting |= np.pad(steep, [(0,1), (0,0)]) | np.pad(steep, [(1,0), (0,0)])
+            else:
+                interesting |= np.pad(steep, [(0,0), (0,1)]) | np.pad(steep, [(0,0), (1,0)])
+        if not(np.any(interesting)):
+            return
+
+        # A cell (with top left corner at a node) is refined if one of its
+        # four corners is interesting
+        refine = interesting.copy()
+        refine[:-1,:]  |= interesting[1:,:]
+        refine[:,:-1]  |= interesting[:,1:]
+        refine[:-1,:-1] |= interesting[1:,1:]
+        # Brightest corner of each cell, for the count time
+        V_cell = np.where(M, V, -np.inf)
+        V_cell[:-1,:] = np.maximum(V_cell[:-1,:], V_cell[1:,:])
+        V_cell[:,:-1] = np.maximum(V_cell[:,:-1], V_cell[:,1:])
+
+        # New pixels in the refined cells
+        i_cells, j_cells = np.nonzero(refine)
+        new_rows = []
+        new_cols = []
+        new_dwell = []
+        for drow, dcol in [(0, s), (s, 0), (s, s)]:
+            r = node_rows[i_cells] + drow
+            c = node_cols[j_cells] + dcol
+            inside = (r<Ny) & (c<Nx)
+            new_rows.append(r[inside])
+            new_cols.append(c[inside])
+            # Count time for seeing the contrast with the background
+            rate = V_cell[i_cells, j_cells][inside]
+            contrast = np.maximum(np.abs(rate - background), 1e-9)
+            t = 1e3*snr**2*(rate + background)/contrast**2
+            factor = np.clip(t/count_time_ms, 1, max_dwell_factor)
+            factor = 2**np.ceil(np.log2(factor))
+            new_dwell.append(count_time_ms*factor)
+        new_rows  = np.concatenate(new_rows)
+        new_cols  = np.concatenate(new_cols)
+        new_dwell = np.concatenate(new_dwell)
+
+        # Remove the duplicates and what is already measured
+        index = new_rows*Nx + new_cols
+        index, first = np.unique(index, return_index=True)
+        new_dwell = new_dwell[first]
+        not_yet = ~measured.ravel()[index]
+        index, new_dwell = index[not_yet], new_dwell[not_yet]
+        if len(index) == 0:
+            continue
+
+        # One batch per count time, row by row
+        for t in np.unique(new_dwell):
+            rows, cols = np.divmod(index[new_dwell == t], Nx)
+            dwell[rows, cols] = t
+            yield rows, cols, t
+
+
+# Name of each scanning mode, as shown in the GUI
+dict_modes = {'Sawtooth'      :sawtooth,
+              'Snake'         :snake,
+              'Random'        :random_points,
+              'Diagonal_sweep':diagonal_sweep,
+              'Spiral'        :spiral,
+              'Progressive'   :coarse_to_fine}
+# Note that quadtree is not in the list, because it needs the measured map
+
+def get_batches(mode, Nx, Ny):
+    """
+    Return the batches for the scanning mode.
+
+    mode:
+        String, one of the keys of dict_modes.
+    Nx, Ny:
+        Number of columns and rows of the map.
+    """
+    _debug('get_batches', mode)
+
+    return dict_modes[mode](Nx, Ny)
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Check that each mode visits each pixel exactly once
+    for mode in dict_modes:
+        for Nx, Ny in [(1,1), (5,3), (3,8), (10,10)]:
+            visited = np.zeros([Ny, Nx], dtype=int)
+            for rows, cols in get_batches(mode, Nx, Ny):
+                np.add.at(visited, (rows, cols), 1)
+            print(mode, Nx, Ny, np.all(visited == 1))
@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 19 16:41:08 2026
+
+Goal: Find the NVs (bright spots) in a confocal map, without placing the ROIs
+by hand.
+
+The steps are:
+    - Estimate the background with a large moving average of the map, where
+      the bright pixels are clipped such that the spots don't lift it.
+    - Apply a gaussian matched filter (a gaussian blur of the size of a spot)
+      on the map minus the background.
+    - Keep the local maxima of the filtered map that are above the noise by
+      a number of standard deviations.
+    - Refine the position of each maximum with the centroid of the pixels
+      around it, and estimate its size with the second moment.
+Everything is done on the whole map at once, so a 200x200 map takes a few
+milliseconds.
+
+@author: Childresslab
+"""
+
+import numpy as np
+from scipy import ndimage
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def estimate_background(Z, size_spot_px):
+    """
+    Return (background, noise). The background is a map of the same shape as
+    Z. The noise is the standard deviation of the pixels around the
+    background (a single number).
+
+    Z:
+        2D array of the map.
+    size_spot_px:
+        Standard deviation of a spot (in pixel).
+    """
+    _debug('estimate_background')
+
+    median = np.median(Z)
+    # Median absolute deviation, robust against the spots
+    noise = 1.4826*np.median(np.abs(Z - median))
+    # Clip the spots, such that they don't lift the local background
+    Z_clipped = np.minimum(Z, median + 3*noise)
+    size_window = max(3, int(8*size_spot_px)|1)
+    background = ndimage.uniform_filter(Z_clipped.astype(float),
+                                        size=size_window, mode='nearest')
+    if noise <= 0:
+        # Very clean map (or simulation). Take the Poisson noise instead
+        noise = np.sqrt(max(median, 1))
+    return background, noise
+
+def find_spots(Z, Vxmin, Vxmax, Vymin, Vymax, size_spot_px=1.5, nb_sigma=5,
+               nb_max=None):
+    """
+    Find the bright spots in the map.
+
+    Return a list of dictionaries, one per spot, from the most to the least
+    significant. Each spot has the keys:
+        'Vx', 'Vy': Position in AO volts (sub-pixel).
+        'row', 'col': Pixel of the maximum.
+        'amplitude': Peak counts above the background.
+        'brightness': Total counts above the background in the spot.
+        'size': Standard deviation of the spot, in volts (mean of x and y).
+        'snr': Significance of the spot in the filtered map, in standard
+               deviations.
+
+    Z:
+        2D array of the map, Z[row][column]. The rows go with Vy and the
+        columns with Vx, like in GUIMap.
+    Vxmin, Vxmax, Vymin, Vymax:
+        Voltages of the first and last pixels.
+    size_spot_px:
+        Expected standard deviation of a spot (in pixel). This is the size of
+        the matched filter and of the local maximum neighborhood.
+    nb_sigma:
+        Minimum significance for keeping a spot.
+    nb_max:
+        Maximum number of spots to return. None for all of them.
+    """
+    _debug('find_spots')
+
+    Z = np.asarray(Z, dtype=float)
+    Ny, Nx = np.shape(Z)
+    if Nx<2 or Ny<2:
+        return []
+
+    background, noise = estimate_background(Z, size_spot_px)
+    signal = Z - background
+
+    # Matched filter. For a gaussian spot in white noise, the best filter is
+    # the spot itself.
+    filtered = ndimage.gaussian_filter(signal, size_spot_px, mode='nearest')
+    # Noise of the filtered map: white noise averaged over the gaussian
+    noise_filtered = noise/(2*np.sqrt(np.pi)*size_spot_px)
+
+    # Local maxima above the threshold
+    radius = max(1, int(np.ceil(2*size_spot_px)))
+    is_max = ndimage.maximum_filter(filtered, size=2*radius+1, mode='nearest') == filtered
+    is_max &= filtered > nb_sigma*noise_filtered
+    rows, cols = np.nonzero(is_max)
+    if len(rows) == 0:
+        return []
+
+    # Sub-pixel centroids and second moments, for all the spots at once.
+    # Each spot gets the window of pixels around its maximum.
+    offsets = np.arange(-radius, radius+1)
+    dr, dc = np.meshgrid(offsets, offsets, indexing='ij')
+    signal_padded = np.pad(signal, radius, mode='constant')
+    windows = signal_padded[(rows+radius)[:,None,None] + dr,
+                            (cols+radius)[:,None,None] + dc]
+    weights = np.clip(windows, 0, None)
+    sum_weights = weights.sum(axis=(1,2))
+    sum_weights[sum_weights<=0] = 1 # Avoid dividing by zero
+    mean_dr = (weights*dr).sum(axis=(1,2))/sum_weights
+    mean_dc = (weights*dc).sum(axis=(1,2))/sum_weights
+    var_r = (weights*(dr-mean_dr[:,None,None])**2).sum(axis=(1,2))/sum_weights
+    var_c = (weights*(dc-mean_dc[:,None,None])**2).sum(axis=(1,2))/sum_weights
+
+    # Convert into volts
+    step_x = (Vxmax-Vxmin)/(Nx-1)
+    step_y = (Vymax-Vymin)/(Ny-1)
+    Vxs = Vxmin + (cols + mean_dc)*step_x
+    Vys = Vymin + (rows + mean_dr)*step_y
+    sizes = 0.5*(np.sqrt(var_c)*abs(step_x) + np.sqrt(var_r)*abs(step_y))
+    snrs  = filtered[rows, cols]/noise_filtered
+
+    # Rank them, the most significant first
+    order = np.argsort(-snrs)
+    if not(nb_max is None):
+        order = order[:nb_max]
+
+    spots = []
+    for i in order:
+        spots.append({'Vx'        :float(Vxs[i]),
+                      'Vy'        :float(Vys[i]),
+                      'row'       :int(rows[i]),
+                      'col'       :int(cols[i]),
+                      'amplitude' :float(signal[rows[i], cols[i]]),
+                      'brightness':float(weights[i].sum()),
+                      'size'      :float(sizes[i]),
+                      'snr'       :float(snrs[i])})
+    return spots
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import time
+
+    # Fake map with some NVs
+    Nx, Ny = 200, 200
+    xs = np.linspace(-5, 5, Nx)
+    ys = np.linspace(-5, 5, Ny)
+    X, Y = np.meshgrid(xs, ys)
+    rate = 20 + 0*X
+    true_positions = np.random.uniform(-4.5, 4.5, (15, 2))
+    for x0, y0 in true_positions:
+        rate += 100*np.exp(-((X-x0)**2 + (Y-y0)**2)/(2*0.08**2))
+    Z = np.random.poisson(rate)
+
+    t0 = time.time()
+    spots = find_spots(Z, -5, 5, -5, 5, size_spot_px=1.6)
+    print('Found %d spots (%d true) in %.1f ms'%(len(spots), len(true_positions),
+                                                  1e3*(time.time()-t0)))
+    for spot in spots[:5]:
+        d = np.min(np.hypot(true_positions[:,0]-spot['Vx'],
+                            true_positions[:,1]-spot['Vy']))
+        print('Vx=%.3f Vy=%.3f snr=%.1f size=%.3f error=%.4f'%(spot['Vx'], spot['Vy'],
+                                                               spot['snr'], spot['size'], d))
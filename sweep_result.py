@@ -0,0 +1,390 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 16:05:12 2026
+
+Goal: Deal with the points of a magnet sweep (x, y, z, w) when there are a lot
+of them (a sweep of many hours has more than 10^5 checkpoints).
+
+The points are put in a KD-tree, which allows to find quickly:
+    - The closest points to a position.
+    - The points within a distance of a position.
+From that, the data can be regridded on a regular grid (in 3D or on a plane),
+each grid point being the weighted average of the points around it:
+    - 'IDW'     : inverse distance weighting, weight = 1/distance^power
+    - 'Gaussian': weight = exp(-distance^2/(2*sigma^2))
+The grid points without any scanned point nearby are nan.
+
+For plotting, a preview keeps a limited number of points by averaging the
+points falling in the same voxel. The same averaging keeps the number of
+points bounded during a long sweep (see nb_max), for the live map.
+
+@author: Childresslab
+"""
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def databox_to_sweep_result(databox):
+    """
+    Return a SweepResult with the columns xs, ys, zs and ws of the databox
+    saved by GUIMagnetSweepLines.
+    """
+    return SweepResult(databox['xs'], databox['ys'], databox['zs'], databox['ws'])
+
+def get_weights(distances, kernel='IDW', power=2, sigma=None):
+    """
+    Return the weights of the points at the distances. The infinite
+    distances (no point) get a zero weight.
+
+    kernel:
+        'IDW' or 'Gaussian'
+    power:
+        Power of the distance for 'IDW'.
+    sigma:
+        Width of the 'Gaussian'.
+    """
+    is_point = np.isfinite(distances)
+    d = np.where(is_point, distances, 0)
+    if kernel == 'IDW':
+        # A point right on the grid point gets a very large weight
+        weights = 1/(d**power + 1e-12*np.max(d+1)**power)
+    elif kernel == 'Gaussian':
+        weights = np.exp(-0.5*(d/sigma)**2)
+    else:
+        print('ERROR: get_weights: unknown kernel '+str(kernel))
+        weights = np.ones(np.shape(d))
+    return np.where(is_point, weights, 0)
+
+
+class SweepResult():
+    """
+    Points of a magnet sweep, with a KD-tree for finding them by position.
+    Points can be added while the sweep is running, the tree is rebuilt only
+    when it is needed.
+    """
+    def __init__(self, xs=[], ys=[], zs=[], ws=[], nb_max=None):
+        """
+        xs, ys, zs:
+            Positions of the points (mm).
+        ws:
+            Data at each point (for example the counts).
+        nb_max:
+            Maximum number of points kept. Above it, the points in the same
+            voxel are averaged, down to about half of nb_max. None for
+            keeping all the points.
+        """
+        _debug('SweepResult: __init__')
+        _debug('Well done is better than well said. – Benjamin Franklin')
+
+        self.nb_max = nb_max
+        # The buffers have room for more points than there are, and their
+        # size doubles when they are full, such that adding a line doesn't
+        # copy all the points. self.points, self.ws and self.multiplicities
+        # are the filled part.
+        self.buffer_points = np.zeros((0,3))
+        self.buffer_ws     = np.zeros(0)
+        self.buffer_multiplicities = np.zeros(0)
+        self.set_nb_points(0)
+        self.trees  = {} # KD-tree for each set of axes, built when needed
+        self.add_points(xs, ys, zs, ws)
+
+    def __len__(self):
+        return len(self.ws)
+
+    def set_nb_points(self, N):
+        """
+        Take the first N points of the buffers as the points.
+        """
+        self.points = self.buffer_points[:N]
+        self.ws     = self.buffer_ws[:N]
+        # Number of measured points averaged in each point (1 if not merged)
+        self.multiplicities = self.buffer_multiplicities[:N]
+
+    def add_points(self, xs, ys, zs, ws):
+        """
+        Add points, for example the ones of the line just swept.
+        """
+        _debug('SweepResult: add_points')
+
+        if len(ws) == 0:
+            return
+        points = np.transpose([xs, ys, zs]).astype(float)
+        N, n = len(self), len(points)
+        if N + n > len(self.buffer_ws):
+            # Make room
+            size = max(2*len(self.buffer_ws), N + n, 1024)
+            self.buffer_points = np.concatenate([self.points, np.zeros((size-N, 3))])
+            self.buffer_ws     = np.concatenate([self.ws, np.zeros(size-N)])
+            self.buffer_multiplicities = np.concatenate([self.multiplicities, np.zeros(size-N)])
+        self.buffer_points[N:N+n] = points
+        self.buffer_ws    [N:N+n] = ws
+        self.buffer_multiplicities[N:N+n] = 1
+        self.set_nb_points(N + n)
+        # The trees are not valid anymore
+        self.trees = {}
+
+        if not(self.nb_max is None) and len(self) > self.nb_max:
+            self.merge_points(self.nb_max//2)
+
+    def merge_points(self, nb_max):
+        """
+        Average the points in the same voxel, such that there are at most
+        about nb_max points left.
+        """
+        _debug('SweepResult: merge_points')
+
+        points, ws, multiplicities = self.get_voxel_means(nb_max)
+        n = len(ws)
+        self.buffer_points[:n] = points
+        self.buffer_ws    [:n] = ws
+        self.buffer_multiplicities[:n] = multiplicities
+        self.set_nb_points(n)
+        self.trees = {}
+
+    def get_axes_index(self, axes):
+        """
+        Return the list of the index of the axes, for example [0, 2] for 'xz'.
+        """
+        return ['xyz'.index(a) for a in axes]
+
+    def get_tree(self, axes='xyz'):
+        """
+        Return the KD-tree of the points projected on the axes ('xyz', 'xy',
+        'yz', 'zx', etc.).
+        """
+        if not(axes in self.trees):
+            _debug('SweepResult: get_tree: build', axes)
+            self.trees[axes] = cKDTree(self.points[:, self.get_axes_index(axes)])
+        return self.trees[axes]
+
+    def query_nearest(self, r, k=1, axes='xyz'):
+        """
+        Return (distances, indices, ws) of the k closest points to the
+        position r.
+
+        r:
+            Position, with one coordinate per axis (or an array of
+            positions).
+        axes:
+            Axes of the positions (for example 'xy' for ignoring z).
+        """
+        distances, indices = self.get_tree(axes).query(r, k=k)
+        return distances, indices, self.ws[indices]
+
+    def query_radius(self, r, radius, axes='xyz'):
+        """
+        Return (indices, ws) of the points within the radius of the position
+        r.
+        """
+        indices = np.array(self.get_tree(axes).query_ball_point(r, radius), dtype=int)
+        return indices, self.ws[indices]
+
+    def interpolate(self, rs, kernel='IDW', radius=None, k=8, power=2,
+                    sigma=None, axes='xyz'):
+        """
+        Return the data interpolated at the positions rs (array of shape
+        (N, len(axes))). The positions without point around are nan.
+
+        kernel:
+            'IDW' or 'Gaussian'
+        radius:
+            Only the points within this distance are used. Default is 3 sigma
+            for the gaussian and no limit for IDW.
+        k:
+            Maximum number of points used for each position (the closest).
+        power:
+            Power of the distance for IDW.
+        sigma:
+            Width of the gaussian. Default is the typical distance between the
+            points (the grid step for regrid).
+        """
+        _debug('SweepResult: interpolate')
+
+        rs = np.atleast_2d(np.asarray(rs, dtype=float))
+        if len(self) == 0:
+            return np.full(len(rs), np.nan)
+        k = min(k, len(self))
+        tree = self.get_tree(axes)
+        if kernel == 'Gaussian':
+            if sigma is None:
+                sigma = self.get_spacing(axes)
+            if radius is None:
+                radius = 3*sigma
+        if radius is None:
+            radius = np.inf
+
+        distances, indices = tree.query(rs, k=k, distance_upper_bound=radius)
+        distances = np.reshape(distances, (len(rs), k))
+        indices   = np.reshape(indices  , (len(rs), k))
+        weights = get_weights(distances, kernel, power, sigma)
+        # The missing neighbours have the index len(self)
+        ws = np.concatenate([self.ws, [0]])[indices]
+        sum_weights = np.sum(weights, axis=1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            return np.where(sum_weights > 0, np.sum(weights*ws, axis=1)/sum_weights, np.nan)
+
+    def get_spacing(self, axes='xyz'):
+        """
+        Return the typical distance between a point and its closest
+        neighbour (median).
+        """
+        if len(self) < 2:
+            return 1
+        # A sample is enough
+        step = max(1, len(self)//1000)
+        distances = self.get_tree(axes).query(self.points[::step, self.get_axes_index(axes)], k=2)[0][:,1]
+        spacing = np.median(distances)
+        return spacing if spacing > 0 else 1
+
+    def get_bounds(self, axes='xyz'):
+        """
+        Return (mins, maxs) of the points on the axes.
+        """
+        points = self.points[:, self.get_axes_index(axes)]
+        return np.min(points, axis=0), np.max(points, axis=0)
+
+    def regrid(self, nb_pts=50, axes='xyz', **kwargs):
+        """
+        Return (grid_axes, W), the data interpolated on a regular grid that
+        covers the points.
+
+        nb_pts:
+            Number of grid points on each axis (or a list with one number per
+            axis).
+        axes:
+            'xyz' for a 3D grid, or two axes (like 'xy') for a planar grid on
+            which the points are projected.
+        kwargs:
+            Are sent to interpolate (kernel, radius, k, power, sigma).
+
+        grid_axes is the list of the 1D arrays of the grid on each axis and
+        W[i][j]... is the data at (grid_axes[0][i], grid_axes[1][j], ...).
+        """
+        _debug('SweepResult: regrid', axes)
+
+        mins, maxs = self.get_bounds(axes)
+        nb_pts = np.broadcast_to(nb_pts, len(axes))
+        grid_axes = [np.linspace(mins[i], maxs[i], nb_pts[i]) for i in range(len(axes))]
+        if kwargs.get('kernel') == 'Gaussian' and kwargs.get('sigma') is None:
+            # Smooth over the size of a grid step
+            kwargs['sigma'] = max(np.max((maxs - mins)/np.maximum(nb_pts-1, 1)),
+                                  self.get_spacing(axes))
+        grids = np.meshgrid(*grid_axes, indexing='ij')
+        rs = np.transpose([g.ravel() for g in grids])
+        W = self.interpolate(rs, axes=axes, **kwargs)
+        return grid_axes, W.reshape(grids[0].shape)
+
+    def get_preview(self, nb_max=20000):
+        """
+        Return (xs, ys, zs, ws) with at most about nb_max points for plotting.
+        The points in the same voxel are averaged. If there are less points,
+        they are all returned.
+        """
+        _debug('SweepResult: get_preview')
+
+        points, ws = self.get_voxel_means(nb_max)[:2]
+        return points[:,0], points[:,1], points[:,2], ws
+
+    def get_voxel_means(self, nb_max):
+        """
+        Return (points, ws, multiplicities) with at most about nb_max points.
+        The points in the same voxel are averaged, weighted by their
+        multiplicities (number of measured points in each). If there are less
+        points, they are all returned.
+        """
+        _debug('SweepResult: get_voxel_means')
+
+        if len(self) <= nb_max:
+            return self.points, self.ws, self.multiplicities
+        mins, maxs = self.get_bounds()
+        spans = np.maximum(maxs - mins, 1e-12)
+        # Voxels of the same size in the 3 directions. Start with about nb_max
+        # of them in the volume, then adjust the size on the number of
+        # occupied voxels (the points are on lines or planes).
+        size = (np.prod(spans)/nb_max)**(1/3)
+        best = None
+        for i in range(10):
+            voxels = np.floor((self.points - mins)/size).astype(np.int64)
+            # One integer per voxel, much faster to sort than the triplets
+            nb_voxels = np.max(voxels, axis=0) + 1
+            keys, inverse = np.unique(np.ravel_multi_index(voxels.T, nb_voxels),
+                                      return_inverse=True)
+            if len(keys) <= nb_max and (best is None or len(keys) > best[0]):
+                best = (len(keys), inverse)
+            if 0.7*nb_max <= len(keys) <= nb_max:
+                break
+            # Like if the points were on a plane
+            size *= np.clip(np.sqrt(len(keys)/nb_max), 0.5, 2)*(1.05 if len(keys) > nb_max else 1)
+        if best is None:
+            # Never small enough, take the first points
+            return self.points[:nb_max], self.ws[:nb_max], self.multiplicities[:nb_max]
+        inverse = best[1]
+        inverse = np.ravel(inverse)
+        m = self.multiplicities
+        multiplicities = np.bincount(inverse, weights=m)
+        points = np.transpose([np.bincount(inverse, weights=m*self.points[:,i])
+                               for i in range(3)])/multiplicities[:,None]
+        ws = np.bincount(inverse, weights=m*self.ws)/multiplicities
+        return points, ws, multiplicities
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import time
+
+    # Fake a sweep: zigzag lines in a plane, with a bright ring
+    xs, ys, zs = [], [], []
+    for y in np.linspace(0, 10, 150):
+        x = np.linspace(0, 10, 1000)
+        xs.extend(x)
+        ys.extend(y + 0.01*np.random.normal(size=len(x)))
+        zs.extend(5 + 0.1*x)
+    xs, ys, zs = np.array(xs), np.array(ys), np.array(zs)
+    rate = 100 + 50*np.exp(-(np.hypot(xs-5, ys-5)-3)**2/0.1)
+    ws = np.random.poisson(rate)
+
+    t0 = time.time()
+    result = SweepResult(xs, ys, zs, ws)
+    result.get_tree()
+    print('%d points, tree built in %.0f ms'%(len(result), 1e3*(time.time()-t0)))
+    t0 = time.time()
+    distances, indices, w = result.query_nearest([5, 8, 5.5], k=5)
+    print('Nearest:', np.round(distances, 4), w, '(%.2f ms)'%(1e3*(time.time()-t0)))
+    print('Points within 0.1 mm: %d'%len(result.query_radius([5, 8, 5.5], 0.1)[0]))
+    for kernel in ['IDW', 'Gaussian']:
+        t0 = time.time()
+        grid_axes, W = result.regrid(100, axes='xy', kernel=kernel)
+        dt = time.time() - t0
+        X, Y = np.meshgrid(*grid_axes, indexing='ij')
+        truth = 100 + 50*np.exp(-(np.hypot(X-5, Y-5)-3)**2/0.1)
+        print('%s 100x100 grid in %.0f ms, rms error %.1f counts'%(kernel, 1e3*dt,
+                                                                    np.sqrt(np.nanmean((W-truth)**2))))
+    t0 = time.time()
+    preview = result.get_preview(20000)
+    print('Preview: %d points in %.0f ms'%(len(preview[0]), 1e3*(time.time()-t0)))
+
+    # Live map of a long sweep, line by line, with a bounded number of points
+    t0 = time.time()
+    live = SweepResult(nb_max=20000)
+    for i in range(0, len(xs), 1000):
+        live.add_points(xs[i:i+1000], ys[i:i+1000], zs[i:i+1000], ws[i:i+1000])
+    grid_axes, W = live.regrid(100, axes='xy', kernel='Gaussian')
+    print('Live map: %d points kept (%d measured) in %.0f ms, rms error %.1f counts'%(
+          len(live), np.sum(live.multiplicities), 1e3*(time.time()-t0),
+          np.sqrt(np.nanmean((W-truth)**2))))
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 17:48:30 2026
+
+Goal: Write the points of a magnet sweep on the disk as the sweep goes, line
+by line, such that a crash doesn't lose them and the memory doesn't grow for
+the whole sweep.
+
+A sweep is a folder containing:
+    - header.json: the settings of the sweep (the path of the lines, the
+      tree dictionary, the date, the name of the columns). It is rewritten
+      (atomically) only if the path of the sweep is extended.
+    - points.bin: the points, appended line after line. Each point is a
+      record of float64, one per column (see COLUMNS).
+    - lines.txt: one line of text per completed line of the sweep:
+      iteration, index of the first point, number of points, time
+      It is written after the points of the line are on the disk, so the
+      points after the last line of this file are incomplete and ignored.
+    - events.txt: one line of text per event (like an optimization):
+      time, iteration, description
+
+The other files are only appended, never rewritten. The points are read with a
+memory map, such that a sweep can be looked at (or resumed) without loading
+everything.
+
+@author: Childresslab
+"""
+
+import numpy as np
+import json
+import os
+import time
+import tempfile
+
+from checkpoint import _to_json_friendly # For writting the header
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+# Columns of each point, in points.bin
+COLUMNS = ['xs', 'ys', 'zs', 'ws', 'ts', 'xs_measured', 'ys_measured', 'zs_measured']
+
+
+class SweepWriter():
+    """
+    Append the lines of a sweep in a folder. See the description of the
+    module for the format.
+    """
+    def __init__(self, path, headers=None, resume=False):
+        """
+        path:
+            Path of the folder. It is created if it does not exist.
+        headers:
+            Dictionary of the settings of the sweep, written in header.json
+            if the sweep is new. The values must be convertible to json.
+        resume:
+            If True, the folder must contain a sweep and the new lines are
+            appended to it (headers is ignored). If False, the folder must not
+            already contain a sweep (FileExistsError), such that two sweeps
+            are never mixed.
+        """
+        _debug('SweepWriter: __init__')
+        _debug('Small deeds done are better than great deeds planned. – Peter Marshall')
+
+        self.path = path
+        if not(os.path.exists(path)):
+            os.makedirs(path)
+        self.path_header = os.path.join(path, 'header.json')
+        self.path_points = os.path.join(path, 'points.bin')
+        self.path_lines  = os.path.join(path, 'lines.txt')
+        self.path_events = os.path.join(path, 'events.txt')
+
+        is_sweep = os.path.exists(self.path_header) or os.path.exists(self.path_points)
+        if resume and not(is_sweep):
+            raise FileNotFoundError('There is no sweep to resume in '+path)
+        if not(resume) and is_sweep:
+            raise FileExistsError('There is already a sweep in '+path)
+        if not(resume):
+            headers = {} if headers is None else dict(headers)
+            headers['columns'] = COLUMNS
+            self.write_headers(headers)
+            with open(self.path_lines, 'w') as f:
+                f.write('# iteration, first point, number of points, time\n')
+            with open(self.path_events, 'w') as f:
+                f.write('# time, iteration, event\n')
+
+        # Number of complete points on the disk. Incomplete points of a
+        # previous crash are cut, such that the new points are aligned.
+        self.nb_points = SweepReader(path).get_nb_points()
+        with open(self.path_points, 'ab') as f:
+            f.truncate(self.nb_points*len(COLUMNS)*8)
+
+    def write_headers(self, headers):
+        """
+        Write the header file. It is written in a temporary file first, such
+        that a crash never leaves a corrupted header.
+        """
+        fd, path_temp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(_to_json_friendly(headers), f, indent=1)
+        os.replace(path_temp, self.path_header)
+
+    def update_headers(self, headers):
+        """
+        Change some values of the header, for example when the path of the
+        sweep is extended.
+        """
+        _debug('SweepWriter: update_headers')
+
+        with open(self.path_header, 'r') as f:
+            headers_old = json.load(f)
+        headers_old.update(headers)
+        self.write_headers(headers_old)
+
+    def add_line(self, iteration, columns):
+        """
+        Append the points of a completed line.
+
+        iteration:
+            Iteration of the sweep (index of the line).
+        columns:
+            Dictionary with a list of values for each name in COLUMNS. They
+            must all have the same length.
+        """
+        _debug('SweepWriter: add_line', iteration)
+
+        points = np.column_stack([np.asarray(columns[key], dtype=np.float64) for key in COLUMNS])
+        with open(self.path_points, 'ab') as f:
+            f.write(points.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        # Now that the points are there, note the line
+        with open(self.path_lines, 'a') as f:
+            f.write('%d, %d, %d, %.17g\n'%(iteration, self.nb_points, len(points), time.time()))
+            f.flush()
+            os.fsync(f.fileno())
+        self.nb_points += len(points)
+
+    def add_event(self, iteration, event):
+        """
+        Note an event (like an optimization) at the iteration.
+
+        event:
+            String describing the event. The commas are replaced.
+        """
+        _debug('SweepWriter: add_event', iteration, event)
+
+        with open(self.path_events, 'a') as f:
+            f.write('%.17g, %d, %s\n'%(time.time(), iteration, str(event).replace(',', ';')))
+
+
+class SweepReader():
+    """
+    Read a sweep written by SweepWriter, even if it is still running or if it
+    was interrupted.
+    """
+    def __init__(self, path):
+        """
+        path:
+            Path of the folder of the sweep.
+        """
+        _debug('SweepReader: __init__')
+
+        self.path = path
+        with open(os.path.join(path, 'header.json'), 'r') as f:
+            self.headers = json.load(f)
+        self.columns = self.headers.get('columns', COLUMNS)
+        self.lines = self.read_table('lines.txt', 4)
+
+    def read_table(self, name, nb_columns):
+        """
+        Return the numbers of a text file of the folder as a 2D array. The
+        last line is ignored if it is incomplete.
+        """
+        path = os.path.join(self.path, name)
+        rows = []
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.startswith('#') or not(line.endswith('\n')):
+                        continue
+                    values = line.split(',')
+                    if len(values) == nb_columns:
+                        rows.append([float(v) for v in values])
+        return np.array(rows).reshape(-1, nb_columns)
+
+    def get_nb_points(self):
+        """
+        Return the number of points of the completed lines.
+        """
+        if len(self.lines) == 0:
+            return 0
+        return int(self.lines[-1,1] + self.lines[-1,2])
+
+    def get_last_iteration(self):
+        """
+        Return the iteration of the last completed line, or 0 if there is
+        none (the iteration 0 is the motion to the start).
+        """
+        if len(self.lines) == 0:
+            return 0
+        return int(self.lines[-1,0])
+
+    def get_points(self):
+        """
+        Return the points of the completed lines, as a read-only memory map
+        of shape (number of points, number of columns). Nothing is read from
+        the disk until the values are used.
+        """
+        nb_points = self.get_nb_points()
+        if nb_points == 0:
+            return np.zeros((0, len(self.columns)))
+        return np.memmap(os.path.join(self.path, 'points.bin'), dtype=np.float64,
+                         mode='r', shape=(nb_points, len(self.columns)))
+
+    def get_column(self, key):
+        """
+        Return the column key (for example 'ws') of all the points.
+        """
+        return self.get_points()[:, self.columns.index(key)]
+
+    def get_line(self, i):
+        """
+        Return the points of the i'th completed line (not the iteration).
+        """
+        start, N = int(self.lines[i,1]), int(self.lines[i,2])
+        return self.get_points()[start:start+N]
+
+    def get_events(self):
+        """
+        Return the list of the events, as (time, iteration, description).
+        """
+        events = []
+        path = os.path.join(self.path, 'events.txt')
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                for line in f:
+                    if line.startswith('#') or not(line.endswith('\n')):
+                        continue
+                    t, iteration, event = line.split(',', 2)
+                    events.append((float(t), int(iteration), event.strip()))
+        return events
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    import shutil
+
+    # Fake a sweep that crashes in the middle of a line
+    path = 'sweep_test'
+    writer = SweepWriter(path, {'resolution':1, 'xs':[0, 1, 2]})
+    for iteration in range(1, 4):
+        N = 1000
+        columns = {key:np.random.normal(size=N) for key in COLUMNS}
+        writer.add_line(iteration, columns)
+        if iteration == 2:
+            writer.add_event(iteration, 'Optimized, counts=123')
+    # The crash: half a line of points, without its entry in lines.txt
+    with open(writer.path_points, 'ab') as f:
+        f.write(np.zeros(123).tobytes())
+
+    reader = SweepReader(path)
+    print('%d lines, %d points, last iteration %d'%(len(reader.lines), reader.get_nb_points(),
+                                                     reader.get_last_iteration()))
+    print('Events:', reader.get_events())
+    print('Last w equal:', reader.get_column('ws')[-1] == columns['ws'][-1])
+
+    # A new sweep can't go in the same folder
+    try:
+        SweepWriter(path, {'resolution':2})
+    except FileExistsError as e:
+        print('New sweep refused:', e)
+
+    # Resume
+    writer = SweepWriter(path, resume=True)
+    writer.add_line(4, columns)
+    reader = SweepReader(path)
+    print('After resuming: %d points, last line ok: %s'%(reader.get_nb_points(),
+          np.all(reader.get_line(-1)[:,3] == columns['ws'])))
+    shutil.rmtree(path)
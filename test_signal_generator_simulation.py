@@ -0,0 +1,81 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Mon Oct 26 10:41:12 2026
+
+Goal: Check that signal_generator_api talks to the simulated instrument
+through the real visa_api_base of mcphysics (query = write, then read).
+
+Run with: python -m pytest -q test_signal_generator_simulation.py
+
+@author: Childresslab
+"""
+
+import os
+os.environ.setdefault('QT_QPA_PLATFORM', 'offscreen') # No display needed
+
+import pytest
+import numpy as np
+
+mcphysics = pytest.importorskip('mcphysics')
+if not hasattr(mcphysics, 'visa_tools'):
+    # Newer mcphysics keep it in the instruments
+    from mcphysics.instruments import _visa_tools
+    mcphysics.visa_tools = _visa_tools
+
+import gui_signal_generator as gsg
+
+
+@pytest.fixture
+def api():
+    gsg.simulation_settings['latency_s'] = 0
+    return gsg.signal_generator_api(pyvisa_py=True, simulation=True, write_sleep=0)
+
+def test_idn(api):
+    assert 'SMA100B' in api.idn
+    assert isinstance(api._api, gsg.sma100b_api)
+
+def test_send_list_and_get_mode(api):
+    fs = np.linspace(2.8e9, 2.9e9, 101)
+    Ps = np.full(101, -10.0)
+    api.set_mode('List')
+    assert api.send_list(fs, Ps, dwell=1000, delay=0) == True
+    # The simulator is in list mode again, like the SMA100B after send_list
+    assert api.get_mode() == 'List'
+    assert api.instrument.get_list_length() == 101
+    assert np.allclose(api.instrument.list_frequencies, fs)
+    # Same list again: nothing is sent
+    assert api.send_list(fs, Ps, dwell=1000, delay=0) == False
+
+def test_get_mode_after_output_off(api):
+    api.set_mode('List')
+    api.set_output(False)
+    assert api.get_mode() == 'Fixed'
+    assert api.get_output() == False
+
+def test_fake_fpga_follows_the_list(api, monkeypatch):
+    api_fpga = pytest.importorskip('api_fpga')
+    sim = api.instrument
+    sim.write('SOUR1:LIST:FREQ 2.82e9,2.87e9,2.92e9')
+    sim.write('SOUR1:LIST:POW 10,10,10')
+    sim.write('SOUR1:FREQ:MODE LIST')
+    sim.write('OUTP ON')
+    fpga = api_fpga.FPGA_fake_api('', 'RIO0')
+    fpga.set_signal_generator(sim, DIO_trigger=7, DIO_count=1)
+    monkeypatch.setitem(api_fpga.simulation_settings, 'rate_cps', 1e9) # Small noise
+    trigger, count = 1<<(16+7), 1<<(16+1)
+
+    # Trigger, then count: the count reads the list point 1 (off resonance)
+    fpga.data = np.array([1000|trigger, 1000, 60000|count, 1000])
+    fpga.run_pulse()
+    assert sim.list_index == 1
+    on_point_1 = fpga.counts[0]
+    # Count with a trigger in the middle: half at the point 1, half at 2
+    fpga.data = np.array([1000, 30000|count, 30000|count|trigger, 1000])
+    fpga.run_pulse()
+    assert sim.list_index == 2
+    assert 0.75*on_point_1 < fpga.counts[0] < 0.95*on_point_1
+    # Count, then trigger: the count reads the list point 2 (resonance)
+    fpga.data = np.array([60000|count, 1000|trigger, 1000])
+    fpga.run_pulse()
+    assert sim.list_index == 0
+    assert fpga.counts[0] < 0.85*on_point_1
@@ -0,0 +1,210 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Tue Oct 20 11:02:19 2026
+
+Goal: Predict the position of the actuators along a straight line, from the
+time, instead of asking them at each point.
+
+Each axis follows a trapezoidal speed profile: it accelerates up to its
+speed, moves at constant speed and decelerates down to the target (or a
+triangular profile if the distance is too short for reaching the speed).
+The model has two free parameters, found from a few readings of the
+positions during the line:
+    - The delay between the command and the start of the motion.
+    - A scale on the speeds (the real speed is not exactly the one asked).
+The RMS difference between the readings and the model tells if the model is
+trustable.
+
+@author: Childresslab
+"""
+
+import numpy as np
+from scipy.optimize import least_squares
+
+import traceback
+_p = traceback.print_last #Very usefull command to use for getting the last-not-printed error
+
+# Debug stuff.
+_debug_enabled     = False
+
+def _debug(*a):
+    if _debug_enabled:
+        s = []
+        for x in a: s.append(str(x))
+        print(', '.join(s))
+
+
+def trapezoid_profile(distance, speed, acceleration):
+    """
+    Return (t_acc, t_cruise, speed) of the trapezoidal speed profile: the time
+    of acceleration, the time at constant speed and the speed reached.
+    See trapezoid_distance for the inputs.
+    """
+    t_acc = speed/acceleration
+    if acceleration*t_acc**2 > distance:
+        # Triangular profile: never reach the speed
+        t_acc = np.sqrt(distance/acceleration)
+        speed = acceleration*t_acc
+    t_cruise = (distance - acceleration*t_acc**2)/speed
+    return t_acc, t_cruise, speed
+
+def trapezoid_distance(ts, distance, speed, acceleration):
+    """
+    Return the distance travelled at the times ts, for a motion starting at
+    t=0 from rest and stopping at the distance, with a trapezoidal speed
+    profile.
+
+    ts:
+        Array of times (s). The negative times give zero.
+    distance:
+        Total distance (positive).
+    speed:
+        Maximum speed (positive).
+    acceleration:
+        Acceleration and deceleration (positive).
+    """
+    ts = np.clip(np.asarray(ts, dtype=float), 0, None)
+    if distance <= 0 or speed <= 0:
+        return np.zeros(np.shape(ts))
+    if acceleration is None or acceleration <= 0:
+        # Instantaneous acceleration
+        return np.minimum(speed*ts, distance)
+
+    t_acc, t_cruise, speed = trapezoid_profile(distance, speed, acceleration)
+    d_acc = 0.5*acceleration*t_acc**2
+    t_end = 2*t_acc + t_cruise
+
+    d = np.where(ts < t_acc, 0.5*acceleration*ts**2,
+                 d_acc + speed*(ts - t_acc))
+    t_dec = ts - t_acc - t_cruise # Time since the start of the deceleration
+    is_decelerating = t_dec > 0
+    d = np.where(is_decelerating,
+                 d_acc + speed*t_cruise + speed*t_dec - 0.5*acceleration*t_dec**2, d)
+    return np.where(ts >= t_end, distance, d)
+
+
+class LineTrajectory():
+    """
+    Model of the motion of the actuators along a straight line.
+    """
+    def __init__(self, r_start, r_end, speeds, acceleration=None):
+        """
+        r_start:
+            (x, y, z) position at the start (mm)
+        r_end:
+            (x, y, z) target position (mm)
+        speeds:
+            (vx, vy, vz) speed asked to each actuator (mm/s)
+        acceleration:
+            Acceleration of the actuators (mm/s^2). None for infinite.
+        """
+        _debug('LineTrajectory: __init__')
+        _debug('Quality is not an act, it is a habit. – Aristotle')
+
+        self.r_start = np.array(r_start, dtype=float)
+        self.r_end   = np.array(r_end  , dtype=float)
+        self.speeds  = np.abs(np.array(speeds, dtype=float))
+        self.acceleration = acceleration
+
+        self.distances  = np.abs(self.r_end - self.r_start)
+        self.directions = np.sign(self.r_end - self.r_start)
+        # Parameters of the model
+        self.delay = 0
+        self.speed_scale = 1
+        self.residual = None # RMS difference with the readings
+
+    def get_positions(self, ts, delay=None, speed_scale=None):
+        """
+        Return the positions (array of shape (3, len(ts))) at the times ts,
+        measured since the command to move.
+        """
+        if delay is None:
+            delay = self.delay
+        if speed_scale is None:
+            speed_scale = self.speed_scale
+        ts = np.asarray(ts, dtype=float) - delay
+        positions = np.empty((3, len(ts)))
+        for i in range(3):
+            d = trapezoid_distance(ts, self.distances[i], speed_scale*self.speeds[i],
+                                   self.acceleration)
+            positions[i] = self.r_start[i] + self.directions[i]*d
+        return positions
+
+    def get_duration(self):
+        """
+        Return the time (s) to reach the target, since the command.
+        """
+        durations = [0]
+        for i in range(3):
+            if self.distances[i]>0 and self.speeds[i]>0:
+                v = self.speed_scale*self.speeds[i]
+                if self.acceleration is None or self.acceleration <= 0:
+                    durations.append(self.distances[i]/v)
+                else:
+                    t_acc, t_cruise, v = trapezoid_profile(self.distances[i], v, self.acceleration)
+                    durations.append(2*t_acc + t_cruise)
+        return self.delay + max(durations)
+
+    def is_arrived(self, t):
+        """
+        Return True if the model says that the actuators reached the target
+        at the time t (since the command).
+        """
+        return t >= self.get_duration()
+
+    def fit(self, list_ts, list_positions):
+        """
+        Adjust the delay and the speed scale on the readings of the positions.
+
+        list_ts:
+            For each axis, the times of the readings (since the command).
+        list_positions:
+            For each axis, the positions read.
+        """
+        _debug('LineTrajectory: fit')
+
+        list_ts        = [np.asarray(ts, dtype=float) for ts in list_ts]
+        list_positions = [np.asarray(r , dtype=float) for r  in list_positions]
+        nb_readings = sum([len(ts) for ts in list_ts])
+        if nb_readings == 0:
+            return
+
+        def get_residuals(params):
+            residuals = []
+            for i in range(3):
+                if len(list_ts[i]) == 0:
+                    continue
+                r = self.get_positions(list_ts[i], params[0], params[1])[i]
+                residuals.append(r - list_positions[i])
+            return np.concatenate(residuals)
+
+        if nb_readings >= 2 and np.max(self.distances)>0:
+            result = least_squares(get_residuals, [self.delay, self.speed_scale],
+                                   bounds=([-1, 0.5], [10, 2]))
+            self.delay, self.speed_scale = result.x
+        self.residual = np.sqrt(np.mean(get_residuals([self.delay, self.speed_scale])**2))
+
+
+
+
+if __name__ == '__main__':
+    _debug_enabled = False
+
+    # Fake a line where the actuators start late and are a bit slow
+    r_start, r_end = [1, 5, 19], [4, 7, 23]
+    d = np.abs(np.array(r_end) - r_start)
+    speeds = 0.1*d/np.sqrt(np.sum(d**2)) # 0.1 mm/s along the line
+    truth = LineTrajectory(r_start, r_end, speeds, acceleration=0.5)
+    truth.delay, truth.speed_scale = 0.15, 0.97
+
+    # Read the positions once every 20 points of 10 ms
+    ts = np.arange(0, truth.get_duration() + 1, 0.01)
+    ts_reading = ts[::20]
+    readings = truth.get_positions(ts_reading) + np.random.normal(0, 1e-4, (3, len(ts_reading)))
+
+    model = LineTrajectory(r_start, r_end, speeds, acceleration=0.5)
+    error_before = np.max(np.abs(model.get_positions(ts) - truth.get_positions(ts)))
+    model.fit([ts_reading]*3, readings)
+    error_after = np.max(np.abs(model.get_positions(ts) - truth.get_positions(ts)))
+    print('Delay %.3f s, speed scale %.3f, residual %.1e mm'%(model.delay, model.speed_scale, model.residual))
+    print('Max error: %.1e mm before the fit, %.1e mm after'%(error_before, error_after))